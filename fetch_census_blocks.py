@@ -9,6 +9,7 @@ It also integrates with TIGER/Line files to get accurate MultiPolygon geometries
 """
 
 import os
+import sys
 import time
 import requests
 import logging
@@ -53,8 +54,17 @@ SUPABASE_SERVICE_KEY = os.getenv('SUPABASE_SERVICE_ROLE_KEY')
 MIN_DELAY = 1.5  # seconds between API calls (increased from 1.0)
 BATCH_SIZE = 100  # Number of items to process in each batch
 
+# Local caches of the safety metrics processor keyed by census_blocks PKs (block memo, neighbor adjacency, temporal cube)
+SAFETY_METRICS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src', 'lib', 'safety-metrics')
+SAFETY_METRICS_DATA_DIR = os.getenv('SAFETY_METRICS_DATA_DIR', os.path.join(SAFETY_METRICS_DIR, 'data'))
+SAFETY_METRICS_CACHE_DIRS = ['block_memo', 'neighbor_cache', 'temporal_cube']
+
+# Shared direct Postgres COPY loader (optional psycopg dependency, used with --copy)
+sys.path.insert(0, SAFETY_METRICS_DIR)
+from postgres_bulk_load import bulk_load, bulk_load_unavailable_reason, connect_database
+
 class CensusFetcher:
-    def __init__(self):
+    def __init__(self, copy_load=False):
         # Initialize Supabase client
         self.supabase: Client = create_client(SUPABASE_URL, SUPABASE_SERVICE_KEY)
         
@@ -75,6 +85,10 @@ class CensusFetcher:
         # Store block group geometries
         self.block_group_geometries = {}
 
+        # With copy_load, block groups are queued by id and COPY-loaded in one transaction at the end
+        self.copy_load = copy_load
+        self.pending_block_groups = {}
+
     def _rate_limit(self):
         """Implement rate limiting for API calls"""
         now = time.time()
@@ -458,6 +472,12 @@ class CensusFetcher:
         """
         if not block_groups:
             return 0
+
+        if self.copy_load:
+            for bg in block_groups:
+                self.pending_block_groups[bg['id']] = bg
+            logger.debug(f"Queued {len(block_groups)} block groups for COPY load")
+            return len(block_groups)
             
         try:
             # Insert in smaller batches to avoid timeouts
@@ -499,8 +519,8 @@ class CensusFetcher:
         else:
             logger.warning("Failed to download TIGER/Line shapefile. Will use placeholder geometries.")
         
-        # Clear existing data if requested
-        if clear_existing:
+        # Clear existing data if requested (COPY loads replace it in the final transaction instead)
+        if clear_existing and not self.copy_load:
             if not self.clear_existing_data():
                 logger.error("Failed to clear existing data. Exiting.")
                 return
@@ -532,6 +552,9 @@ class CensusFetcher:
                 logger.info(f"Progress: {pbar.n}/{len(tract_ids)} tracts processed. "
                            f"Estimated time remaining: {remaining/60:.1f} minutes")
         
+        if self.copy_load and not self.copy_load_block_groups(replace_where={} if clear_existing else None):
+            return
+
         # Log completion
         elapsed = time.time() - start_time
         logger.info(f"Census block fetch complete.")
@@ -539,6 +562,7 @@ class CensusFetcher:
         logger.info(f"Successfully fetched data for {self.successful_fetches} tracts.")
         logger.info(f"Failed to fetch data for {self.failed_fetches} tracts.")
         logger.info(f"Total records added to database: {self.total_records_added}")
+        self.invalidate_safety_metric_caches()
 
     def run_for_city(self, state_fips="06", county_fips="037", city_id=1, clear_existing=True, test_limit=0):
         """
@@ -573,8 +597,8 @@ class CensusFetcher:
         else:
             logger.warning("Failed to download TIGER/Line shapefile. Will use placeholder geometries.")
 
-        # Clear existing data for this city if requested
-        if clear_existing:
+        # Clear existing data for this city if requested (COPY loads replace it in the final transaction instead)
+        if clear_existing and not self.copy_load:
             if not self.clear_city_data(city_id=city_id):
                 logger.error(f"Failed to clear existing data for {city_name}. Continuing anyway.")
 
@@ -627,6 +651,9 @@ class CensusFetcher:
                          logger.info(f"Progress: {pbar.n}/{len(tract_ids)} tracts processed.")
 
 
+        if self.copy_load and not self.copy_load_block_groups(replace_where={'city_id': city_id} if clear_existing else None):
+            return
+
         # Log completion
         elapsed = time.time() - start_time
         logger.info(f"Census block fetch COMPLETE for {city_name}.")
@@ -634,6 +661,57 @@ class CensusFetcher:
         logger.info(f"Successfully fetched block groups for {self.successful_fetches} API calls.")
         logger.info(f"Failed to fetch block groups for {self.failed_fetches} API calls.")
         logger.info(f"Total block groups inserted into database: {total_block_groups_inserted_count}")
+        self.invalidate_safety_metric_caches(city_id=city_id)
+
+    def copy_load_block_groups(self, replace_where=None):
+        """
+        COPY-load the queued block groups into census_blocks over a direct Postgres connection,
+        deleting the rows matching replace_where in the same transaction, so readers never see
+        the table half-empty
+
+        Args:
+            replace_where: Column values of the rows to replace, e.g. {'city_id': 1} ({} for all rows, None to only upsert)
+
+        Returns:
+            True if the load committed
+        """
+        block_groups = list(self.pending_block_groups.values())
+        if not block_groups:
+            logger.warning("No block groups queued for COPY load")
+            return True
+        try:
+            with connect_database() as conn:
+                result = bulk_load(conn, 'census_blocks', block_groups, list(block_groups[0]), replace_where=replace_where)
+        except Exception as e:
+            logger.error(f"COPY load of census blocks failed and was rolled back: {str(e)}")
+            return False
+        self.pending_block_groups = {}
+        self.total_records_added += result['written']
+        return True
+
+    def invalidate_safety_metric_caches(self, city_id=None):
+        """
+        Delete the safety metrics processor's local caches keyed by census block PKs
+        (coordinate -> block memo, neighbor adjacency, temporal cube) so they are rebuilt on its next run
+
+        Args:
+            city_id: City ID whose caches to delete (default: None for all cities)
+        """
+        prefix = f"city_{city_id}_" if city_id is not None else "city_"
+        removed = 0
+        for cache_dir in SAFETY_METRICS_CACHE_DIRS:
+            cache_path = os.path.join(SAFETY_METRICS_DATA_DIR, cache_dir)
+            if not os.path.isdir(cache_path):
+                continue
+            for file_name in os.listdir(cache_path):
+                if file_name.startswith(prefix):
+                    try:
+                        os.remove(os.path.join(cache_path, file_name))
+                        removed += 1
+                    except OSError as e:
+                        logger.warning(f"Could not remove safety metrics cache {file_name}: {e}")
+        if removed:
+            logger.info(f"Invalidated {removed} safety metrics cache files for {'city_id ' + str(city_id) if city_id is not None else 'all cities'}")
 
     def clear_city_data(self, city_id=1):
         """
@@ -686,13 +764,16 @@ if __name__ == "__main__":
     parser.add_argument('--debug', action='store_true', help='Enable debug logging')
     parser.add_argument('--test', action='store_true', help='Run in test mode with limited tracts')
     parser.add_argument('--full', action='store_true', help='Fetch all tracts even in city mode (no test limit)')
+    parser.add_argument('--copy', action='store_true', help='Load census_blocks with COPY through a staging table in one transaction over a direct Postgres connection (needs psycopg and SUPABASE_DB_URL)')
     
     args = parser.parse_args()
+    if args.copy and bulk_load_unavailable_reason():
+        parser.error(f"--copy is unavailable: {bulk_load_unavailable_reason()}")
     
     if args.debug:
         logger.setLevel(logging.DEBUG)
     
-    fetcher = CensusFetcher()
+    fetcher = CensusFetcher(copy_load=args.copy)
     
     if args.city_only:
         # Fetch data only for the city
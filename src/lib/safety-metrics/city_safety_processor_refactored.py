@@ -20,9 +20,21 @@ from sodapy import Socrata
 from tqdm import tqdm
 import time
 import math
+import hashlib
+import itertools
+import io
+import abc
 from scipy.spatial import KDTree
+from scipy.sparse import csr_matrix
+import shapely
+from shapely import STRtree
+import geopandas as gpd
 from postgrest.exceptions import APIError
 import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from postgres_bulk_load import bulk_load, bulk_load_unavailable_reason, connect_database
 
 # --- Basic Configuration ---
 logging.basicConfig(
@@ -39,15 +51,37 @@ SUPABASE_KEY = os.environ.get("SUPABASE_SERVICE_ROLE_KEY")
 
 # Script directory for loading local configs
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+# Local working data (incident stores, caches); override with SAFETY_METRICS_DATA_DIR
+LOCAL_DATA_DIR = os.environ.get("SAFETY_METRICS_DATA_DIR", os.path.join(SCRIPT_DIR, 'data'))
 
 # --- Constants ---
 SOCRATA_TIMEOUT = 60  # Timeout in seconds for Socrata API requests
+SOCRATA_PAGE_SIZE = 50000 # Rows per $limit/$offset page in windowed fetch mode
+SOCRATA_WINDOW_DAYS = 30 # Width of each date window in windowed fetch mode
+SOCRATA_MAX_WORKERS = 4 # Concurrent window downloads in windowed fetch mode
+SOCRATA_MAX_RETRIES = 3 # Attempts per page before a window is given up
+INCREMENTAL_OVERLAP_DAYS = 14 # Re-fetch this many days before the high-water mark to catch late-reported incidents
+CRIME_CACHE_DEFAULT_MAX_MB = 2048 # Size cap for the local Socrata pull cache before LRU eviction
 DEFAULT_NEIGHBOR_RADIUS_METERS = 400 # Default radius for finding neighbors
 DEFAULT_NEIGHBOR_BATCH_SIZE = 30 # Smaller batch size for neighbor RPC
 GEO_MAPPING_BATCH_SIZE = 20000 # Batch size for coordinate-to-block mapping RPC
-METRIC_UPLOAD_BATCH_SIZE = 100 # Batch size for uploading safety_metrics
+GEO_MAPPING_MAX_WORKERS = 4 # Concurrent coordinate-to-block mapping RPC batches
+MISSING_RPC_ERROR_CODE = 'PGRST202' # PostgREST: function not found (migration not applied)
+CENSUS_BLOCK_PAGE_SIZE = 1000 # Rows per census_blocks request when loading geometries for local mapping
+METRIC_UPLOAD_BATCH_SIZE = 100 # Batch size for uploading safety_metrics (serial upload engine)
+METRIC_UPLOAD_TARGET_BYTES = 512 * 1024 # JSON payload per safety_metrics write request (concurrent upload engine)
+METRIC_UPLOAD_MAX_BATCH_ROWS = 2000 # Row cap per safety_metrics write request (concurrent upload engine)
+METRIC_UPLOAD_MAX_WORKERS = 4 # Concurrent safety_metrics write requests (concurrent upload engine)
+METRIC_WRITE_MAX_RETRIES = 3 # Attempts per safety_metrics write request on transient errors (timeouts, 429/5xx)
+METRIC_WRITE_MAX_BISECT_DEPTH = 8 # How often a batch rejected for bad data is halved to isolate the bad rows
+METRIC_DATA_ERROR_CLASSES = ('22', '23') # SQLSTATE classes of rejected rows (data exceptions, constraint violations)
+METRIC_HASH_FETCH_BATCH_SIZE = 1000 # Page size when fetching existing safety_metrics content hashes
+METRIC_HASH_EXCLUDED_FIELDS = ('created_at', 'expires_at', 'content_hash') # Bookkeeping fields left out of the content hash
+SLIM_METRIC_OMITTED_FIELDS = ('geom',) # Slim payloads: always rebuilt from longitude/latitude by the safety_metrics trigger
+SLIM_METRIC_DEFAULTED_FIELDS = ('question', 'created_at', 'expires_at') # Slim payloads: left out and written as column defaults (question: by the trigger)
 ACCOMMODATION_UPDATE_BATCH_SIZE = 500 # Batch size for updating accommodations
 METRIC_EXPIRY_DAYS = 90 # How long metrics are considered valid
+METRIC_EXPIRY_REFRESH_DAYS = 7 # Incremental metric runs rewrite unchanged metrics expiring within this many days
 MAX_ACCOMMODATION_METRIC_DISTANCE_KM = 4.0 # Max distance to link accommodations to metrics
 NEIGHBOR_INCIDENT_WEIGHT = 0.25 # Weighting factor for neighbor incidents in score
 SCORE_DECAY_CONSTANT_K = 0.005 # Decay factor for calculating score from weighted incidents
@@ -64,9 +98,34 @@ except Exception as e:
     logger.error(f"Failed to initialize Supabase client: {e}", exc_info=True)
     sys.exit(1)
 
+# --- Compact Processed Incident Schema ---
+# Dtypes of the processed incident frame handed to calculate_metrics. Codes and block
+# identifiers are dictionary-encoded (category codes are the int block indices).
+COMPACT_INCIDENT_DTYPES = {
+    'crime_code': 'category',
+    'latitude': 'float32',
+    'longitude': 'float32',
+    'hour': 'uint8',
+    'month': 'uint16',
+    'day': 'uint16',
+    'weight': 'int32',
+    'census_block_pk': 'category',
+    'block_group_identifier': 'category',
+    'population': 'int32',
+    'housing_units': 'int32'
+}
+
+# --- Crime Source Extra Columns ---
+# Extra columns returned by the server-side aggregated ($group) fetch mode
+AGGREGATE_COUNT_FIELD = "incident_count" # count(*) per group, becomes the 'weight' column
+AGGREGATE_HOUR_FIELD = "incident_hour" # Server-side hour of day (from the HHMM time field or date_extract_hh())
+
 # --- Global Configuration Storage ---
 METRIC_DEFINITIONS = {}
 CITY_SPECIFIC_MAPPINGS = {}
+CENSUS_BLOCK_INDEXES = {} # city_id -> loaded census block STRtree (see load_census_block_index)
+CENSUS_VERSIONS = {} # city_id -> census_blocks data fingerprint (see get_census_version)
+MISSING_RPCS = set() # RPC functions the database reported as missing; not called again this run
 
 # --- Configuration Loading Functions ---
 def load_global_config():
@@ -127,6 +186,31 @@ def load_city_config(city_id: int) -> dict:
 
 # --- Helper Functions ---
 
+def log_frame_memory(df: pd.DataFrame, stage: str):
+    """Logs the row count and deep memory usage of a pipeline DataFrame at a named stage."""
+    memory_mb = df.memory_usage(deep=True).sum() / 1e6
+    bytes_per_row = df.memory_usage(deep=True).sum() / len(df) if len(df) else 0
+    logger.info(f"Memory [{stage}]: {len(df):,} rows, {memory_mb:,.1f} MB ({bytes_per_row:.0f} bytes/row)")
+
+def compact_incident_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Converts a processed incident frame to COMPACT_INCIDENT_DTYPES (columns not present are skipped).
+    Integer columns whose values do not fit the compact dtype (e.g. pre-1970 dates in
+    'month'/'day') keep their current dtype instead of silently wrapping around.
+    """
+    dtypes = {}
+    for col, dtype in COMPACT_INCIDENT_DTYPES.items():
+        if col not in df.columns:
+            continue
+        if dtype != 'category' and np.dtype(dtype).kind in 'iu':
+            bounds = np.iinfo(dtype)
+            values = df[col].to_numpy()
+            if len(values) and (values.min() < bounds.min or values.max() > bounds.max):
+                logger.warning(f"Column '{col}' holds values outside {dtype} ({values.min()}..{values.max()}); keeping {df[col].dtype}.")
+                continue
+        dtypes[col] = dtype
+    return df.astype(dtypes)
+
 def calculate_distance_km(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
     """
     Calculate the great circle distance between two points
@@ -144,12 +228,477 @@ def calculate_distance_km(lat1: float, lon1: float, lat2: float, lon2: float) ->
     r_km = 6371 # Radius of earth in kilometers
     return c * r_km
 
+def ordered_parallel_map(func, items, max_workers: int):
+    """
+    Applies func to each item on a bounded thread pool and yields the results
+    in input order. At most max_workers calls are in flight at any time, so
+    results are never buffered much further ahead than the consumer.
+    """
+    item_iter = iter(items)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque(executor.submit(func, item) for _, item in zip(range(max_workers), item_iter))
+        while pending:
+            result = pending.popleft().result()
+            for next_item in item_iter:
+                pending.append(executor.submit(func, next_item))
+                break
+            yield result
+
+# --- Crime Source Adapters ---
+# Each adapter knows one crime data source: its column names, how to fetch it (for
+# non-Socrata sources) and how to turn raw records into typed columns:
+#   latitude/longitude (float64), crime_code (str), timestamp (datetime64[ns], UTC),
+#   plus weight (int64) and aggregate_hour for aggregated ($group) pulls.
+# To add a city, add (or reuse) an adapter and register it in SOURCE_ADAPTERS.
+
+def extract_field_values(raw_records, field: str | None) -> np.ndarray:
+    """Returns one raw field as an object array from a list of dicts or a DataFrame (None where absent)."""
+    if field is None:
+        return np.full(len(raw_records), None, dtype=object)
+    if isinstance(raw_records, pd.DataFrame):
+        if field not in raw_records.columns:
+            return np.full(len(raw_records), None, dtype=object)
+        return raw_records[field].to_numpy() # Keep already typed columns (e.g. from CSV ingestion) as-is
+    return np.array([record.get(field) for record in raw_records], dtype=object)
+
+def parse_timestamp_value(value) -> pd.Timestamp:
+    """Parses one timestamp with format inference; naive values are taken as UTC. Returns naive UTC or NaT."""
+    try:
+        if value is None or pd.isna(value):
+            return pd.NaT
+        dt_obj = pd.to_datetime(str(value), errors='coerce')
+        if dt_obj is pd.NaT:
+            return pd.NaT
+        return dt_obj.tz_convert('UTC').tz_localize(None) if dt_obj.tzinfo is not None else dt_obj
+    except Exception:
+        return pd.NaT
+
+def coerce_timestamps(values, date_format: str) -> pd.Series:
+    """
+    Vectorized to_datetime with an explicit format, returning naive UTC timestamps.
+    The (rare) non-null values the format rejects fall back to per-value inference,
+    so unusual formats still parse exactly as before.
+    """
+    values = pd.Series(values, dtype=object)
+    parsed = pd.to_datetime(values, format=date_format, errors='coerce', utc=True).dt.tz_localize(None).astype('datetime64[ns]')
+    retry = parsed.isna() & values.notna()
+    if retry.any():
+        parsed[retry] = pd.to_datetime(values[retry].map(parse_timestamp_value)).astype('datetime64[ns]')
+    return parsed
+
+class CrimeSourceAdapter(abc.ABC):
+    """Base adapter: full timestamps in the date field, no separate time field. Subclasses implement fetch_records."""
+    source_type = None
+    fields = {
+        "date_field": None,
+        "time_field": None,
+        "code_field": None,
+        "lat_field": None,
+        "lon_field": None,
+        "id_field": None # Stable record id, used to deduplicate re-fetched incidents
+    }
+    reliable_hours = True # False skips metric time filters (e.g. date-only timestamps)
+
+    def __init__(self, crime_data_config: dict):
+        self.crime_data_config = crime_data_config
+
+    @property
+    def source_key(self) -> str:
+        """Identifier used for local stores (dataset id, or source type when there is none)."""
+        return self.crime_data_config.get('dataset_id') or self.source_type
+
+    def csv_dtypes(self) -> dict:
+        """Explicit read_csv dtypes for bulk CSV exports (codes and times stay text to keep leading zeros)."""
+        dtypes = {
+            self.fields['code_field']: str,
+            self.fields['lat_field']: 'float64',
+            self.fields['lon_field']: 'float64',
+            self.fields['date_field']: str,
+            AGGREGATE_COUNT_FIELD: 'Int64',
+            AGGREGATE_HOUR_FIELD: 'float64'
+        }
+        for text_field in ('time_field', 'id_field'):
+            if self.fields.get(text_field):
+                dtypes[self.fields[text_field]] = str
+        return dtypes
+
+    def parse_timestamps(self, date_values: np.ndarray, time_values: np.ndarray) -> np.ndarray:
+        """Parses full ISO 8601 timestamps in one vectorized pass; naive values are taken as UTC."""
+        return coerce_timestamps(date_values, 'ISO8601').to_numpy(dtype='datetime64[ns]')
+
+    def to_columns(self, raw_records, city_name: str) -> dict | None:
+        """
+        Converts raw records (list of dicts or DataFrame) into typed columns.
+        Returns None if a required source field is missing from every record.
+        """
+        required = {
+            'latitude': self.fields['lat_field'],
+            'longitude': self.fields['lon_field'],
+            'crime_code': self.fields['code_field'],
+            'date': self.fields['date_field']
+        }
+        # Aggregated ($group) pulls replace the time field with a server-side hour
+        hour_values = extract_field_values(raw_records, AGGREGATE_HOUR_FIELD)
+        has_aggregate_hour = len(hour_values) > 0 and not pd.isna(hour_values).all()
+        if self.fields['time_field'] and not has_aggregate_hour:
+            required['time'] = self.fields['time_field']
+        raw_values = {name: extract_field_values(raw_records, field) for name, field in required.items()}
+
+        missing_source_cols = [required[name] for name, values in raw_values.items()
+                               if len(values) > 0 and pd.isna(values).all()]
+        if missing_source_cols:
+            logger.error(f"Missing required source columns in raw data for {city_name} ({self.source_key}): {missing_source_cols}")
+            return None
+
+        columns = {
+            'latitude': pd.to_numeric(raw_values['latitude'], errors='coerce').astype(np.float64),
+            'longitude': pd.to_numeric(raw_values['longitude'], errors='coerce').astype(np.float64),
+            'crime_code': pd.Series(raw_values['crime_code'], dtype=object).astype(str).to_numpy(dtype=object),
+            'timestamp': self.parse_timestamps(raw_values['date'], raw_values.get('time'))
+        }
+
+        # Aggregated ($group) records carry a per-group incident count and possibly a server-side hour
+        count_values = extract_field_values(raw_records, AGGREGATE_COUNT_FIELD)
+        if len(count_values) > 0 and not pd.isna(count_values).all():
+            columns['weight'] = pd.to_numeric(count_values, errors='coerce')
+        if has_aggregate_hour:
+            columns['aggregate_hour'] = pd.to_numeric(hour_values, errors='coerce')
+        return columns
+
+    @abc.abstractmethod
+    def fetch_records(self, city_config: dict, days_back: int, max_records: int, since: datetime | None = None,
+                      **fetch_options) -> list | pd.DataFrame:
+        """
+        Fetches raw records for days_back days (or since a given start) from the source.
+        fetch_options carries the fetch_crime_data tuning (fetch_mode, cache_ttl_hours,
+        max_cache_mb, pushdown, aggregate) and its fetch_status dict; sources ignore
+        tuning options they do not support.
+        """
+
+class SocrataAdapter(CrimeSourceAdapter):
+    """Base for Socrata datasets, fetched through the SoQL query builder (prepare_socrata_query)."""
+    source_type = 'socrata'
+
+    def fetch_records(self, city_config: dict, days_back: int, max_records: int, since: datetime | None = None,
+                      **fetch_options) -> list | pd.DataFrame:
+        """Fetches via fetch_socrata_records, honoring every fetch option."""
+        return fetch_socrata_records(city_config, days_back, max_records, since=since, **fetch_options)
+
+class LapdSocrataAdapter(SocrataAdapter):
+    """LAPD Crime Data (2nrs-mtv8): date-only date_occ plus an HHMM time_occ text field."""
+    fields = {
+        "date_field": "date_occ",
+        "time_field": "time_occ",
+        "code_field": "crm_cd",
+        "lat_field": "lat",
+        "lon_field": "lon",
+        "id_field": "dr_no" # Division of Records number
+    }
+
+    def parse_timestamps(self, date_values: np.ndarray, time_values: np.ndarray) -> np.ndarray:
+        """
+        Combines the date part with the HHMM time, vectorized: hours >= 24 (e.g. '2400')
+        become 23:59, missing/non-HHMM times default to 12:00, and minutes above 59
+        make the timestamp invalid (NaT).
+        """
+        # Date part: text before 'T', parsed in one pass with an explicit format
+        date_parts = pd.Series(date_values, dtype=object).astype('string').str.split('T', n=1).str[0]
+        day_starts = coerce_timestamps(date_parts.astype(object).where(date_parts.notna(), None), '%Y-%m-%d').dt.normalize()
+
+        # Time part: zero-pad to HHMM, then minutes of the day as integer arithmetic
+        if time_values is None: # Aggregated pulls carry a server-side hour instead
+            time_values = np.full(len(date_values), None, dtype=object)
+        time_text = pd.Series(time_values, dtype=object).astype('string').str.zfill(4)
+        is_hhmm = time_text.str.fullmatch(r'[0-9]{4}').fillna(False).to_numpy(dtype=bool)
+        hhmm = pd.to_numeric(time_text.where(is_hhmm), errors='coerce').fillna(1200).to_numpy(dtype=np.int64)
+        hours, minutes = np.divmod(hhmm, 100)
+        minute_of_day = np.where(hours >= 24, 23 * 60 + 59, hours * 60 + minutes) # Handle '2400'
+        invalid_time = (hours < 24) & (minutes > 59)
+
+        timestamps = day_starts.to_numpy(dtype='datetime64[ns]') + minute_of_day.astype('timedelta64[m]')
+        timestamps[invalid_time] = np.datetime64('NaT')
+        return timestamps
+
+class NypdSocrataAdapter(SocrataAdapter):
+    """NYPD Arrest Data (uip8-fykc): arrest_date only carries the date, so hours are unreliable."""
+    fields = {
+        "date_field": "arrest_date", # Contains full timestamp
+        "time_field": None, # Time is part of the date field
+        "code_field": "ky_cd", # Law Code Category
+        "lat_field": "latitude",
+        "lon_field": "longitude",
+        "id_field": "arrest_key"
+    }
+    reliable_hours = False
+
+class GenericApiAdapter(CrimeSourceAdapter):
+    """
+    Plain JSON or CSV endpoint (crime_data.source_type 'api', e.g. Miami).
+    Field names default to date/code/latitude/longitude and can be overridden
+    with crime_data.fields; crime_data.format forces 'json' or 'csv'.
+    """
+    source_type = 'api'
+    default_fields = {
+        "date_field": "date",
+        "time_field": None,
+        "code_field": "code",
+        "lat_field": "latitude",
+        "lon_field": "longitude",
+        "id_field": None
+    }
+
+    def __init__(self, crime_data_config: dict):
+        super().__init__(crime_data_config)
+        self.fields = {**self.default_fields, **crime_data_config.get('fields', {})}
+
+    def fetch_records(self, city_config: dict, days_back: int, max_records: int, since: datetime | None = None,
+                      **fetch_options) -> list:
+        """
+        Downloads the endpoint once and filters it to the requested date range locally.
+        Socrata-only fetch options (modes, cache, pushdown, aggregate) are ignored.
+        """
+        fetch_status = fetch_options.get('fetch_status')
+        fetch_status = fetch_status if fetch_status is not None else {}
+        fetch_status['complete'] = False
+        city_name = city_config.get('city_name', 'Unknown City')
+        api_url = self.crime_data_config.get('api_url')
+        if not api_url:
+            logger.error(f"Missing 'api_url' in crime_data config for {city_name}.")
+            return []
+
+        token_var = self.crime_data_config.get('app_token_env_var')
+        headers = {'X-App-Token': os.environ[token_var]} if token_var and os.environ.get(token_var) else {}
+        try:
+            logger.info(f"Fetching crime data for {city_name} from {api_url}")
+            response = requests.get(api_url, headers=headers, timeout=SOCRATA_TIMEOUT)
+            response.raise_for_status()
+            response_format = self.crime_data_config.get('format')
+            if response_format is None:
+                is_csv = 'csv' in response.headers.get('content-type', '') or api_url.lower().endswith('.csv')
+                response_format = 'csv' if is_csv else 'json'
+            if response_format == 'csv':
+                records = pd.read_csv(io.StringIO(response.text), dtype=str).to_dict('records')
+            else:
+                payload = response.json()
+                records = payload.get('data', []) if isinstance(payload, dict) else payload
+        except Exception as e:
+            logger.error(f"Error fetching crime data for {city_name} from {api_url}: {e}", exc_info=True)
+            return []
+
+        start_date = since if since is not None else datetime.now(timezone.utc) - timedelta(days=days_back)
+        timestamps = self.parse_timestamps(extract_field_values(records, self.fields['date_field']), None)
+        in_range = timestamps >= np.datetime64(start_date.replace(tzinfo=None))
+        newest_first = np.argsort(timestamps[in_range])[::-1][:max_records]
+        in_range_indices = np.flatnonzero(in_range)[newest_first]
+        results = [records[i] for i in sorted(in_range_indices)]
+        fetch_status['complete'] = int(in_range.sum()) <= max_records
+        logger.info(f"Fetched {len(records):,} records from {api_url}; {len(results):,} fall in the requested range.")
+        return results
+
+# Registry: 'socrata:<dataset_id>' for Socrata datasets, source_type for everything else
+SOURCE_ADAPTERS = {
+    "socrata:2nrs-mtv8": LapdSocrataAdapter,
+    "socrata:uip8-fykc": NypdSocrataAdapter,
+    "api": GenericApiAdapter
+}
+
+def get_source_adapter(city_config: dict) -> CrimeSourceAdapter | None:
+    """Returns the adapter for the city's crime_data config, or None if none is registered."""
+    crime_data_config = city_config.get('crime_data', {})
+    source_type = crime_data_config.get('source_type')
+    registry_key = f"socrata:{crime_data_config.get('dataset_id')}" if source_type == 'socrata' else source_type
+    adapter_class = SOURCE_ADAPTERS.get(registry_key)
+    if adapter_class is None:
+        logger.error(f"No crime source adapter registered for '{registry_key}' ({city_config.get('city_name', 'Unknown City')}).")
+        return None
+    return adapter_class(crime_data_config)
+
+# --- Socrata Windowed Fetch Helpers ---
+
+def build_date_windows(start_date: datetime, end_date: datetime, window_days: int) -> list:
+    """Splits [start_date, end_date) into consecutive (window_start, window_end) tuples."""
+    windows = []
+    window_start = start_date
+    while window_start < end_date:
+        window_end = min(window_start + timedelta(days=window_days), end_date)
+        windows.append((window_start, window_end))
+        window_start = window_end
+    return windows
+
+def fetch_socrata_window(socrata_client: Socrata, dataset_id: str, select_clause: str, filter_clause: str,
+                         date_field: str, window: tuple, page_size: int = SOCRATA_PAGE_SIZE,
+                         group_clause: str | None = None, order_clause: str | None = None) -> list | None:
+    """
+    Fetches every record of one date window, paging with $offset.
+    Rows are ordered by the date field (and :id as a tie-breaker) unless order_clause
+    is given, so pages are stable. group_clause is passed through as $group.
+    Returns None if a page still fails after SOCRATA_MAX_RETRIES attempts.
+    """
+    window_start, window_end = window
+    window_where = (
+        f"{date_field} >= '{window_start.strftime('%Y-%m-%dT%H:%M:%S.000')}'"
+        f" AND {date_field} < '{window_end.strftime('%Y-%m-%dT%H:%M:%S.000')}'"
+    )
+    if filter_clause:
+        window_where += f" AND {filter_clause}"
+
+    records = []
+    offset = 0
+    while True:
+        for attempt in range(1, SOCRATA_MAX_RETRIES + 1):
+            try:
+                page = socrata_client.get(
+                    dataset_id,
+                    select=select_clause,
+                    where=window_where,
+                    group=group_clause,
+                    order=order_clause or f"{date_field}, :id",
+                    limit=page_size,
+                    offset=offset
+                )
+                break
+            except Exception as page_err:
+                logger.warning(f"Window {window_start.date()}..{window_end.date()} page at offset {offset} failed (attempt {attempt}/{SOCRATA_MAX_RETRIES}): {page_err}")
+                if attempt == SOCRATA_MAX_RETRIES:
+                    return None
+                time.sleep(2 ** attempt)
+
+        records.extend(page)
+        if len(page) < page_size:
+            break
+        offset += page_size
+
+    logger.debug(f"Fetched {len(records):,} records for window {window_start.date()}..{window_end.date()}.")
+    return records
+
+def iter_socrata_windows(socrata_client: Socrata, dataset_id: str, select_clause: str, filter_clause: str,
+                         date_field: str, start_date: datetime, end_date: datetime,
+                         max_workers: int = SOCRATA_MAX_WORKERS, newest_first: bool = False,
+                         group_clause: str | None = None, order_clause: str | None = None):
+    """
+    Yields (window, records) for each date window in chronological order (or reverse
+    chronological with newest_first), downloading up to max_workers windows concurrently
+    over the client's shared keep-alive session.
+    records is None for windows that failed after retries.
+    """
+    windows = build_date_windows(start_date, end_date, SOCRATA_WINDOW_DAYS)
+    if newest_first:
+        windows.reverse()
+    logger.info(f"Fetching {len(windows)} windows of {SOCRATA_WINDOW_DAYS} days with {max_workers} workers (page size {SOCRATA_PAGE_SIZE:,}).")
+
+    # Let every worker thread keep its own pooled connection to the Socrata host
+    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+    socrata_client.session.mount('https://', adapter)
+
+    def fetch_window(window):
+        return window, fetch_socrata_window(socrata_client, dataset_id, select_clause, filter_clause, date_field, window,
+                                            group_clause=group_clause, order_clause=order_clause)
+
+    yield from ordered_parallel_map(fetch_window, windows, max_workers)
+
+def fetch_socrata_csv(socrata_client: Socrata, domain: str, dataset_id: str, select_clause: str,
+                      where_clause: str, dtypes: dict, limit: int, group_clause: str | None = None,
+                      order_clause: str | None = None) -> pd.DataFrame:
+    """
+    Downloads the bulk CSV export (/resource/<id>.csv) for the given SoQL clauses and
+    parses it while streaming, chunk by chunk, into typed columns using dtypes.
+    Raises on HTTP or parse errors (handled by fetch_crime_data).
+    """
+    params = {'$select': select_clause, '$where': where_clause, '$limit': limit}
+    if group_clause:
+        params['$group'] = group_clause
+    if order_clause:
+        params['$order'] = order_clause
+    url = f"https://{domain}/resource/{dataset_id}.csv"
+    # The client session carries the app token header and connection pool
+    with socrata_client.session.get(url, params=params, stream=True, timeout=SOCRATA_TIMEOUT) as response:
+        response.raise_for_status()
+        response.raw.decode_content = True # Let urllib3 undo gzip transfer encoding
+        chunks = [
+            chunk for chunk in tqdm(
+                pd.read_csv(response.raw, dtype=dtypes, chunksize=SOCRATA_PAGE_SIZE),
+                desc=f"Reading CSV export ({dataset_id})", unit="chunk"
+            )
+        ]
+    if not chunks:
+        return pd.DataFrame(columns=list(dtypes))
+    return pd.concat(chunks, ignore_index=True)
+
 # --- Core Logic Functions ---
 
-def fetch_crime_data(city_config: dict, days_back: int, max_records: int) -> list:
+def build_pushdown_clause(city_config: dict, fields: dict) -> str:
+    """
+    Builds a SoQL filter restricting a pull to the crime codes mapped for the city
+    in safety_metrics_config.json (union over all metrics) and to the city's
+    mapbox_config bbox ("min_lon,min_lat,max_lon,max_lat").
+    Returns an empty string if neither filter can be built.
+    """
+    city_name = city_config.get('city_name', 'Unknown City')
+    clauses = []
+
+    city_crime_codes = CITY_SPECIFIC_MAPPINGS.get(str(city_config.get('city_id')), {})
+    mapped_codes = sorted({str(code) for codes in city_crime_codes.values() for code in codes})
+    if mapped_codes and fields.get('code_field'):
+        code_list = ", ".join(f"'{code}'" for code in mapped_codes)
+        clauses.append(f"{fields['code_field']} IN ({code_list})")
+    else:
+        logger.warning(f"No mapped crime codes found for {city_name}; code pushdown skipped.")
+
+    bbox = city_config.get('mapbox_config', {}).get('bbox')
+    if bbox and fields.get('lat_field') and fields.get('lon_field'):
+        try:
+            min_lon, min_lat, max_lon, max_lat = (float(v) for v in bbox.split(','))
+            # Cast to number so the bounds compare numerically even where coordinates are text columns
+            clauses.append(
+                f"{fields['lat_field']}::number BETWEEN {min_lat!r} AND {max_lat!r}"
+                f" AND {fields['lon_field']}::number BETWEEN {min_lon!r} AND {max_lon!r}"
+            )
+        except ValueError:
+            logger.warning(f"Invalid mapbox_config.bbox '{bbox}' for {city_name}; bbox pushdown skipped.")
+
+    return " AND ".join(clauses)
+
+def report_pushdown_savings(socrata_client: Socrata, dataset_id: str, base_where: str, pushed_where: str) -> dict | None:
+    """
+    Counts rows matching the query with and without pushdown filters (two cheap
+    count(*) requests) and logs how many rows the pushdown avoided transferring.
+    """
+    try:
+        base_count = int(socrata_client.get(dataset_id, select="count(*) AS row_count", where=base_where)[0]['row_count'])
+        pushed_count = int(socrata_client.get(dataset_id, select="count(*) AS row_count", where=pushed_where)[0]['row_count'])
+    except Exception as count_err:
+        logger.warning(f"Could not count rows for pushdown report on {dataset_id}: {count_err}")
+        return None
+
+    avoided = base_count - pushed_count
+    share = (avoided / base_count * 100.0) if base_count > 0 else 0.0
+    logger.info(f"Query pushdown: {pushed_count:,} of {base_count:,} rows match; {avoided:,} rows ({share:.1f}%) avoided.")
+    return {'base_rows': base_count, 'pushed_rows': pushed_count, 'avoided_rows': avoided}
+
+def report_city_pushdown_savings(city_config: dict, days_back: int) -> dict | None:
+    """
+    Runs report_pushdown_savings for the city's full days_back window. Opt-in
+    (--pushdown-report): both counts scan the whole window on the Socrata side.
+    """
+    query = prepare_socrata_query(city_config, days_back, pushdown=True)
+    if not query:
+        return None
+    try:
+        return report_pushdown_savings(query['client'], query['dataset_id'], query['base_where_clause'], query['where_clause'])
+    finally:
+        close_socrata_client(query['client'])
+
+def prepare_socrata_query(city_config: dict, days_back: int, since: datetime | None = None,
+                          pushdown: bool = False, aggregate: bool = False) -> dict | None:
     """
-    Fetches raw crime data from the source specified in the city configuration.
-    Currently supports Socrata API.
+    Validates the Socrata settings in city_config, opens a client and builds the
+    SELECT/WHERE clauses covering the last days_back days (or everything from
+    since onwards, when given). With pushdown, the mapped crime codes and the
+    city bbox are added to the WHERE clause (see build_pushdown_clause).
+    With aggregate, Socrata groups rows by (code, hour, lat, lon, month) and
+    returns count(*) per group instead of one row per incident.
+    Returns a dict of query parts (including the open client), or None if the
+    configuration is unusable.
     """
     city_name = city_config.get('city_name', 'Unknown City')
     crime_data_config = city_config.get('crime_data', {})
@@ -157,7 +706,7 @@ def fetch_crime_data(city_config: dict, days_back: int, max_records: int) -> lis
 
     if source_type != 'socrata':
         logger.error(f"Unsupported crime data source_type '{source_type}' for {city_name}. Only 'socrata' is supported.")
-        return []
+        return None
 
     # --- Socrata Specific Logic ---
     domain = crime_data_config.get('api_domain')
@@ -167,7 +716,7 @@ def fetch_crime_data(city_config: dict, days_back: int, max_records: int) -> lis
 
     if not domain or not dataset_id:
         logger.error(f"Missing 'api_domain' or 'dataset_id' in crime_data config for {city_name}.")
-        return []
+        return None
 
     if app_token_var and not app_token:
         logger.warning(f"Socrata app token env var '{app_token_var}' defined but not found for {city_name}. Proceeding without token (may have lower rate limits).")
@@ -176,48 +725,22 @@ def fetch_crime_data(city_config: dict, days_back: int, max_records: int) -> lis
     else:
         logger.info(f"No Socrata app token configured for {city_name}. Proceeding without token.")
 
-    # Initialize Socrata client for this request
-    try:
-        logger.info(f"Initializing Socrata client for {city_name} (Domain: {domain}, Timeout: {SOCRATA_TIMEOUT}s)")
-        socrata_client = Socrata(domain, app_token, timeout=SOCRATA_TIMEOUT)
-    except Exception as e:
-        logger.error(f"Failed to initialize Socrata client for {city_name}: {e}", exc_info=True)
-        return []
-
     # --- Calculate Date Filter ---
     try:
-        start_date = datetime.now(timezone.utc) - timedelta(days=days_back)
+        start_date = since if since is not None else datetime.now(timezone.utc) - timedelta(days=days_back)
         # Socrata SoQL format (YYYY-MM-DDTHH:MM:SS.fff)
         start_date_str = start_date.strftime('%Y-%m-%dT%H:%M:%S.000')
     except Exception as date_err:
         logger.error(f"Error calculating start date: {date_err}")
-        return []
+        return None
 
     # --- Define Dataset Specific Fields and Filters ---
-    # Map standard internal names to dataset-specific column names
-    dataset_field_mappings = {
-        "2nrs-mtv8": { # LAPD Crime Data
-            "date_field": "date_occ",
-            "time_field": "time_occ",
-            "code_field": "crm_cd",
-            "lat_field": "lat",
-            "lon_field": "lon"
-        },
-        "uip8-fykc": { # NYPD Arrest Data
-            "date_field": "arrest_date", # Contains full timestamp
-            "time_field": None, # Time is part of the date field
-            "code_field": "ky_cd", # Law Code Category
-            "lat_field": "latitude",
-            "lon_field": "longitude"
-        }
-        # Add mappings for other potential datasets here
-    }
-
-    if dataset_id not in dataset_field_mappings:
+    adapter = get_source_adapter(city_config)
+    if adapter is None:
         logger.error(f"Unknown dataset_id '{dataset_id}' for {city_name}. Cannot determine required fields.")
-        return []
+        return None
 
-    fields = dataset_field_mappings[dataset_id]
+    fields = adapter.fields
     date_field = fields["date_field"]
     lat_field = fields["lat_field"]
     lon_field = fields["lon_field"]
@@ -225,30 +748,200 @@ def fetch_crime_data(city_config: dict, days_back: int, max_records: int) -> lis
     # Build SELECT clause (only include fields that are not None)
     select_columns_list = [f for f in fields.values() if f is not None]
     select_clause = ", ".join(select_columns_list)
-
-    # Build WHERE clause
-    where_clause = f"{date_field} >= '{start_date_str}'"
+    group_clause = None
+    order_clause = None
+    if aggregate:
+        # Group per (code, hour, lat, lon). The month is kept (aliased to the date field) so
+        # dates still parse downstream. Hours are computed server-side: from the separate
+        # time field when the dataset has one (LAPD HHMM text, whose hour is HHMM div 100;
+        # grouping on the raw HHMM would keep one group per minute), otherwise from
+        # date_extract_hh().
+        group_columns = [fields["code_field"], lat_field, lon_field, f"date_trunc_ym({date_field})"]
+        select_columns_list = [fields["code_field"], lat_field, lon_field, f"date_trunc_ym({date_field}) AS {date_field}"]
+        if fields.get("time_field"):
+            hhmm = f"{fields['time_field']}::number"
+            hour_expression = f"({hhmm} - {hhmm} % 100) / 100"
+        else:
+            hour_expression = f"date_extract_hh({date_field})"
+        group_columns.append(hour_expression)
+        select_columns_list.append(f"{hour_expression} AS {AGGREGATE_HOUR_FIELD}")
+        select_columns_list.append(f"count(*) AS {AGGREGATE_COUNT_FIELD}")
+        select_clause = ", ".join(select_columns_list)
+        group_clause = ", ".join(group_columns)
+        order_clause = group_clause
+
+    # Build WHERE clause (non-date filters are kept separate for windowed mode)
+    filter_clause = ""
     if lat_field and lon_field:
         # Add IS NOT NULL checks for coordinates
-        where_clause += f" AND {lat_field} IS NOT NULL AND {lon_field} IS NOT NULL"
+        filter_clause = f"{lat_field} IS NOT NULL AND {lon_field} IS NOT NULL"
         # Add specific != '0' checks if necessary for certain datasets (optional)
         # e.g., if dataset_id == "2nrs-mtv8":
-        #    where_clause += f" AND {lat_field} != '0' AND {lon_field} != '0'"
+        #    filter_clause += f" AND {lat_field} != '0' AND {lon_field} != '0'"
+    base_where_clause = f"{date_field} >= '{start_date_str}'"
+    if filter_clause:
+        base_where_clause += f" AND {filter_clause}"
+
+    if pushdown:
+        pushdown_clause = build_pushdown_clause(city_config, fields)
+        if pushdown_clause:
+            filter_clause = f"{filter_clause} AND {pushdown_clause}" if filter_clause else pushdown_clause
+    where_clause = f"{date_field} >= '{start_date_str}'"
+    if filter_clause:
+        where_clause += f" AND {filter_clause}"
+
+    # Initialize Socrata client for this request
+    try:
+        logger.info(f"Initializing Socrata client for {city_name} (Domain: {domain}, Timeout: {SOCRATA_TIMEOUT}s)")
+        socrata_client = Socrata(domain, app_token, timeout=SOCRATA_TIMEOUT)
+    except Exception as e:
+        logger.error(f"Failed to initialize Socrata client for {city_name}: {e}", exc_info=True)
+        return None
+
+    return {
+        'client': socrata_client,
+        'domain': domain,
+        'dataset_id': dataset_id,
+        'date_field': date_field,
+        'select_clause': select_clause,
+        'group_clause': group_clause,
+        'order_clause': order_clause,
+        'filter_clause': filter_clause,
+        'where_clause': where_clause,
+        'base_where_clause': base_where_clause,
+        'start_date': start_date,
+        'start_date_str': start_date_str
+    }
+
+def close_socrata_client(socrata_client: Socrata):
+    """Closes the Socrata client connection if possible (depends on library version)."""
+    if hasattr(socrata_client, 'close'):
+        try:
+            socrata_client.close()
+        except Exception as close_err:
+            logger.warning(f"Error closing Socrata client: {close_err}")
+
+def fetch_crime_data(city_config: dict, days_back: int, max_records: int, fetch_mode: str = 'single',
+                     since: datetime | None = None, cache_ttl_hours: float | None = None,
+                     max_cache_mb: float = CRIME_CACHE_DEFAULT_MAX_MB, pushdown: bool = False,
+                     aggregate: bool = False, fetch_status: dict | None = None) -> list | pd.DataFrame:
+    """
+    Fetches raw crime data from the source specified in the city configuration
+    (Socrata datasets or plain JSON/CSV endpoints).
+    fetch_mode 'single' issues one request for up to max_records rows; 'windowed'
+    splits days_back into date windows paged in parallel and keeps the newest
+    max_records rows; 'csv' streams the bulk CSV export of the newest max_records
+    rows into a typed DataFrame (returned instead of a list of dicts), skipping
+    JSON decoding. since overrides the days_back start date.
+    With cache_ttl_hours, pulls are served from / written to the local Parquet
+    pull cache, keyed by dataset, SELECT/WHERE clauses and date range.
+    With pushdown, only mapped crime codes inside the city bbox are requested.
+    With aggregate, records are server-side (code, hour, lat, lon) groups carrying
+    an incident_count, and max_records limits the number of groups.
+    fetch_status, if given, gets 'complete': True only when every record in the date
+    range came back (no failed request or window, max_records not reached, not served
+    from the pull cache).
+    Dispatches to the source adapter's fetch_records.
+    """
+    adapter = get_source_adapter(city_config)
+    if adapter is None:
+        return []
+    return adapter.fetch_records(
+        city_config, days_back, max_records, since=since, fetch_mode=fetch_mode,
+        cache_ttl_hours=cache_ttl_hours, max_cache_mb=max_cache_mb, pushdown=pushdown, aggregate=aggregate,
+        fetch_status=fetch_status
+    )
+
+def fetch_socrata_records(city_config: dict, days_back: int, max_records: int, since: datetime | None = None,
+                          fetch_mode: str = 'single', cache_ttl_hours: float | None = None,
+                          max_cache_mb: float = CRIME_CACHE_DEFAULT_MAX_MB, pushdown: bool = False,
+                          aggregate: bool = False, fetch_status: dict | None = None) -> list | pd.DataFrame:
+    """Socrata implementation of fetch_crime_data (see there for the fetch options)."""
+    fetch_status = fetch_status if fetch_status is not None else {}
+    fetch_status['complete'] = False
+    city_name = city_config.get('city_name', 'Unknown City')
+    if cache_ttl_hours and since is None:
+        # Align the window start to midnight so the cache key is stable within a day
+        since = (datetime.now(timezone.utc) - timedelta(days=days_back)).replace(hour=0, minute=0, second=0, microsecond=0)
+    query = prepare_socrata_query(city_config, days_back, since=since, pushdown=pushdown, aggregate=aggregate)
+    if not query:
+        return []
+
+    socrata_client = query['client']
+    domain = query['domain']
+    dataset_id = query['dataset_id']
+    date_field = query['date_field']
+    select_clause = query['select_clause']
+    group_clause = query['group_clause']
+    filter_clause = query['filter_clause']
+    where_clause = query['where_clause']
+    start_date = query['start_date']
+    start_date_str = query['start_date_str']
+
+    # --- Check Local Pull Cache ---
+    cache_key = None
+    if cache_ttl_hours:
+        cache_key = crime_cache_key(dataset_id, select_clause, where_clause, max_records, group_clause=group_clause,
+                                    fetch_mode=fetch_mode, pushdown=pushdown, aggregate=aggregate)
+        cached_records = load_cached_crime_pull(cache_key, cache_ttl_hours, as_frame=fetch_mode == 'csv')
+        if cached_records is not None:
+            close_socrata_client(socrata_client)
+            return cached_records
 
     # --- Execute Socrata Query ---
     try:
-        logger.info(f"Querying {city_name} ({dataset_id}) for records since {start_date_str}")
+        logger.info(f"Querying {city_name} ({dataset_id}) for records since {start_date_str} (fetch mode: {fetch_mode})")
         logger.info(f"  SELECT: {select_clause}")
         logger.info(f"  WHERE: {where_clause}")
+        if group_clause:
+            logger.info(f"  GROUP: {group_clause}")
         logger.info(f"  LIMIT: {max_records:,}")
 
-        results = socrata_client.get(
-            dataset_id,
-            select=select_clause,
-            where=where_clause,
-            limit=max_records
-        )
+        if fetch_mode == 'windowed':
+            results = []
+            failed_windows = 0
+            window_iter = iter_socrata_windows(
+                socrata_client, dataset_id, select_clause, filter_clause, date_field,
+                start_date, datetime.now(timezone.utc),
+                group_clause=group_clause, order_clause=query['order_clause']
+            )
+            for window, window_records in tqdm(window_iter, desc=f"Fetching windows ({city_name})", unit="window"):
+                if window_records is None:
+                    logger.error(f"Giving up on window {window[0].date()}..{window[1].date()} for {city_name} after {SOCRATA_MAX_RETRIES} attempts.")
+                    failed_windows += 1
+                    continue
+                results.extend(window_records)
+            if failed_windows > 0:
+                logger.warning(f"{failed_windows} date windows failed for {city_name}. Crime data is incomplete for those periods.")
+            complete = failed_windows == 0 and len(results) <= max_records
+            if len(results) > max_records:
+                # Windows arrive oldest first, so the tail holds the newest records
+                logger.info(f"Trimming {len(results) - max_records:,} oldest records to respect max_records={max_records:,}.")
+                results = results[-max_records:]
+        elif fetch_mode == 'csv':
+            results = fetch_socrata_csv(
+                socrata_client, domain, dataset_id, select_clause, where_clause,
+                get_source_adapter(city_config).csv_dtypes(), max_records,
+                group_clause=group_clause,
+                order_clause=query['order_clause'] or f"{date_field} DESC, :id"
+            )
+            complete = len(results) < max_records
+        else:
+            results = socrata_client.get(
+                dataset_id,
+                select=select_clause,
+                where=where_clause,
+                group=group_clause,
+                limit=max_records
+            )
+            complete = len(results) < max_records
         logger.info(f"Successfully fetched {len(results):,} raw records from {domain} for {city_name}.")
+        if group_clause and len(results) > 0:
+            incident_total = int(np.nansum(pd.to_numeric(extract_field_values(results, AGGREGATE_COUNT_FIELD), errors='coerce')))
+            logger.info(f"Aggregated fetch: {len(results):,} groups represent {incident_total:,} incidents.")
+        if cache_key and len(results) > 0:
+            store_crime_pull(cache_key, results, dataset_id, where_clause, max_cache_mb)
+        fetch_status['complete'] = complete
         return results
 
     except requests.exceptions.Timeout:
@@ -270,79 +963,328 @@ def fetch_crime_data(city_config: dict, days_back: int, max_records: int) -> lis
         logger.error(f"Unexpected error fetching Socrata data for {city_name} ({dataset_id}): {e}", exc_info=True)
         return []
     finally:
-        # Close the Socrata client connection if possible (depends on library version)
-        if hasattr(socrata_client, 'close'):
-            try:
-                socrata_client.close()
-            except Exception as close_err:
-                logger.warning(f"Error closing Socrata client: {close_err}")
+        close_socrata_client(socrata_client)
 
-def process_crime_data(raw_crime_data: list, city_config: dict) -> pd.DataFrame | None:
+def iter_crime_data_pages(city_config: dict, days_back: int, max_records: int, pushdown: bool = False,
+                          aggregate: bool = False):
     """
-    Processes raw crime data list into a cleaned pandas DataFrame.
-    Steps include:
-    1. Standardizing columns based on city_config.
-    2. Cleaning data types (numeric coords, string codes).
-    3. Parsing datetime and extracting hour.
-    4. Matching coordinates to census blocks via batch Supabase RPC.
-    5. Calculating population density proxy.
+    Generator counterpart of fetch_crime_data used by the streaming pipeline.
+    Yields lists of raw records one date window at a time, newest window first,
+    and stops once max_records rows have been yielded.
     """
     city_name = city_config.get('city_name', 'Unknown City')
-    dataset_id = city_config.get('crime_data', {}).get('dataset_id')
-    logger.info(f"Processing {len(raw_crime_data):,} raw records for {city_name} (Dataset: {dataset_id})...")
+    adapter = get_source_adapter(city_config)
+    if adapter is None:
+        return
+    if adapter.source_type != 'socrata':
+        # Non-Socrata sources are downloaded in one go; stream them as a single page
+        records = adapter.fetch_records(city_config, days_back, max_records)
+        if records:
+            yield records
+        return
 
-    if not raw_crime_data:
-        logger.warning(f"No raw crime data provided for {city_name}. Returning empty DataFrame.")
-        return pd.DataFrame()
+    query = prepare_socrata_query(city_config, days_back, pushdown=pushdown, aggregate=aggregate)
+    if not query:
+        return
 
+    socrata_client = query['client']
+    logger.info(f"Streaming {city_name} ({query['dataset_id']}) records since {query['start_date_str']}")
+    logger.info(f"  SELECT: {query['select_clause']}")
+    logger.info(f"  WHERE: {query['where_clause']}")
+    logger.info(f"  LIMIT: {max_records:,}")
+
+    window_iter = iter_socrata_windows(
+        socrata_client, query['dataset_id'], query['select_clause'], query['filter_clause'],
+        query['date_field'], query['start_date'], datetime.now(timezone.utc), newest_first=True,
+        group_clause=query['group_clause'], order_clause=query['order_clause']
+    )
+    yielded = 0
+    failed_windows = 0
     try:
-        # 1. Convert to DataFrame
-        df = pd.DataFrame(raw_crime_data)
-        logger.info(f"Converted raw data to DataFrame with {len(df)} rows. Initial columns: {df.columns.tolist()}")
-
-        # 2. Standardize Columns
-        # Define standard internal names and map them to source names via city_config
-        # (Using the same mapping structure as fetch_crime_data)
-        dataset_field_mappings = {
-            "2nrs-mtv8": { # LAPD
-                'date_str': 'date_occ',
-                'time_str': 'time_occ',
-                'crime_code': 'crm_cd',
-                'latitude': 'lat',
-                'longitude': 'lon'
-            },
-            "uip8-fykc": { # NYPD Arrest Data
-                'date_str': 'arrest_date',
-                'time_str': None,
-                'crime_code': 'ky_cd',
-                'latitude': 'latitude',
-                'longitude': 'longitude'
-            }
-            # Add other dataset mappings here
-        }
+        for window, window_records in window_iter:
+            if window_records is None:
+                logger.error(f"Giving up on window {window[0].date()}..{window[1].date()} for {city_name} after {SOCRATA_MAX_RETRIES} attempts.")
+                failed_windows += 1
+                continue
+            remaining = max_records - yielded
+            if len(window_records) >= remaining:
+                # Records inside a window are in ascending date order, so keep the tail
+                yielded += remaining
+                yield window_records[len(window_records) - remaining:]
+                logger.info(f"Reached max_records={max_records:,}; older windows are not fetched.")
+                break
+            yielded += len(window_records)
+            yield window_records
+    finally:
+        window_iter.close()
+        close_socrata_client(socrata_client)
 
-        if dataset_id not in dataset_field_mappings:
-             logger.error(f"Dataset ID '{dataset_id}' not recognized for column standardization in {city_name}.")
-             return None
+    if failed_windows > 0:
+        logger.warning(f"{failed_windows} date windows failed for {city_name}. Crime data is incomplete for those periods.")
+    logger.info(f"Streamed {yielded:,} raw records for {city_name}.")
 
-        mapping = dataset_field_mappings[dataset_id]
-        rename_map = {v: k for k, v in mapping.items() if v is not None and v in df.columns}
-        required_source_cols = [v for v in mapping.values() if v is not None]
+# --- Local Socrata Pull Cache ---
 
-        # Check for missing source columns that are needed
-        missing_source_cols = [col for col in required_source_cols if col not in df.columns]
-        if missing_source_cols:
-            logger.error(f"Missing required source columns in raw data for {city_name} ({dataset_id}): {missing_source_cols}")
+def get_crime_cache_dir() -> str:
+    """Directory holding cached raw Socrata pulls (Parquet data + JSON metadata)."""
+    return os.path.join(LOCAL_DATA_DIR, 'socrata_cache')
+
+def crime_cache_key(dataset_id: str, select_clause: str, where_clause: str, max_records: int,
+                    group_clause: str | None = None, fetch_mode: str = 'single', pushdown: bool = False,
+                    aggregate: bool = False) -> str:
+    """
+    Stable cache key for a Socrata pull; the date range is part of where_clause.
+    fetch_mode is part of the key because modes differ in which rows they keep
+    ('windowed' trims oldest, 'single'/'csv' take the newest) and in the result type.
+    """
+    key_source = json.dumps({
+        'dataset_id': dataset_id,
+        'select': select_clause,
+        'where': where_clause,
+        'group': group_clause,
+        'limit': max_records,
+        'fetch_mode': fetch_mode,
+        'pushdown': pushdown,
+        'aggregate': aggregate
+    }, sort_keys=True)
+    return hashlib.sha256(key_source.encode('utf-8')).hexdigest()[:32]
+
+def load_cached_crime_pull(cache_key: str, ttl_hours: float, as_frame: bool = False) -> list | pd.DataFrame | None:
+    """
+    Returns the cached records for cache_key if present and younger than ttl_hours, else None.
+    With as_frame the records come back as a DataFrame (as 'csv' fetches return), otherwise as a list of dicts.
+    """
+    data_path = os.path.join(get_crime_cache_dir(), f"{cache_key}.parquet")
+    meta_path = os.path.join(get_crime_cache_dir(), f"{cache_key}.json")
+    if not os.path.exists(data_path) or not os.path.exists(meta_path):
+        return None
+    try:
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        created_at = datetime.fromisoformat(meta['created_at'])
+        age_hours = (datetime.now(timezone.utc) - created_at).total_seconds() / 3600.0
+        if age_hours > ttl_hours:
+            logger.info(f"Cached Socrata pull {cache_key} is {age_hours:.1f}h old (TTL {ttl_hours}h); refetching.")
             return None
 
-        # Select only needed columns and rename
-        df = df[list(rename_map.keys())].rename(columns=rename_map)
-        logger.info(f"Renamed columns to standard set: {df.columns.tolist()}")
+        start = time.perf_counter()
+        records = pd.read_parquet(data_path)
+        if not as_frame:
+            records = records.to_dict('records')
+        meta['last_used_at'] = datetime.now(timezone.utc).isoformat()
+        with open(meta_path, 'w') as f:
+            json.dump(meta, f, indent=2)
+        logger.info(f"Loaded {len(records):,} records from Socrata pull cache {cache_key} ({age_hours:.1f}h old) in {(time.perf_counter() - start) * 1000:.0f} ms.")
+        return records
+    except Exception as e:
+        logger.warning(f"Could not read Socrata pull cache entry {cache_key}, refetching: {e}")
+        return None
+
+def store_crime_pull(cache_key: str, records: list | pd.DataFrame, dataset_id: str, where_clause: str, max_cache_mb: float):
+    """Writes records to the pull cache and evicts least recently used entries above max_cache_mb."""
+    cache_dir = get_crime_cache_dir()
+    os.makedirs(cache_dir, exist_ok=True)
+    data_path = os.path.join(cache_dir, f"{cache_key}.parquet")
+    meta_path = os.path.join(cache_dir, f"{cache_key}.json")
+    try:
+        pd.DataFrame(records).to_parquet(f"{data_path}.tmp", index=False)
+        os.replace(f"{data_path}.tmp", data_path)
+        now_iso = datetime.now(timezone.utc).isoformat()
+        with open(meta_path, 'w') as f:
+            json.dump({
+                'dataset_id': dataset_id,
+                'where': where_clause,
+                'rows': len(records),
+                'created_at': now_iso,
+                'last_used_at': now_iso
+            }, f, indent=2)
+        logger.info(f"Cached {len(records):,} raw records as {cache_key} ({os.path.getsize(data_path) / 1e6:.1f} MB).")
+    except Exception as e:
+        logger.warning(f"Failed to write Socrata pull cache entry {cache_key}: {e}")
+        return
+    evict_crime_cache(max_cache_mb)
+
+def evict_crime_cache(max_cache_mb: float):
+    """Deletes least recently used cache entries until the cache fits in max_cache_mb."""
+    cache_dir = get_crime_cache_dir()
+    entries = []
+    for file_name in os.listdir(cache_dir):
+        if not file_name.endswith('.json'):
+            continue
+        cache_key = file_name[:-len('.json')]
+        data_path = os.path.join(cache_dir, f"{cache_key}.parquet")
+        try:
+            with open(os.path.join(cache_dir, file_name), 'r') as f:
+                last_used_at = json.load(f).get('last_used_at', '')
+            size = os.path.getsize(data_path) if os.path.exists(data_path) else 0
+        except Exception:
+            last_used_at, size = '', 0
+        entries.append((last_used_at, cache_key, size))
+
+    total_bytes = sum(size for _, _, size in entries)
+    max_bytes = max_cache_mb * 1024 * 1024
+    for _, cache_key, size in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        for suffix in ('.parquet', '.json'):
+            path = os.path.join(cache_dir, f"{cache_key}{suffix}")
+            if os.path.exists(path):
+                os.remove(path)
+        total_bytes -= size
+        logger.info(f"Evicted Socrata pull cache entry {cache_key} ({size / 1e6:.1f} MB).")
+
+# --- Incremental Incident Store ---
+
+def get_incident_store_paths(city_id, dataset_id: str) -> tuple:
+    """Returns (parquet_path, state_path) of the local incident store for a city and dataset."""
+    store_dir = os.path.join(LOCAL_DATA_DIR, 'incidents')
+    base_name = f"{city_id}_{dataset_id}"
+    return os.path.join(store_dir, f"{base_name}.parquet"), os.path.join(store_dir, f"{base_name}.state.json")
+
+def load_incident_store(city_id, dataset_id: str) -> tuple:
+    """
+    Loads the local incident store and its high-water mark.
+    Returns (DataFrame, high_water_mark) or (None, None) if there is no usable store.
+    """
+    store_path, state_path = get_incident_store_paths(city_id, dataset_id)
+    if not os.path.exists(store_path) or not os.path.exists(state_path):
+        return None, None
+    try:
+        with open(state_path, 'r') as f:
+            state = json.load(f)
+        high_water_mark = datetime.fromisoformat(state['high_water_mark'])
+        store_df = pd.read_parquet(store_path)
+        logger.info(f"Loaded incident store with {len(store_df):,} records (high-water mark: {high_water_mark.isoformat()}).")
+        return store_df, high_water_mark
+    except Exception as e:
+        logger.warning(f"Could not load incident store {store_path}, falling back to a full fetch: {e}")
+        return None, None
+
+def save_incident_store(city_id, dataset_id: str, store_df: pd.DataFrame, high_water_mark: datetime):
+    """Writes the incident store and its high-water mark state file."""
+    store_path, state_path = get_incident_store_paths(city_id, dataset_id)
+    os.makedirs(os.path.dirname(store_path), exist_ok=True)
+    # Write to temp files first so an interrupted run never leaves a half-written store
+    store_df.to_parquet(f"{store_path}.tmp", index=False)
+    os.replace(f"{store_path}.tmp", store_path)
+    with open(f"{state_path}.tmp", 'w') as f:
+        json.dump({
+            'high_water_mark': high_water_mark.isoformat(),
+            'record_count': len(store_df),
+            'updated_at': datetime.now(timezone.utc).isoformat()
+        }, f, indent=2)
+    os.replace(f"{state_path}.tmp", state_path)
+    logger.info(f"Saved incident store with {len(store_df):,} records (high-water mark: {high_water_mark.isoformat()}).")
+
+def dedupe_incident_records(records_df: pd.DataFrame, id_field: str | None) -> pd.DataFrame:
+    """
+    Drops repeated incidents, keeping the last copy: by id_field where a record carries one,
+    otherwise by identical content.
+    """
+    duplicated = records_df.duplicated(keep='last')
+    if id_field and id_field in records_df.columns:
+        has_id = records_df[id_field].notna()
+        duplicated = np.where(has_id, records_df.duplicated(subset=[id_field], keep='last'), duplicated)
+    return records_df[~np.asarray(duplicated, dtype=bool)]
+
+def fetch_crime_data_incremental(city_config: dict, days_back: int, max_records: int, fetch_mode: str = 'single',
+                                 cache_ttl_hours: float | None = None, max_cache_mb: float = CRIME_CACHE_DEFAULT_MAX_MB,
+                                 pushdown: bool = False) -> list:
+    """
+    Incremental counterpart of fetch_crime_data.
+    Keeps a local incident store per city and dataset with the last ingested date
+    (high-water mark). Only records from INCREMENTAL_OVERLAP_DAYS before the mark
+    onwards are fetched. When the fetch completed they replace the overlapping part
+    of the store, so late-reported incidents are picked up and withdrawn ones dropped.
+    Otherwise (failed requests or windows, max_records reached) they are merged into
+    the store, deduplicated by the adapter's id field, and the high-water mark stays
+    put so the next run fetches the overlap again. Records older than days_back are
+    aged out. Returns the full windowed record list.
+    """
+    city_name = city_config.get('city_name', 'Unknown City')
+    city_id = city_config.get('city_id')
+    adapter = get_source_adapter(city_config)
+    if adapter is None:
+        return []
+    dataset_id = adapter.source_key
+    date_field = adapter.fields['date_field']
+    id_field = adapter.fields.get('id_field')
+
+    # Socrata timestamps are floating (no zone), so compare as naive UTC
+    window_start = (datetime.now(timezone.utc) - timedelta(days=days_back)).replace(tzinfo=None)
+    store_df, high_water_mark = load_incident_store(city_id, dataset_id)
+
+    if store_df is not None:
+        fetch_since = max(window_start, high_water_mark - timedelta(days=INCREMENTAL_OVERLAP_DAYS))
+        logger.info(f"Incremental fetch for {city_name}: re-fetching from {fetch_since.isoformat()} ({INCREMENTAL_OVERLAP_DAYS} days overlap).")
+    else:
+        fetch_since = window_start
+        logger.info(f"No incident store for {city_name} ({dataset_id}); performing a full backfill.")
+
+    fetch_status = {}
+    new_records = fetch_crime_data(
+        city_config, days_back=days_back, max_records=max_records,
+        fetch_mode=fetch_mode, since=fetch_since.replace(tzinfo=timezone.utc),
+        cache_ttl_hours=cache_ttl_hours, max_cache_mb=max_cache_mb, pushdown=pushdown,
+        fetch_status=fetch_status
+    )
+    new_df = pd.DataFrame(new_records)
+    del new_records
+    fetch_complete = fetch_status.get('complete', False)
+
+    if store_df is None and new_df.empty:
+        return []
+
+    if store_df is not None:
+        store_dates = pd.to_datetime(store_df[date_field], errors='coerce')
+        if fetch_complete:
+            keep_mask = (store_dates >= window_start) & (store_dates < fetch_since)
+        else:
+            # A partial fetch may be missing overlap records: keep them, newly fetched copies win
+            logger.warning(f"Incremental fetch for {city_name} is incomplete; merging {len(new_df):,} records into the stored ones.")
+            keep_mask = store_dates >= window_start
+        aged_out = int((store_dates < window_start).sum())
+        if aged_out > 0:
+            logger.info(f"Aged out {aged_out:,} stored records older than {days_back} days.")
+        merged_df = pd.concat([store_df[keep_mask], new_df], ignore_index=True)
+        if not fetch_complete:
+            merged_df = dedupe_incident_records(merged_df, id_field)
+    else:
+        merged_df = new_df
+
+    merged_dates = pd.to_datetime(merged_df[date_field], errors='coerce')
+    merged_df = merged_df.iloc[np.argsort(merged_dates.to_numpy(), kind='stable')].reset_index(drop=True)
+    if len(merged_df) > max_records:
+        logger.info(f"Trimming {len(merged_df) - max_records:,} oldest stored records to respect max_records={max_records:,}.")
+        merged_df = merged_df.iloc[-max_records:].reset_index(drop=True)
+
+    new_high_water_mark = merged_dates.max() if fetch_complete else None
+    if new_high_water_mark is None or pd.isna(new_high_water_mark):
+        new_high_water_mark = high_water_mark or window_start
+    save_incident_store(city_id, dataset_id, merged_df, pd.Timestamp(new_high_water_mark).to_pydatetime())
+
+    logger.info(f"Incremental ingestion for {city_name}: {len(new_df):,} fetched, {len(merged_df):,} records in window.")
+    return merged_df.to_dict('records')
+
+def standardize_crime_chunk(raw_records, adapter: CrimeSourceAdapter, city_name: str) -> pd.DataFrame | None:
+    """
+    Standardizes, cleans and time-parses one chunk of raw crime records
+    (the per-record part of process_crime_data):
+    2. Converting raw records to typed columns via the source adapter.
+    3. Cleaning coordinates.
+    4. Dropping unparseable timestamps and extracting hour, month and day.
+    Returns a DataFrame with latitude, longitude, crime_code, hour, month and day, an empty
+    DataFrame if no valid rows remain, or None if the chunk cannot be standardized.
+    """
+    try:
+        # 2. Typed Columns from the Source Adapter (no DataFrame of raw strings)
+        columns = adapter.to_columns(raw_records, city_name)
+        if columns is None:
+            return None
+        df = pd.DataFrame(columns)
 
-        # 3. Clean Data Types and Coordinates
+        # 3. Clean Coordinates
         initial_rows = len(df)
-        df['latitude'] = pd.to_numeric(df['latitude'], errors='coerce')
-        df['longitude'] = pd.to_numeric(df['longitude'], errors='coerce')
         # Drop rows with invalid or zero coordinates
         df.dropna(subset=['latitude', 'longitude'], inplace=True)
         df = df[(df['latitude'] != 0) & (df['longitude'] != 0)]
@@ -354,66 +1296,9 @@ def process_crime_data(raw_crime_data: list, city_config: dict) -> pd.DataFrame
             logger.warning(f"No valid records remaining after coordinate cleaning for {city_name}.")
             return pd.DataFrame()
 
-        # Ensure crime code is string
-        if 'crime_code' in df.columns:
-             df['crime_code'] = df['crime_code'].astype(str)
-        else:
-             logger.error(f"Standardized column 'crime_code' not found after renaming. Check mapping for dataset {dataset_id}.")
-             return None
-
-        # 4. Parse Datetime and Extract Hour
-        logger.info("Parsing datetime information...")
-
-        def parse_datetime_internal(row):
-            try:
-                date_str_val = row.get('date_str')
-                if pd.isna(date_str_val):
-                    return pd.NaT
-                date_str_full = str(date_str_val)
-
-                # Handle specific dataset formats
-                if dataset_id == "uip8-fykc": # NYPD Arrest Data (contains timestamp)
-                    dt_obj = pd.to_datetime(date_str_full, errors='coerce')
-                    if dt_obj is pd.NaT:
-                        return pd.NaT
-                    # Ensure timezone is UTC
-                    if dt_obj.tzinfo is None:
-                        return dt_obj.tz_localize('UTC')
-                    else:
-                        return dt_obj.tz_convert('UTC')
-
-                elif dataset_id == "2nrs-mtv8": # LAPD (separate date and HHMM time)
-                    date_part = date_str_full.split('T')[0]
-                    time_str_val = row.get('time_str')
-                    parsed_time = "12:00:00" # Default
-                    if time_str_val is not None and pd.notna(time_str_val):
-                        time_str = str(time_str_val).zfill(4)
-                        if len(time_str) == 4 and time_str.isdigit():
-                            hour = int(time_str[:2])
-                            minute = int(time_str[2:])
-                            if hour >= 24: hour, minute = 23, 59 # Handle '2400'
-                            parsed_time = f"{hour:02d}:{minute:02d}:00"
-                        # else: logger.debug(f"Invalid time format '{time_str_val}', using default.") # Optional debug
-                    # else: logger.debug("Missing time_str, using default.") # Optional debug
-
-                    dt_str = f"{date_part} {parsed_time}"
-                    dt_obj = pd.to_datetime(dt_str, errors='coerce')
-                    return dt_obj.tz_localize('UTC') if dt_obj is not pd.NaT else pd.NaT
-
-                else: # Generic fallback (attempt basic parsing)
-                     dt_obj = pd.to_datetime(date_str_full, errors='coerce')
-                     if dt_obj is pd.NaT:
-                         return pd.NaT
-                     if dt_obj.tzinfo is None: return dt_obj.tz_localize('UTC')
-                     else: return dt_obj.tz_convert('UTC')
-
-            except Exception as e:
-                # logger.warning(f"Datetime parsing error for row: {row.to_dict()}, Error: {e}") # Detailed log if needed
-                return pd.NaT
-
-        df['datetime_occ'] = df.apply(parse_datetime_internal, axis=1)
+        # 4. Drop Unparseable Datetimes and Extract Hour
         rows_before_dt_drop = len(df)
-        df.dropna(subset=['datetime_occ'], inplace=True)
+        df = df[df['timestamp'].notna()]
         rows_after_dt_drop = len(df)
         if rows_before_dt_drop > rows_after_dt_drop:
              logger.info(f"Dropped {rows_before_dt_drop - rows_after_dt_drop} rows due to datetime parsing errors.")
@@ -422,81 +1307,391 @@ def process_crime_data(raw_crime_data: list, city_config: dict) -> pd.DataFrame
             logger.warning(f"No valid records remaining after datetime parsing for {city_name}.")
             return pd.DataFrame()
 
-        df['hour'] = df['datetime_occ'].dt.hour
-        logger.info("Successfully parsed datetime and extracted hour.")
+        df['hour'] = df['timestamp'].dt.hour
+        if 'aggregate_hour' in df.columns:
+            # Aggregated dates are truncated to the month, so the hour comes from the server
+            # (LAPD '2400' yields hour 24, which the HHMM parser also maps to 23)
+            df['hour'] = df['aggregate_hour'].fillna(df['hour']).clip(upper=23).astype(int)
+        # Calendar month as months since 1970-01 (see format_cube_month), for the temporal cube
+        df['month'] = (df['timestamp'].dt.year - 1970) * 12 + df['timestamp'].dt.month - 1
+        # Calendar day as days since 1970-01-01, for the incremental metric counters
+        df['day'] = df['timestamp'].to_numpy(dtype='datetime64[ns]').astype('datetime64[D]').astype(np.int64)
+        logger.info("Successfully parsed datetime and extracted hour, month and day.")
 
         # Select columns needed for next steps
-        df_for_mapping = df[['latitude', 'longitude', 'crime_code', 'hour']].copy()
-        del df # Free memory
+        output_cols = ['latitude', 'longitude', 'crime_code', 'hour', 'month', 'day']
+        if 'weight' in df.columns:
+            df['weight'] = df['weight'].fillna(1).astype(np.int64)
+            output_cols.append('weight')
+        return df[output_cols].copy()
+
+    except Exception as e:
+        logger.error(f"An unexpected error occurred while standardizing crime records for {city_name}: {e}", exc_info=True)
+        return None
+
+# --- Census Block Mapping Engines ---
+
+def run_block_mapping_rpc(rpc_name: str, points: list, batch_num: int) -> list | None:
+    """
+    Runs one block mapping RPC call and returns its rows, or None if the call failed.
+    A missing function (PGRST202) is added to MISSING_RPCS.
+    """
+    try:
+        rpc_response = supabase.rpc(rpc_name, {'points_json': points}).execute()
+        if isinstance(rpc_response.data, list):
+            return rpc_response.data
+        if hasattr(rpc_response, 'error') and rpc_response.error:
+            logger.error(f"Supabase RPC error ({rpc_name}) for batch {batch_num}: {rpc_response.error}")
+        else:
+            logger.warning(f"RPC mapping call for batch {batch_num} returned an unexpected format: {rpc_response.data}")
+    except APIError as api_err:
+        if api_err.code == MISSING_RPC_ERROR_CODE:
+            MISSING_RPCS.add(rpc_name)
+        logger.error(f"APIError during RPC mapping call ({rpc_name}) for batch {batch_num}: {api_err}", exc_info=False)
+    except Exception as rpc_err:
+        logger.error(f"Unexpected error processing RPC mapping for batch {batch_num}: {rpc_err}", exc_info=True)
+    return None
+
+def call_block_mapping_batch(batch: tuple) -> tuple:
+    """
+    Runs one 'match_points_to_block_groups_indexed' RPC call for (batch_num, points).
+    Databases without that function (migration 20261016120000) get the original
+    'match_points_to_block_groups' RPC instead, whose rows are aligned by position and
+    tagged with the input indices; a batch returning a different number of rows is failed.
+    Returns (batch_num, points, rows), with rows None if the call failed.
+    """
+    batch_num, coord_chunk = batch
+    if 'match_points_to_block_groups_indexed' not in MISSING_RPCS:
+        rows = run_block_mapping_rpc('match_points_to_block_groups_indexed', coord_chunk, batch_num)
+        if rows is not None or 'match_points_to_block_groups_indexed' not in MISSING_RPCS:
+            return batch_num, coord_chunk, rows
+        logger.warning("RPC 'match_points_to_block_groups_indexed' not found; falling back to 'match_points_to_block_groups'.")
+
+    rows = run_block_mapping_rpc('match_points_to_block_groups', [{'lat': p['lat'], 'lon': p['lon']} for p in coord_chunk], batch_num)
+    if rows is None:
+        return batch_num, coord_chunk, None
+    if len(rows) != len(coord_chunk):
+        logger.error(f"RPC mapping batch {batch_num} returned {len(rows)} rows for {len(coord_chunk)} points; cannot align them. Discarding the batch.")
+        return batch_num, coord_chunk, None
+    return batch_num, coord_chunk, [{**row, 'idx': point['idx']} for point, row in zip(coord_chunk, rows) if row]
+
+def match_blocks_rpc(df_for_mapping: pd.DataFrame) -> pd.DataFrame | None:
+    """
+    Matches incident coordinates to census blocks via 'match_points_to_block_groups_indexed'
+    RPC batches, GEO_MAPPING_MAX_WORKERS at a time. Every point is tagged with its input
+    index and results are joined back by that index, never by position; a batch returning
+    rows for indices it was not sent, or several rows for one index, is discarded as failed.
+    Returns one row per incident (id, block_group_id, total_population, housing_units; empty
+    where unmatched or failed), or None if the Supabase client is unavailable.
+    """
+    if not supabase:
+         logger.error("Supabase client is not available for RPC call.")
+         return None
+
+    logger.info(f"Starting geospatial mapping for {len(df_for_mapping)} records using RPC 'match_points_to_block_groups_indexed'...")
+    # Format for RPC: list of {'idx': ..., 'lat': ..., 'lon': ...}
+    coordinates_rpc = [
+        {'idx': idx, 'lat': lat, 'lon': lon}
+        for idx, (lat, lon) in enumerate(zip(df_for_mapping['latitude'].tolist(), df_for_mapping['longitude'].tolist()))
+    ]
+    total_coords = len(coordinates_rpc)
+    batches = [
+        ((i // GEO_MAPPING_BATCH_SIZE) + 1, coordinates_rpc[i:i + GEO_MAPPING_BATCH_SIZE])
+        for i in range(0, total_coords, GEO_MAPPING_BATCH_SIZE)
+    ]
+    logger.info(f"Processing {total_coords:,} coordinates in {len(batches)} batches (size {GEO_MAPPING_BATCH_SIZE}, {GEO_MAPPING_MAX_WORKERS} concurrent).")
+
+    block_rows = [None] * total_coords # Joined by input index
+    processed_batches = 0
+    failed_batches = 0
+    for batch_num, coord_chunk, rows in tqdm(ordered_parallel_map(call_block_mapping_batch, batches, GEO_MAPPING_MAX_WORKERS),
+                                             total=len(batches), desc="Mapping coordinates", unit="batch"):
+        if rows is None:
+            failed_batches += 1
+            continue
+        first_idx = coord_chunk[0]['idx']
+        last_idx = coord_chunk[-1]['idx']
+        foreign_rows = [row for row in rows if not isinstance(row.get('idx'), int) or not first_idx <= row['idx'] <= last_idx]
+        if foreign_rows:
+            logger.error(f"RPC mapping batch {batch_num} returned {len(foreign_rows)} rows without a valid input index (e.g. {foreign_rows[0]}). Discarding the batch.")
+            failed_batches += 1
+            continue
+        row_indices = [row['idx'] for row in rows]
+        if len(set(row_indices)) != len(row_indices):
+            logger.error(f"RPC mapping batch {batch_num} returned several rows for the same input index. Discarding the batch.")
+            failed_batches += 1
+            continue
+        for row in rows:
+            block_rows[row['idx']] = row
+        processed_batches += 1
 
-        # 5. Match Coordinates to Census Blocks (Batch RPC)
-        logger.info(f"Starting geospatial mapping for {len(df_for_mapping)} records using RPC 'match_points_to_block_groups'...")
-        coordinates = df_for_mapping[['latitude', 'longitude']].to_dict('records')
-        # Format for RPC: list of {'lat': ..., 'lon': ...}
-        coordinates_rpc = [{'lat': c['latitude'], 'lon': c['longitude']} for c in coordinates]
+    logger.info(f"Finished RPC mapping calls. Processed Batches: {processed_batches}, Failed Batches: {failed_batches}.")
+    if failed_batches > 0:
+        logger.warning(f"{failed_batches} mapping batches failed; their incidents are left unmapped.")
 
-        all_block_data = [] # To store results from all batches
-        total_coords = len(coordinates_rpc)
-        total_batches = math.ceil(total_coords / GEO_MAPPING_BATCH_SIZE)
-        processed_batches = 0
-        failed_batches = 0
+    # Unmatched/failed points become empty rows (dropped after the merge)
+    return pd.DataFrame([row if row is not None else {} for row in block_rows]) \
+        .reindex(columns=['id', 'block_group_id', 'total_population', 'housing_units'])
 
-        logger.info(f"Processing {total_coords:,} coordinates in {total_batches} batches (size {GEO_MAPPING_BATCH_SIZE}).")
+def parse_block_geometry(geom_value):
+    """Parses a census_blocks.geom value (GeoJSON dict, hex (E)WKB or (E)WKT string) into a Shapely geometry."""
+    try:
+        if geom_value is None:
+            return None
+        if isinstance(geom_value, dict):
+            return shapely.geometry.shape(geom_value)
+        geom_text = str(geom_value)
+        if geom_text.startswith('SRID='):
+            geom_text = geom_text.split(';', 1)[1]
+        if all(ch in '0123456789abcdefABCDEF' for ch in geom_text[:16]):
+            return shapely.from_wkb(geom_text)
+        return shapely.from_wkt(geom_text)
+    except Exception as e:
+        logger.warning(f"Could not parse census block geometry: {e}")
+        return None
 
-        if not supabase:
-             logger.error("Supabase client is not available for RPC call.")
-             return None
+def load_census_block_index(city_id: int, city_name: str) -> dict | None:
+    """
+    Loads the city's census_blocks geometries and attributes once per run and builds a
+    Shapely STRtree over them. Returns {'tree': STRtree, 'blocks': DataFrame} (rows aligned
+    with the tree's geometries), or None if no usable geometries were found.
+    """
+    if city_id in CENSUS_BLOCK_INDEXES:
+        return CENSUS_BLOCK_INDEXES[city_id]
+    if not supabase:
+        logger.error("Supabase client is not available to load census block geometries.")
+        return None
 
-        for i in range(0, total_coords, GEO_MAPPING_BATCH_SIZE):
-            coord_chunk = coordinates_rpc[i:i + GEO_MAPPING_BATCH_SIZE]
-            batch_num = (i // GEO_MAPPING_BATCH_SIZE) + 1
-            logger.info(f"Mapping coordinates: Batch {batch_num}/{total_batches} ({len(coord_chunk)} coords)")
+    start = time.perf_counter()
+    rows = []
+    offset = 0
+    while True:
+        response = supabase.table('census_blocks') \
+            .select('id, block_group_id, total_population, housing_units, geom') \
+            .eq('city_id', city_id) \
+            .order('id') \
+            .range(offset, offset + CENSUS_BLOCK_PAGE_SIZE - 1) \
+            .execute()
+        page = response.data or []
+        rows.extend(page)
+        if len(page) < CENSUS_BLOCK_PAGE_SIZE:
+            break
+        offset += CENSUS_BLOCK_PAGE_SIZE
+
+    geometries = [parse_block_geometry(row.get('geom')) for row in rows]
+    valid = [i for i, geom in enumerate(geometries) if geom is not None and not geom.is_empty]
+    if not valid:
+        logger.error(f"No usable census block geometries found for {city_name} (city_id {city_id}).")
+        return None
+    if len(valid) < len(rows):
+        logger.warning(f"Skipping {len(rows) - len(valid)} census blocks without a usable geometry for {city_name}.")
 
-            try:
-                rpc_response = supabase.rpc('match_points_to_block_groups', {'points_json': coord_chunk}).execute()
-
-                if rpc_response.data and isinstance(rpc_response.data, list):
-                    # Basic check for response length mismatch
-                    if len(rpc_response.data) != len(coord_chunk):
-                        logger.warning(f"RPC mapping response length mismatch for batch {batch_num}! Expected {len(coord_chunk)}, Got {len(rpc_response.data)}. Results may be misaligned.")
-                        # Pad with Nones to maintain length if response is shorter? Or handle alignment later.
-                        # For now, extend with what we got, but this is risky.
-                    all_block_data.extend(rpc_response.data)
-                    processed_batches += 1
-                    # logger.debug(f"Mapping batch {batch_num} successful.") # Optional debug
-                elif hasattr(rpc_response, 'error') and rpc_response.error:
-                    logger.error(f"Supabase RPC error (match_points_to_block_groups) for batch {batch_num}: {rpc_response.error}")
-                    all_block_data.extend([None] * len(coord_chunk)) # Add placeholders
-                    failed_batches += 1
-                else:
-                    logger.warning(f"RPC mapping call for batch {batch_num} returned no data or unexpected format: {rpc_response.data}")
-                    all_block_data.extend([None] * len(coord_chunk))
-                    failed_batches += 1
+    blocks = pd.DataFrame([rows[i] for i in valid], columns=['id', 'block_group_id', 'total_population', 'housing_units'])
+    tree = STRtree([geometries[i] for i in valid])
+    logger.info(f"Loaded {len(blocks):,} census block geometries for {city_name} into an STRtree in {time.perf_counter() - start:.1f}s.")
+    CENSUS_BLOCK_INDEXES[city_id] = {'tree': tree, 'blocks': blocks}
+    return CENSUS_BLOCK_INDEXES[city_id]
 
-            except APIError as api_err:
-                logger.error(f"APIError during RPC mapping call for batch {batch_num}: {api_err}", exc_info=False)
-                all_block_data.extend([None] * len(coord_chunk))
-                failed_batches += 1
-            except Exception as rpc_err:
-                logger.error(f"Unexpected error processing RPC mapping for batch {batch_num}: {rpc_err}", exc_info=True)
-                all_block_data.extend([None] * len(coord_chunk))
-                failed_batches += 1
-            
-            time.sleep(0.1) # Small delay between batches
+def match_blocks_local(df_for_mapping: pd.DataFrame, city_id: int, city_name: str) -> pd.DataFrame | None:
+    """
+    Local counterpart of match_blocks_rpc: vectorized point-in-polygon against the city's
+    census block STRtree (same containment rule as ST_Contains, first match wins).
+    Returns one row per incident in the same format as match_blocks_rpc.
+    """
+    block_index = load_census_block_index(city_id, city_name)
+    if block_index is None:
+        return None
 
-        logger.info(f"Finished RPC mapping calls. Processed Batches: {processed_batches}, Failed Batches: {failed_batches}.")
+    start = time.perf_counter()
+    points = shapely.points(df_for_mapping['longitude'].to_numpy(), df_for_mapping['latitude'].to_numpy())
+    point_idx, block_idx = block_index['tree'].query(points, predicate='within')
+    matched_block = np.full(len(points), -1, dtype=np.int64)
+    _, first_match = np.unique(point_idx, return_index=True)
+    matched_block[point_idx[first_match]] = block_idx[first_match]
+
+    block_df = block_index['blocks'].reindex(matched_block).reset_index(drop=True) # -1 (no match) becomes an empty row
+    logger.info(f"Locally mapped {len(first_match):,} of {len(points):,} coordinates to census blocks in {time.perf_counter() - start:.2f}s.")
+    return block_df
+
+# --- Coordinate to Census Block Memo ---
+# Persistent per-city map of (latitude, longitude) -> census block attributes. Files are
+# keyed by the census data version, so reloading census_blocks starts a fresh memo.
+BLOCK_MEMO_DTYPES = {
+    'latitude': 'float64',
+    'longitude': 'float64',
+    'id': object,
+    'block_group_id': object,
+    'total_population': 'float64',
+    'housing_units': 'float64'
+}
+BLOCK_MEMO_COLUMNS = list(BLOCK_MEMO_DTYPES)
+
+def get_census_version(city_id: int) -> str | None:
+    """
+    Fingerprint of the city's census_blocks data (row count and latest updated_at).
+    Cached per run; returns None if it cannot be determined.
+    """
+    if city_id in CENSUS_VERSIONS:
+        return CENSUS_VERSIONS[city_id]
+    if not supabase:
+        return None
+    try:
+        response = supabase.table('census_blocks') \
+            .select('updated_at', count='exact') \
+            .eq('city_id', city_id) \
+            .order('updated_at', desc=True) \
+            .limit(1) \
+            .execute()
+        latest_update = response.data[0].get('updated_at') if response.data else None
+        version_source = f"{city_id}:{response.count}:{latest_update}"
+        CENSUS_VERSIONS[city_id] = hashlib.sha256(version_source.encode('utf-8')).hexdigest()[:16]
+    except Exception as e:
+        logger.warning(f"Could not determine census data version for city_id {city_id}: {e}")
+        return None
+    return CENSUS_VERSIONS[city_id]
 
-        # Verify final length before proceeding
-        if len(all_block_data) != total_coords:
-            logger.error(f"CRITICAL ERROR: Final block data length ({len(all_block_data)}) does not match input coordinate length ({total_coords}) after RPC calls. Aborting processing.")
-            return None
+def get_block_memo_path(city_id: int, census_version: str) -> str:
+    """Returns the Parquet path of the coordinate memo for a city and census data version."""
+    return os.path.join(LOCAL_DATA_DIR, 'block_memo', f"city_{city_id}_{census_version}.parquet")
 
-        # --- Process and Merge RPC Results ---
-        logger.info("Processing and merging census block data from RPC results...")
-        # Convert None values from RPC result (no match) into empty dicts for DataFrame creation
-        processed_block_data = [item if item is not None else {} for item in all_block_data]
-        block_df = pd.DataFrame(processed_block_data) # Create DF from list of dicts (incl. empty ones)
+def load_block_memo(city_id: int, census_version: str) -> pd.DataFrame:
+    """Loads the coordinate memo, or an empty one if missing or unreadable."""
+    memo_path = get_block_memo_path(city_id, census_version)
+    if os.path.exists(memo_path):
+        try:
+            return pd.read_parquet(memo_path).astype(BLOCK_MEMO_DTYPES)
+        except Exception as e:
+            logger.warning(f"Could not read coordinate memo {memo_path}, starting a new one: {e}")
+    return pd.DataFrame(columns=BLOCK_MEMO_COLUMNS).astype(BLOCK_MEMO_DTYPES)
+
+def save_block_memo(city_id: int, census_version: str, memo_df: pd.DataFrame):
+    """Atomically writes the coordinate memo and removes memos of older census versions for the city."""
+    memo_path = get_block_memo_path(city_id, census_version)
+    memo_dir = os.path.dirname(memo_path)
+    os.makedirs(memo_dir, exist_ok=True)
+    try:
+        memo_df.to_parquet(f"{memo_path}.tmp", index=False)
+        os.replace(f"{memo_path}.tmp", memo_path)
+    except Exception as e:
+        logger.warning(f"Failed to write coordinate memo {memo_path}: {e}")
+        return
+    for file_name in os.listdir(memo_dir):
+        if file_name.startswith(f"city_{city_id}_") and file_name != os.path.basename(memo_path):
+            os.remove(os.path.join(memo_dir, file_name))
+            logger.info(f"Removed coordinate memo for an outdated census version: {file_name}")
+
+class CoordinateMemo:
+    """
+    In-memory coordinate memo for one city and census version. Loaded once per run
+    (chunked runs share it across chunks); new matches are written back by save()
+    unless the memo is read_only (--test runs).
+    """
+    def __init__(self, city_id: int, census_version: str, read_only: bool = False):
+        self.city_id = city_id
+        self.census_version = census_version
+        self.read_only = read_only
+        self.frame = load_block_memo(city_id, census_version)
+        self.pending = 0
+
+    def add(self, newly_matched: pd.DataFrame):
+        """Adds matched coordinates (BLOCK_MEMO_COLUMNS) to the in-memory memo."""
+        self.frame = newly_matched if self.frame.empty else pd.concat([self.frame, newly_matched], ignore_index=True)
+        self.pending += len(newly_matched)
+
+    def save(self):
+        """Writes the memo if coordinates were added since the last save."""
+        if self.pending == 0:
+            return
+        if self.read_only:
+            logger.info(f"Not writing {self.pending:,} new coordinates to the read-only memo.")
+            self.pending = 0
+            return
+        save_block_memo(self.city_id, self.census_version, self.frame)
+        logger.info(f"Added {self.pending:,} coordinates to the memo ({len(self.frame):,} total).")
+        self.pending = 0
 
+def open_coordinate_memo(city_id: int | None, city_name: str, block_memo: bool, cache_writes: bool = True) -> CoordinateMemo | None:
+    """
+    Opens the coordinate memo for the city's current census version (read-only unless
+    cache_writes), or None if disabled/unavailable.
+    """
+    if not block_memo:
+        return None
+    census_version = get_census_version(city_id) if city_id is not None else None
+    if census_version is None:
+        logger.warning(f"Coordinate memo disabled for {city_name}: census data version unavailable.")
+        return None
+    return CoordinateMemo(city_id, census_version, read_only=not cache_writes)
+
+def match_unique_coordinates(df_for_mapping: pd.DataFrame, city_name: str, mapping_engine: str,
+                             city_id: int | None, block_memo: bool, memo: CoordinateMemo | None = None,
+                             cache_writes: bool = True) -> pd.DataFrame | None:
+    """
+    Maps each distinct (latitude, longitude) pair once and scatters the results back to
+    every incident. With block_memo, coordinates resolved in earlier runs (same city and
+    census version) are served from the on-disk memo and only new ones hit the engine.
+    A caller-provided memo (shared across chunks) is updated in memory and left for the
+    caller to save; otherwise the memo is opened and saved here (unless cache_writes is off).
+    Returns one block row per incident, like the engines themselves.
+    """
+    coords = df_for_mapping[['latitude', 'longitude']].to_numpy(dtype=np.float64)
+    unique_coords, inverse = np.unique(coords, axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    unique_df = pd.DataFrame(unique_coords, columns=['latitude', 'longitude'])
+    logger.info(f"Collapsed {len(coords):,} incident coordinates to {len(unique_df):,} unique points for mapping.")
+
+    owns_memo = memo is None
+    if owns_memo:
+        memo = open_coordinate_memo(city_id, city_name, block_memo, cache_writes)
+    memo_df = memo.frame if memo else pd.DataFrame(columns=BLOCK_MEMO_COLUMNS).astype(BLOCK_MEMO_DTYPES)
+
+    resolved = unique_df.merge(memo_df, on=['latitude', 'longitude'], how='left')
+    unresolved_mask = resolved['id'].isna().to_numpy()
+    if memo:
+        logger.info(f"Coordinate memo hit for {int((~unresolved_mask).sum()):,} of {len(unique_df):,} unique points; resolving {int(unresolved_mask.sum()):,}.")
+
+    if unresolved_mask.any():
+        to_resolve = unique_df[unresolved_mask].reset_index(drop=True)
+        if mapping_engine == 'local':
+            new_blocks = match_blocks_local(to_resolve, city_id, city_name)
+        else:
+            new_blocks = match_blocks_rpc(to_resolve)
+        if new_blocks is None:
+            return None
+        new_blocks = new_blocks.reindex(columns=BLOCK_MEMO_COLUMNS[2:])
+        resolved.loc[unresolved_mask, BLOCK_MEMO_COLUMNS[2:]] = new_blocks.to_numpy(dtype=object)
+
+        if memo:
+            # Only memoize matches: unmatched rows may be failed RPC batches rather than true misses
+            newly_matched = pd.concat([to_resolve, new_blocks], axis=1).dropna(subset=['id']).astype(BLOCK_MEMO_DTYPES)
+            if not newly_matched.empty:
+                memo.add(newly_matched)
+                if owns_memo:
+                    memo.save()
+
+    return resolved.drop(columns=['latitude', 'longitude']).iloc[inverse].reset_index(drop=True)
+
+def map_incidents_to_blocks(df_for_mapping: pd.DataFrame, city_name: str, mapping_engine: str = 'rpc',
+                            city_id: int | None = None, block_memo: bool = True,
+                            memo: CoordinateMemo | None = None, cache_writes: bool = True) -> pd.DataFrame | None:
+    """
+    Attaches census block data to standardized incidents:
+    5. Matching unique coordinates to census blocks, via batch Supabase RPC ('rpc') or the
+       local STRtree point-in-polygon engine ('local', needs city_id), reusing the
+       coordinate memo when block_memo is set (or the shared memo, if given; only read
+       when cache_writes is off).
+    6. Calculating population density proxy.
+    7. Selecting the final columns.
+    """
+    try:
+        # 5. Match Coordinates to Census Blocks
+        block_df = match_unique_coordinates(df_for_mapping, city_name, mapping_engine, city_id, block_memo, memo=memo,
+                                            cache_writes=cache_writes)
+        if block_df is None:
+            return None
+
+        # --- Process and Merge Block Results ---
+        logger.info("Processing and merging census block data from mapping results...")
         # Rename columns coming from RPC if necessary (based on RPC function output)
         # RPC returns: id, block_group_id, total_population, housing_units
         block_df.rename(columns={
@@ -510,7 +1705,7 @@ def process_crime_data(raw_crime_data: list, city_config: dict) -> pd.DataFrame
         expected_block_cols = ['census_block_pk', 'block_group_identifier', 'population', 'housing_units']
         missing_block_cols = [col for col in expected_block_cols if col not in block_df.columns]
         if missing_block_cols:
-             logger.error(f"Missing expected columns from block mapping RPC result after rename: {missing_block_cols}")
+             logger.error(f"Missing expected columns from block mapping result after rename: {missing_block_cols}")
              # Decide how critical this is - maybe proceed without them?
              # For now, let's log and continue, they might be handled later.
 
@@ -535,29 +1730,211 @@ def process_crime_data(raw_crime_data: list, city_config: dict) -> pd.DataFrame
         processed_df['housing_units'] = pd.to_numeric(processed_df.get('housing_units'), errors='coerce').fillna(0).astype(int)
 
         # Calculate population density proxy
-        processed_df['population_density_proxy'] = processed_df.apply(
-            lambda row: row['population'] / row['housing_units'] if row['housing_units'] > 0 else 0.0,
-            axis=1
-        ).astype(float)
+        population = processed_df['population'].to_numpy(dtype=np.float64)
+        housing_units = processed_df['housing_units'].to_numpy(dtype=np.float64)
+        processed_df['population_density_proxy'] = np.divide(
+            population, housing_units, out=np.zeros(len(processed_df)), where=housing_units > 0
+        )
         logger.info("Calculated population density proxy.")
+        log_frame_memory(processed_df, "mapped")
+
+        # 7. Final Column Selection
+        final_cols = [
+            'crime_code', 'latitude', 'longitude', 'hour', 'month', 'day', 'weight', # Original data (weight only for aggregated pulls)
+            'census_block_pk', 'block_group_identifier', # Block info
+            'population', 'housing_units', 'population_density_proxy' # Calculated fields
+        ]
+        # Ensure all expected columns exist before selecting, then switch to the compact schema
+        final_df = compact_incident_frame(processed_df[[col for col in final_cols if col in processed_df.columns]])
+        log_frame_memory(final_df, "compacted")
+
+        logger.info(f"Processing complete for {city_name}. Final DataFrame shape: {final_df.shape}")
+        logger.debug(f"Final columns: {final_df.columns.tolist()}")
+        # logger.debug(f"Final DataFrame head:\n{final_df.head()}") # Optional debug
+        return final_df
+
+    except Exception as e:
+        logger.error(f"An unexpected error occurred while mapping incidents to census blocks for {city_name}: {e}", exc_info=True)
+        return None
+
+def process_crime_data(raw_crime_data: list | pd.DataFrame, city_config: dict, mapping_engine: str = 'rpc',
+                       block_memo: bool = True, cache_writes: bool = True) -> pd.DataFrame | None:
+    """
+    Processes raw crime data (list of dicts, or a DataFrame from CSV ingestion) into a cleaned pandas DataFrame.
+    Steps include:
+    1. Standardizing columns based on city_config.
+    2. Cleaning data types (numeric coords, string codes).
+    3. Parsing datetime and extracting hour.
+    4. Matching coordinates to census blocks (batch Supabase RPC or local STRtree, see mapping_engine;
+       the coordinate memo is only read when cache_writes is off).
+    5. Calculating population density proxy.
+    """
+    city_name = city_config.get('city_name', 'Unknown City')
+    dataset_id = city_config.get('crime_data', {}).get('dataset_id')
+    logger.info(f"Processing {len(raw_crime_data):,} raw records for {city_name} (Dataset: {dataset_id})...")
+
+    if len(raw_crime_data) == 0:
+        logger.warning(f"No raw crime data provided for {city_name}. Returning empty DataFrame.")
+        return pd.DataFrame()
+
+    # 1. Resolve the source adapter (converts raw records straight to typed columns)
+    adapter = get_source_adapter(city_config)
+    if adapter is None:
+        return None
+
+    df_for_mapping = standardize_crime_chunk(raw_crime_data, adapter, city_name)
+    if df_for_mapping is None or df_for_mapping.empty:
+        return df_for_mapping
+    log_frame_memory(df_for_mapping, "standardized")
+
+    return map_incidents_to_blocks(df_for_mapping, city_name, mapping_engine=mapping_engine, city_id=city_config.get('city_id'),
+                                   block_memo=block_memo, cache_writes=cache_writes)
+
+class IncidentColumnBuffer:
+    """
+    Accumulates standardized incident chunks as typed NumPy column arrays, so the
+    streaming pipeline never holds more than one chunk of raw dicts at a time.
+    """
+    COLUMN_DTYPES = {
+        'latitude': np.float64,
+        'longitude': np.float64,
+        'crime_code': str,
+        'hour': np.int8,
+        'month': np.int32,
+        'day': np.int32
+    }
+
+    OPTIONAL_COLUMN_DTYPES = {
+        'weight': np.int64 # Present for aggregated ($group) pulls
+    }
+
+    def __init__(self):
+        self._columns = {col: [] for col in self.COLUMN_DTYPES}
+        self.row_count = 0
+
+    def append(self, chunk_df: pd.DataFrame):
+        """Appends one standardized chunk (output of standardize_crime_chunk)."""
+        for col, dtype in self.OPTIONAL_COLUMN_DTYPES.items():
+            if col in chunk_df.columns and col not in self._columns:
+                if self.row_count > 0:
+                    raise ValueError(f"Column '{col}' appeared mid-stream; all chunks must share one schema.")
+                self._columns[col] = []
+        for col in self._columns:
+            dtype = self.COLUMN_DTYPES.get(col, self.OPTIONAL_COLUMN_DTYPES.get(col))
+            self._columns[col].append(chunk_df[col].to_numpy(dtype=dtype))
+        self.row_count += len(chunk_df)
+
+    def to_frame(self) -> pd.DataFrame:
+        """Concatenates the buffered columns into one DataFrame and releases the buffers."""
+        if self.row_count == 0:
+            return pd.DataFrame(columns=list(self._columns))
+        data = {col: np.concatenate(parts) for col, parts in self._columns.items()}
+        data['crime_code'] = data['crime_code'].astype(object) # Plain str objects, as in the non-streaming path
+        self._columns = {col: [] for col in self.COLUMN_DTYPES}
+        return pd.DataFrame(data)
+
+def process_crime_stream(raw_pages, city_config: dict, mapping_engine: str = 'rpc',
+                         block_memo: bool = True, cache_writes: bool = True) -> pd.DataFrame | None:
+    """
+    Streaming variant of process_crime_data. Consumes an iterable of raw record
+    pages (e.g. iter_crime_data_pages), standardizes each page as it arrives and
+    appends it to typed column buffers, so peak memory scales with the page size
+    rather than the total history. Census block mapping then runs once on the
+    compact buffered columns.
+    """
+    city_name = city_config.get('city_name', 'Unknown City')
+    dataset_id = city_config.get('crime_data', {}).get('dataset_id')
+    logger.info(f"Streaming raw records for {city_name} (Dataset: {dataset_id}) through standardization...")
+    adapter = get_source_adapter(city_config)
+    if adapter is None:
+        return None
+
+    buffer = IncidentColumnBuffer()
+    raw_total = 0
+    for page in raw_pages:
+        if not page:
+            continue
+        raw_total += len(page)
+        chunk_df = standardize_crime_chunk(page, adapter, city_name)
+        if chunk_df is None:
+            logger.error(f"Failed to standardize a page of {len(page):,} records for {city_name}. Aborting streaming processing.")
+            return None
+        if not chunk_df.empty:
+            buffer.append(chunk_df)
+
+    logger.info(f"Streamed {raw_total:,} raw records; {buffer.row_count:,} valid records buffered for mapping.")
+    if buffer.row_count == 0:
+        logger.warning(f"No valid records remaining after streaming standardization for {city_name}.")
+        return pd.DataFrame()
+
+    df_for_mapping = buffer.to_frame()
+    log_frame_memory(df_for_mapping, "buffered")
+    return map_incidents_to_blocks(df_for_mapping, city_name, mapping_engine=mapping_engine, city_id=city_config.get('city_id'),
+                                   block_memo=block_memo, cache_writes=cache_writes)
+
+def process_crime_chunks(raw_pages, city_config: dict, target_city_id: int, mapping_engine: str = 'rpc',
+                         block_memo: bool = True, cache_writes: bool = True) -> pd.DataFrame | None:
+    """
+    Out-of-core variant of process_crime_data + calculate_metrics' reduction step.
+    Each page of raw records (e.g. one date window from iter_crime_data_pages) is
+    standardized, mapped to census blocks and immediately reduced to per-block,
+    per-metric partial counts, which are folded into a running total. Memory is
+    bounded by one chunk plus blocks x metrics, regardless of history length.
+    Returns the merged partials for calculate_metrics_from_partials, or None on failure.
+    """
+    city_name = city_config.get('city_name', 'Unknown City')
+    dataset_id = city_config.get('crime_data', {}).get('dataset_id')
+    logger.info(f"Processing raw records for {city_name} (Dataset: {dataset_id}) in chunks...")
+    adapter = get_source_adapter(city_config)
+    if adapter is None:
+        return None
+
+    # One memo for the whole run: chunks share the census version lookup and memo reads,
+    # and new matches are written once at the end
+    memo = open_coordinate_memo(city_config.get('city_id'), city_name, block_memo, cache_writes)
+    try:
+        return reduce_crime_chunks(raw_pages, city_config, target_city_id, adapter, mapping_engine, memo)
+    finally:
+        if memo:
+            memo.save()
+
+def reduce_crime_chunks(raw_pages, city_config: dict, target_city_id: int, adapter: CrimeSourceAdapter,
+                        mapping_engine: str, memo: CoordinateMemo | None) -> pd.DataFrame | None:
+    """Chunk loop of process_crime_chunks: standardize, map (sharing memo) and reduce each page."""
+    city_name = city_config.get('city_name', 'Unknown City')
+    metric_partials = merge_metric_partials([])
+    raw_total = 0
+    mapped_total = 0
+    for chunk_num, page in enumerate(raw_pages, start=1):
+        if len(page) == 0:
+            continue
+        raw_total += len(page)
+        chunk_df = standardize_crime_chunk(page, adapter, city_name)
+        del page # Free the raw records before mapping
+        if chunk_df is None:
+            logger.error(f"Failed to standardize chunk {chunk_num} for {city_name}. Aborting chunked processing.")
+            return None
+        if chunk_df.empty:
+            continue
 
-        # 7. Final Column Selection
-        final_cols = [
-            'crime_code', 'latitude', 'longitude', 'hour', # Original data
-            'census_block_pk', 'block_group_identifier', # Block info
-            'population', 'housing_units', 'population_density_proxy' # Calculated fields
-        ]
-        # Ensure all expected columns exist before selecting
-        final_df = processed_df[[col for col in final_cols if col in processed_df.columns]].copy()
+        mapped_df = map_incidents_to_blocks(chunk_df, city_name, mapping_engine=mapping_engine,
+                                            city_id=city_config.get('city_id'), block_memo=memo is not None, memo=memo)
+        if mapped_df is None:
+            logger.error(f"Failed to map chunk {chunk_num} to census blocks for {city_name}. Aborting chunked processing.")
+            return None
+        if mapped_df.empty:
+            continue
+        mapped_total += len(mapped_df)
 
-        logger.info(f"Processing complete for {city_name}. Final DataFrame shape: {final_df.shape}")
-        logger.debug(f"Final columns: {final_df.columns.tolist()}")
-        # logger.debug(f"Final DataFrame head:\n{final_df.head()}") # Optional debug
-        return final_df
+        chunk_partials = reduce_metric_partials(mapped_df, target_city_id, city_config)
+        if chunk_partials is None:
+            return None
+        metric_partials = merge_metric_partials([metric_partials, chunk_partials])
+        logger.info(f"Chunk {chunk_num}: {len(mapped_df):,} mapped incidents; running partials hold {len(metric_partials):,} block-metric rows.")
+        log_frame_memory(metric_partials, "metric partials")
 
-    except Exception as e:
-        logger.error(f"An unexpected error occurred during process_crime_data for {city_name}: {e}", exc_info=True)
-        return None
+    logger.info(f"Chunked processing finished for {city_name}: {raw_total:,} raw records, {mapped_total:,} mapped incidents.")
+    return metric_partials
 
 # --- Metric Calculation Helper Functions ---
 
@@ -586,6 +1963,31 @@ def calculate_safety_score(weighted_incidents: float) -> float:
     final_score = max(0.0, score)
     return final_score
 
+def calculate_safety_scores(weighted_incidents: np.ndarray) -> np.ndarray:
+    """
+    Vectorized calculate_safety_score. The score is evaluated once per distinct weighted
+    value with math.exp (np.exp may differ in the last bit), so results are bit-identical
+    to the scalar function.
+    """
+    unique_weighted, inverse = np.unique(weighted_incidents, return_inverse=True)
+    unique_scores = np.array([calculate_safety_score(w) for w in unique_weighted.tolist()], dtype=np.float64)
+    return unique_scores[inverse.ravel()]
+
+def build_block_adjacency(block_pks: pd.Index, neighbor_cache: dict) -> csr_matrix:
+    """
+    Binary CSR adjacency over block_pks: A[i, j] = 1 if block_pks[j] is listed as a neighbor
+    of block_pks[i]. Neighbors outside block_pks are dropped; duplicates count once.
+    """
+    neighbor_lists = [neighbor_cache.get(pk, []) for pk in block_pks]
+    rows = np.repeat(np.arange(len(block_pks)), [len(neighbors) for neighbors in neighbor_lists])
+    cols = block_pks.get_indexer([pk for neighbors in neighbor_lists for pk in neighbors])
+    known = cols >= 0
+    adjacency = csr_matrix((np.ones(int(known.sum()), dtype=np.int64), (rows[known], cols[known])),
+                           shape=(len(block_pks), len(block_pks)))
+    adjacency.sum_duplicates()
+    adjacency.data[:] = 1
+    return adjacency
+
 def get_risk_description(
     metric_type: str,
     score: float,
@@ -683,40 +2085,184 @@ def get_risk_description(
         return f"Could not determine specific risk details for {metric_name}. Score indicates {risk_level.lower()} risk overall."
 
 
-def calculate_metrics(processed_df: pd.DataFrame, target_city_id: int, city_config: dict) -> dict:
+def get_projected_block_geometries(block_index: dict) -> gpd.GeoSeries:
+    """Returns the block index geometries projected to the city's UTM zone (meters), computed once per index."""
+    if 'projected' not in block_index:
+        geometries = gpd.GeoSeries(block_index['tree'].geometries, crs="EPSG:4326")
+        block_index['projected'] = geometries.to_crs(geometries.estimate_utm_crs())
+    return block_index['projected']
+
+def find_block_neighbors_local(unique_block_pks: list | None, city_config: dict) -> dict | None:
     """
-    Calculates all safety metrics for each relevant census block.
-    Steps:
-    1. Pre-fetches neighbor relationships for all unique blocks via batch RPC.
-    2. Iterates through each metric type defined in global config.
-    3. Filters data based on metric-specific crime codes and time filters.
-    4. Aggregates incidents per block.
-    5. Calculates weighted incidents and scores for each block.
-    6. Formats results into a dictionary {metric_type: [list_of_records]}.
+    Local counterpart of the 'find_block_neighbors_batch' RPC: finds, in one spatial index
+    pass, every census block of the city whose geometry lies within neighbor_radius_meters
+    of each target block (in a UTM projection); unique_block_pks=None targets every block.
+    Returns {block_pk: [neighbor_pk, ...]} (a block is not its own neighbor), or None if
+    block geometries are unavailable.
     """
-    if processed_df is None or processed_df.empty:
-        logger.warning("No processed data provided to calculate_metrics. Returning empty results.")
-        return {}
-    
-    city_name = city_config.get('city_name', f'ID {target_city_id}')
-    logger.info(f"Calculating safety metrics for {city_name} using {len(processed_df):,} processed records.")
+    city_id = city_config.get('city_id')
+    city_name = city_config.get('city_name', 'Unknown City')
+    neighbor_radius = city_config.get('geospatial', {}).get('neighbor_radius_meters', DEFAULT_NEIGHBOR_RADIUS_METERS)
+    block_index = load_census_block_index(city_id, city_name)
+    if block_index is None:
+        return None
 
-    results = {} # Dictionary to hold lists of metric records by type
-    now = datetime.now(timezone.utc)
-    expires_at = now + timedelta(days=METRIC_EXPIRY_DAYS)
+    start = time.perf_counter()
+    projected = get_projected_block_geometries(block_index)
+    block_pks = block_index['blocks']['id'].astype(str).to_numpy(dtype=object)
+    if unique_block_pks is None:
+        unique_block_pks = block_pks
+    target_positions = pd.Index(block_pks).get_indexer([str(pk) for pk in unique_block_pks])
+    unknown_targets = int((target_positions < 0).sum())
+    if unknown_targets > 0:
+        logger.warning(f"{unknown_targets} target blocks have no geometry in census_blocks for {city_name}; they get no neighbors.")
+    target_positions = target_positions[target_positions >= 0]
+
+    query_idx, neighbor_positions = projected.sindex.query(
+        projected.iloc[target_positions], predicate='dwithin', distance=neighbor_radius
+    )
+    source_positions = target_positions[query_idx]
+    not_self = source_positions != neighbor_positions
+    source_positions = source_positions[not_self]
+    neighbor_positions = neighbor_positions[not_self]
+
+    # Group neighbor PKs by target block
+    order = np.argsort(source_positions, kind='stable')
+    source_positions = source_positions[order]
+    neighbor_positions = neighbor_positions[order]
+    neighbor_cache = {block_pks[pos]: [] for pos in target_positions}
+    split_points = np.flatnonzero(np.diff(source_positions)) + 1
+    for group in np.split(np.arange(len(source_positions)), split_points):
+        if len(group) > 0:
+            neighbor_cache[block_pks[source_positions[group[0]]]] = block_pks[neighbor_positions[group]].tolist()
+
+    logger.info(f"Computed {len(source_positions):,} neighbor pairs within {neighbor_radius}m for {len(neighbor_cache):,} blocks locally in {time.perf_counter() - start:.2f}s.")
+    return neighbor_cache
+
+# --- Neighbor Adjacency Cache ---
+# Neighbor relationships only depend on census geometry and the radius, so they are kept on
+# disk as a CSR adjacency matrix over a block PK lookup, keyed by city, radius and census
+# data version (fetch_census_blocks.py also deletes a city's files when it reloads blocks).
+
+def get_neighbor_cache_path(city_id: int, neighbor_radius: float, census_version: str) -> str:
+    """Returns the .npz path of the neighbor adjacency cache for a city, radius and census version."""
+    return os.path.join(LOCAL_DATA_DIR, 'neighbor_cache', f"city_{city_id}_r{neighbor_radius:g}_{census_version}.npz")
+
+def build_neighbor_adjacency(neighbor_map: dict) -> tuple:
+    """
+    Converts {block_pk: [neighbor_pk, ...]} into (block_pks, adjacency, computed):
+    a PK lookup array, a CSR matrix whose row i holds the neighbor indices of block_pks[i],
+    and a mask of the rows that were actually computed (a block may have no neighbors).
+    """
+    target_pks = [str(pk) for pk in neighbor_map]
+    neighbor_lists = [[str(pk) for pk in neighbors] for neighbors in neighbor_map.values()]
+    all_neighbor_pks = [pk for neighbors in neighbor_lists for pk in neighbors]
+    block_pks = pd.Index(target_pks + all_neighbor_pks).unique()
+    rows = np.repeat(block_pks.get_indexer(target_pks), [len(neighbors) for neighbors in neighbor_lists])
+    cols = block_pks.get_indexer(all_neighbor_pks)
+    adjacency = csr_matrix((np.ones(len(cols), dtype=np.int8), (rows, cols)), shape=(len(block_pks), len(block_pks)))
+    adjacency.sum_duplicates()
+    computed = np.zeros(len(block_pks), dtype=bool)
+    computed[block_pks.get_indexer(target_pks)] = True
+    return block_pks.to_numpy(dtype=str), adjacency, computed
+
+def adjacency_to_neighbor_map(block_pks: np.ndarray, adjacency: csr_matrix, computed: np.ndarray, target_pks: list) -> dict:
+    """Returns {block_pk: [neighbor_pk, ...]} for the target PKs whose rows are computed in the adjacency."""
+    positions = pd.Index(block_pks).get_indexer([str(pk) for pk in target_pks])
+    neighbor_map = {}
+    for pk, pos in zip(target_pks, positions):
+        if pos >= 0 and computed[pos]:
+            neighbor_map[str(pk)] = block_pks[adjacency.indices[adjacency.indptr[pos]:adjacency.indptr[pos + 1]]].tolist()
+    return neighbor_map
+
+def load_neighbor_adjacency(cache_path: str) -> tuple | None:
+    """Loads (block_pks, adjacency, computed) from a neighbor cache file, or None if missing/unreadable."""
+    if not os.path.exists(cache_path):
+        return None
+    try:
+        with np.load(cache_path, allow_pickle=False) as cached:
+            block_pks = cached['block_pks']
+            adjacency = csr_matrix((cached['data'], cached['indices'], cached['indptr']), shape=(len(block_pks), len(block_pks)))
+            return block_pks, adjacency, cached['computed']
+    except Exception as e:
+        logger.warning(f"Could not read neighbor cache {cache_path}, recomputing: {e}")
+        return None
 
-    # Ensure Supabase client is available
-    if not supabase:
-        logger.error("Supabase client not available for neighbor calculation.")
-        return {}
+def save_neighbor_adjacency(cache_path: str, block_pks: np.ndarray, adjacency: csr_matrix, computed: np.ndarray):
+    """Atomically writes a neighbor cache file and removes the city's caches for other census versions."""
+    cache_dir = os.path.dirname(cache_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    try:
+        with open(f"{cache_path}.tmp", 'wb') as f:
+            np.savez_compressed(f, block_pks=block_pks, data=adjacency.data, indices=adjacency.indices,
+                                indptr=adjacency.indptr, computed=computed)
+        os.replace(f"{cache_path}.tmp", cache_path)
+    except Exception as e:
+        logger.warning(f"Failed to write neighbor cache {cache_path}: {e}")
+        return
+    # Same city and radius, different census version: "city_{id}_r{radius}_" prefix
+    version_prefix = os.path.basename(cache_path).rsplit('_', 1)[0] + '_'
+    for file_name in os.listdir(cache_dir):
+        if file_name.startswith(version_prefix) and file_name.endswith('.npz') and file_name != os.path.basename(cache_path):
+            os.remove(os.path.join(cache_dir, file_name))
+            logger.info(f"Removed neighbor cache for an outdated census version: {file_name}")
+
+def fetch_block_neighbors(unique_block_pks: list, city_config: dict, neighbor_engine: str = 'rpc',
+                          cache_neighbors: bool = True, cache_writes: bool = True) -> dict:
+    """
+    Returns {block_pk: [neighbor_pk, ...]} for the given census block PKs. With cache_neighbors,
+    rows already in the on-disk adjacency cache are reused and only missing blocks are computed
+    (by compute_block_neighbors); warm runs skip the neighbor stage entirely. Computed rows are
+    added to the cache unless cache_writes is off.
+    """
+    city_id = city_config.get('city_id')
+    neighbor_radius = city_config.get('geospatial', {}).get('neighbor_radius_meters', DEFAULT_NEIGHBOR_RADIUS_METERS)
+    census_version = get_census_version(city_id) if cache_neighbors and city_id is not None else None
+    if not census_version:
+        if cache_neighbors:
+            logger.warning("Neighbor cache disabled: census data version unavailable.")
+        return compute_block_neighbors(unique_block_pks, city_config, neighbor_engine)
+
+    cache_path = get_neighbor_cache_path(city_id, neighbor_radius, census_version)
+    cached = load_neighbor_adjacency(cache_path)
+    neighbor_map = adjacency_to_neighbor_map(*cached, unique_block_pks) if cached else {}
+    missing_pks = [pk for pk in unique_block_pks if str(pk) not in neighbor_map]
+    logger.info(f"Neighbor cache hit for {len(neighbor_map):,} of {len(unique_block_pks):,} blocks ({os.path.basename(cache_path)}).")
+    if not missing_pks:
+        return neighbor_map
+
+    # The local engine covers the whole city in one pass, so later runs never miss
+    computed_map = compute_block_neighbors(None if neighbor_engine == 'local' else missing_pks, city_config, neighbor_engine)
+    if cached:
+        cached_block_pks, cached_adjacency, cached_computed = cached
+        computed_map = {**adjacency_to_neighbor_map(cached_block_pks, cached_adjacency, cached_computed,
+                                                    cached_block_pks[cached_computed].tolist()), **computed_map}
+    if cache_writes:
+        save_neighbor_adjacency(cache_path, *build_neighbor_adjacency(computed_map))
+        logger.info(f"Stored neighbor adjacency for {len(computed_map):,} blocks in {os.path.basename(cache_path)}.")
+    else:
+        logger.info(f"Not storing neighbor adjacency for {len(missing_pks):,} new blocks (cache is read-only).")
+    return {str(pk): computed_map.get(str(pk), computed_map.get(pk, [])) for pk in unique_block_pks}
+
+def compute_block_neighbors(unique_block_pks: list | None, city_config: dict, neighbor_engine: str = 'rpc') -> dict:
+    """
+    Computes neighbor relationships for the given census block PKs via the
+    'find_block_neighbors_batch' RPC ('rpc'), or from block geometries ('local', see
+    find_block_neighbors_local; None targets every block). Returns {block_pk: [neighbor_pk, ...]}.
+    """
+    if neighbor_engine == 'local':
+        neighbor_cache = find_block_neighbors_local(unique_block_pks, city_config)
+        if neighbor_cache is not None:
+            return neighbor_cache
+        logger.warning("Local neighbor computation unavailable; falling back to the neighbor RPC.")
+        if unique_block_pks is None:
+            return {}
 
-    # --- 1. Pre-calculate Neighbors (Batch RPC) ---
     neighbor_radius = city_config.get('geospatial', {}).get('neighbor_radius_meters', DEFAULT_NEIGHBOR_RADIUS_METERS)
     neighbor_batch_size = city_config.get('geospatial', {}).get('neighbor_batch_size', DEFAULT_NEIGHBOR_BATCH_SIZE)
     logger.info(f"Pre-calculating neighbors within {neighbor_radius}m using batch RPC 'find_block_neighbors_batch' (batch size: {neighbor_batch_size})...")
-    
+
     neighbor_cache = {} # Stores {block_pk: [neighbor_pk1, neighbor_pk2, ...]}
-    unique_block_pks = processed_df['census_block_pk'].unique().tolist()
     total_unique_blocks = len(unique_block_pks)
     logger.info(f"Found {total_unique_blocks} unique block PKs with incidents to fetch neighbors for.")
 
@@ -745,7 +2291,9 @@ def calculate_metrics(processed_df: pd.DataFrame, target_city_id: int, city_conf
                 ).execute()
 
                 # Response data is expected to be a JSON object: {target_id: [neighbor_ids], ...}
-                if batch_neighbor_response.data and isinstance(batch_neighbor_response.data, dict):
+                if isinstance(batch_neighbor_response.data, dict):
+                    # Blocks without neighbors may be left out of the response; record them as computed (empty)
+                    neighbor_cache.update({str(pk): [] for pk in pk_chunk})
                     neighbor_cache.update(batch_neighbor_response.data) # Merge results
                     processed_neighbor_batches += 1
                     # logger.debug(f"Neighbor batch {batch_num} successful.") # Optional debug
@@ -753,7 +2301,7 @@ def calculate_metrics(processed_df: pd.DataFrame, target_city_id: int, city_conf
                     logger.error(f"Error calling neighbor RPC for batch {batch_num}: {batch_neighbor_response.error}")
                     failed_neighbor_batches += 1
                 else:
-                    # This case might occur if the RPC returns an empty dict or non-dict data
+                    # This case might occur if the RPC returns no data or non-dict data
                     logger.warning(f"Neighbor RPC for batch {batch_num} returned no data or unexpected format: {batch_neighbor_response.data}")
                     # We don't explicitly mark as failed here, but no data was added.
 
@@ -771,139 +2319,829 @@ def calculate_metrics(processed_df: pd.DataFrame, target_city_id: int, city_conf
             logger.warning(f"Neighbor data may be incomplete due to {failed_neighbor_batches} failed RPC batches.")
     else:
         logger.info("No unique blocks found to fetch neighbors for.")
-    # --- End Neighbor Pre-calculation --- 
-
-    # --- 2. Calculate Metrics per Type ---
-    city_id_str = str(target_city_id) # For mapping lookup
-    if city_id_str not in CITY_SPECIFIC_MAPPINGS:
-        logger.error(f"Crime code mappings not found for city_id '{target_city_id}' in global config. Cannot calculate metrics.")
-        return {}
-    city_crime_codes = CITY_SPECIFIC_MAPPINGS[city_id_str]
+    return neighbor_cache
 
-    for metric_type, metric_info in METRIC_DEFINITIONS.items(): 
-        logger.info(f"--- Processing Metric: '{metric_type}' for {city_name} ---")
-
-        # --- 2a. Filter by Crime Code ---
+def build_metric_masks(processed_df: pd.DataFrame, city_crime_codes: dict, target_city_id: int, city_config: dict) -> tuple:
+    """
+    Resolves every metric's crime code and time filters (safety_metrics_config.json) into
+    bitmask lookup tables, with bit j standing for metric_types[j]:
+    code -> metrics whose codes include it, and hour -> metrics whose time filter admits it
+    (metrics without an applicable time filter admit every hour).
+    Returns (metric_types, code_values, code_masks, hour_values, hour_masks), where the
+    *_values are the distinct crime codes / hours of processed_df (see pd.factorize).
+    """
+    city_name = city_config.get('city_name', 'Unknown City')
+    dataset_id_for_time_check = city_config.get('crime_data', {}).get('dataset_id')
+    # Skip time filtering for sources known to have bad time data (e.g., NYPD date-only arrest_date)
+    source_adapter = get_source_adapter(city_config)
+    skip_time_filter = source_adapter is not None and not source_adapter.reliable_hours
+    hour_usable = 'hour' in processed_df.columns and pd.api.types.is_numeric_dtype(processed_df['hour'])
+
+    code_values = pd.Index(pd.unique(processed_df['crime_code'].dropna()))
+    hour_values = pd.Index(pd.unique(processed_df['hour'])) if hour_usable else pd.Index([])
+    metric_types = []
+    code_masks = np.zeros(len(code_values), dtype=np.int64)
+    hour_masks = np.zeros(len(hour_values), dtype=np.int64)
+    for metric_type, metric_info in METRIC_DEFINITIONS.items():
+        # --- 2a. Crime Code Filter ---
         if metric_type not in city_crime_codes:
-            logger.warning(f"Metric type '{metric_type}' not found in crime code mapping for city {city_id_str}. Skipping.")
-            results[metric_type] = []
+            logger.warning(f"Metric type '{metric_type}' not found in crime code mapping for city {target_city_id}. Skipping.")
             continue
         relevant_codes = city_crime_codes[metric_type]
         if not relevant_codes:
-             logger.info(f"No crime codes defined for metric '{metric_type}' in city {city_id_str}. Skipping.")
-             results[metric_type] = []
-             continue
-        
-        # Filter the main DataFrame for relevant codes for this metric
-        metric_crimes_df = processed_df[processed_df['crime_code'].isin(relevant_codes)].copy()
-        logger.info(f"Found {len(metric_crimes_df):,} initial incidents for codes: {relevant_codes}")
+            logger.info(f"No crime codes defined for metric '{metric_type}' in city {target_city_id}. Skipping.")
+            continue
+        metric_bit = np.int64(1) << len(metric_types)
+        metric_types.append(metric_type)
+        code_masks[code_values.isin(relevant_codes)] |= metric_bit
 
-        # --- 2b. Apply Time Filter (if defined) ---
+        # --- 2b. Time Filter (if defined) ---
         time_filter_hours = metric_info.get('time_filter')
-        dataset_id_for_time_check = city_config.get('crime_data', {}).get('dataset_id')
-        # Specific check to skip time filtering for datasets known to have bad time data (e.g., NYPD)
-        skip_time_filter = dataset_id_for_time_check == "uip8-fykc"
-
+        admitted_hours = np.ones(len(hour_values), dtype=bool)
         if time_filter_hours and isinstance(time_filter_hours, list):
             if skip_time_filter:
-                 logger.warning(f"Skipping time filter {time_filter_hours} for metric '{metric_type}' in {city_name} (Dataset: {dataset_id_for_time_check}) due to known timestamp issues.")
+                logger.warning(f"Skipping time filter {time_filter_hours} for metric '{metric_type}' in {city_name} (Dataset: {dataset_id_for_time_check}) due to known timestamp issues.")
+            elif hour_usable:
+                admitted_hours = hour_values.isin(time_filter_hours)
+                logger.info(f"Time filter for '{metric_type}': hours {time_filter_hours}.")
             else:
-                if 'hour' in metric_crimes_df.columns and pd.api.types.is_numeric_dtype(metric_crimes_df['hour']):
-                    initial_count = len(metric_crimes_df)
-                    metric_crimes_df = metric_crimes_df[metric_crimes_df['hour'].isin(time_filter_hours)]
-                    filtered_count = len(metric_crimes_df)
-                    logger.info(f"Applied time filter (Hours: {time_filter_hours}). Records reduced from {initial_count} to {filtered_count}.")
-                else:
-                    logger.warning(f"Could not apply time filter for '{metric_type}': 'hour' column missing or not numeric.")
+                logger.warning(f"Could not apply time filter for '{metric_type}': 'hour' column missing or not numeric.")
         elif time_filter_hours:
-             logger.warning(f"Time filter for metric '{metric_type}' is defined but not a list: {time_filter_hours}. Skipping filter.")
+            logger.warning(f"Time filter for metric '{metric_type}' is defined but not a list: {time_filter_hours}. Skipping filter.")
+        hour_masks[admitted_hours] |= metric_bit
+    return metric_types, code_values, code_masks, hour_values, hour_masks
+
+def reduce_metric_partials(processed_df: pd.DataFrame, target_city_id: int, city_config: dict,
+                           bucket_column: str | None = None) -> pd.DataFrame | None:
+    """
+    Reduces processed incidents to per-block, per-metric partial counts in a single pass:
+    each incident gets a metric bitmask (code mask & hour mask, see build_metric_masks),
+    then one sparse blocks x incidents product sums incidents (weights for aggregated pulls)
+    and incident-weighted coordinates into blocks x metrics matrices.
+    Partials of different chunks can be combined with merge_metric_partials.
+    Returns a DataFrame with one row per (metric_type, census_block_pk), or per
+    (metric_type, census_block_pk, bucket) when bucket_column (e.g. 'day') is given,
+    or None if the city has no crime code mappings.
+    """
+    city_name = city_config.get('city_name', f'ID {target_city_id}')
+    city_id_str = str(target_city_id) # For mapping lookup
+    if city_id_str not in CITY_SPECIFIC_MAPPINGS:
+        logger.error(f"Crime code mappings not found for city_id '{target_city_id}' in global config. Cannot calculate metrics.")
+        return None
+    city_crime_codes = CITY_SPECIFIC_MAPPINGS[city_id_str]
+
+    metric_types, code_values, code_masks, hour_values, hour_masks = build_metric_masks(
+        processed_df, city_crime_codes, target_city_id, city_config)
+    if not metric_types:
+        return merge_metric_partials([], bucket_column=bucket_column)
+
+    # --- 2c. Metric Bitmask per Incident ---
+    code_positions = code_values.get_indexer(processed_df['crime_code'])
+    incident_masks = np.where(code_positions >= 0, code_masks[code_positions], 0)
+    if len(hour_values): # No hour values means no time filter could be applied
+        hour_positions = hour_values.get_indexer(processed_df['hour'])
+        incident_masks &= np.where(hour_positions >= 0, hour_masks[hour_positions], 0)
+    selected = (incident_masks != 0) & processed_df['census_block_pk'].notna().to_numpy()
+    incident_masks = incident_masks[selected]
+    block_codes, block_pks = pd.factorize(processed_df['census_block_pk'].to_numpy()[selected])
+    if bucket_column:
+        # Rows of the blocks x metrics matrices become (block, bucket) pairs
+        bucket_codes, bucket_values = pd.factorize(processed_df[bucket_column].to_numpy()[selected])
+        block_codes, block_bucket_pairs = pd.factorize(block_codes.astype(np.int64) * len(bucket_values) + bucket_codes)
+        block_buckets = np.asarray(bucket_values)[block_bucket_pairs % len(bucket_values)]
+        block_pks = np.asarray(block_pks, dtype=object)[block_bucket_pairs // len(bucket_values)]
+    metric_bits = (incident_masks[:, None] >> np.arange(len(metric_types))) & 1
+
+    # --- 2d. Aggregate Incidents per Block x Metric ---
+    # Aggregated pulls: each row stands for `weight` incidents at the same coordinates,
+    # so incidents are summed and the block location is the incident-weighted mean
+    if 'weight' in processed_df.columns:
+        incident_counts = processed_df['weight'].to_numpy(dtype=np.int64)[selected]
+    else:
+        incident_counts = np.ones(len(block_codes), dtype=np.int64)
+    block_incidence = csr_matrix((incident_counts, (block_codes, np.arange(len(block_codes)))),
+                                 shape=(len(block_pks), len(block_codes)))
+    direct_incidents = block_incidence @ metric_bits
+    latitude_sums = block_incidence @ (metric_bits * processed_df['latitude'].to_numpy(dtype=np.float64)[selected, None])
+    longitude_sums = block_incidence @ (metric_bits * processed_df['longitude'].to_numpy(dtype=np.float64)[selected, None])
+
+    # Block attributes are constant per block: take them from each block's first incident
+    _, first_rows = np.unique(block_codes, return_index=True) # factorize codes are 0..n-1, so row i is block i
+    block_attributes = processed_df.loc[selected, ['block_group_identifier', 'population', 'population_density_proxy']].iloc[first_rows]
+    block_rows, metric_columns = np.nonzero(direct_incidents)
+    for metric_column, metric_type in enumerate(metric_types):
+        metric_counts = direct_incidents[:, metric_column]
+        logger.info(f"Aggregated {int(metric_counts.sum()):,} incidents into {int(np.count_nonzero(metric_counts))} census blocks for '{metric_type}' in {city_name}.")
+    metric_partials = pd.DataFrame({
+        'metric_type': np.asarray(metric_types, dtype=object)[metric_columns],
+        'census_block_pk': np.asarray(block_pks, dtype=object)[block_rows],
+        'block_group_identifier': block_attributes['block_group_identifier'].to_numpy()[block_rows],
+        'direct_incidents': direct_incidents[block_rows, metric_columns],
+        'latitude_sum': latitude_sums[block_rows, metric_columns],
+        'longitude_sum': longitude_sums[block_rows, metric_columns],
+        'population': block_attributes['population'].to_numpy()[block_rows],
+        'population_density_proxy': block_attributes['population_density_proxy'].to_numpy()[block_rows]
+    })
+    if bucket_column:
+        metric_partials.insert(2, bucket_column, block_buckets[block_rows])
+    return merge_metric_partials([metric_partials], bucket_column=bucket_column)
+
+def merge_metric_partials(partials: list, bucket_column: str | None = None) -> pd.DataFrame:
+    """
+    Combines partial count frames (from reduce_metric_partials) into one row per
+    (metric_type, census_block_pk), or per (metric_type, census_block_pk, bucket_column).
+    """
+    group_keys = ['metric_type', 'census_block_pk'] + ([bucket_column] if bucket_column else [])
+    partials = [p for p in partials if p is not None and not p.empty]
+    if not partials:
+        return pd.DataFrame(columns=group_keys + ['block_group_identifier', 'direct_incidents', 'latitude_sum',
+                                                  'longitude_sum', 'population', 'population_density_proxy'])
+    combined = pd.concat(partials, ignore_index=True)
+    return combined.groupby(group_keys, sort=True).agg(
+        block_group_identifier=('block_group_identifier', 'first'),
+        direct_incidents=('direct_incidents', 'sum'),
+        latitude_sum=('latitude_sum', 'sum'),
+        longitude_sum=('longitude_sum', 'sum'),
+        population=('population', 'first'),
+        population_density_proxy=('population_density_proxy', 'first')
+    ).reset_index()
+
+# --- Temporal Cube ---
+# Per-block incident counts by metric (crime codes only, no time filter), hour of day and
+# calendar month, stored sparsely (one entry per non-empty cell) with incident-weighted
+# coordinate sums, so any time_filter or month window can be scored by slicing the cube.
+
+def get_temporal_cube_path(city_id: int, census_version: str) -> str:
+    """Returns the .npz path of a city's temporal cube for a census data version (cells are keyed by block PKs)."""
+    return os.path.join(LOCAL_DATA_DIR, 'temporal_cube', f"city_{city_id}_{census_version}.npz")
+
+def format_cube_month(month: int) -> str:
+    """Formats a cube month (months since 1970-01) as 'YYYY-MM'."""
+    return f"{1970 + month // 12}-{month % 12 + 1:02d}"
+
+def build_temporal_cube(processed_df: pd.DataFrame, target_city_id: int, city_config: dict) -> dict | None:
+    """
+    Builds the sparse block x metric x hour x month cube from processed incidents.
+    Returns a dict of arrays (cells as block/metric/hour/month indexes with incidents,
+    latitude_sum and longitude_sum, plus block attributes and the metric/month axes),
+    or None if the incidents lack hour/month columns or the city has no code mappings.
+    """
+    city_name = city_config.get('city_name', f'ID {target_city_id}')
+    city_crime_codes = CITY_SPECIFIC_MAPPINGS.get(str(target_city_id))
+    if not city_crime_codes:
+        logger.error(f"Crime code mappings not found for city_id '{target_city_id}'. Cannot build temporal cube.")
+        return None
+    if 'hour' not in processed_df.columns or 'month' not in processed_df.columns:
+        logger.warning(f"Cannot build temporal cube for {city_name}: 'hour' or 'month' column missing.")
+        return None
+
+    metric_types, code_values, code_masks, _, _ = build_metric_masks(processed_df, city_crime_codes, target_city_id, city_config)
+    code_positions = code_values.get_indexer(processed_df['crime_code'])
+    incident_masks = np.where(code_positions >= 0, code_masks[code_positions], 0)
+    hours = processed_df['hour'].to_numpy(dtype=np.float64)
+    months = processed_df['month'].to_numpy(dtype=np.float64)
+    selected = (incident_masks != 0) & processed_df['census_block_pk'].notna().to_numpy() & np.isfinite(hours) & np.isfinite(months)
+    block_codes, block_pks = pd.factorize(processed_df['census_block_pk'].to_numpy()[selected])
+    month_axis, month_codes = np.unique(months[selected].astype(np.int64), return_inverse=True)
+    hours = hours[selected].astype(np.int64)
+    if 'weight' in processed_df.columns:
+        incident_counts = processed_df['weight'].to_numpy(dtype=np.int64)[selected]
+    else:
+        incident_counts = np.ones(len(block_codes), dtype=np.int64)
+    latitudes = processed_df['latitude'].to_numpy(dtype=np.float64)[selected]
+    longitudes = processed_df['longitude'].to_numpy(dtype=np.float64)[selected]
+
+    # One (incident, metric) pair per metric bit set on the incident
+    rows, metric_codes = np.nonzero((incident_masks[selected][:, None] >> np.arange(len(metric_types))) & 1)
+    cell_keys = ((block_codes[rows] * len(metric_types) + metric_codes) * 24 + hours[rows]) * len(month_axis) + month_codes.ravel()[rows]
+    cells, cell_codes = np.unique(cell_keys, return_inverse=True)
+    weights = incident_counts[rows].astype(np.float64)
+    cell_months, cells = cells % len(month_axis), cells // len(month_axis)
+    cell_hours, cells = cells % 24, cells // 24
+    cell_metrics, cell_blocks = cells % len(metric_types), cells // len(metric_types)
+
+    # Block attributes are constant per block: take them from each block's first incident
+    _, first_rows = np.unique(block_codes, return_index=True)
+    block_attributes = processed_df.loc[selected, ['block_group_identifier', 'population', 'population_density_proxy']].iloc[first_rows]
+    source_adapter = get_source_adapter(city_config)
+    cube = {
+        'block_pks': np.asarray(block_pks, dtype=str),
+        'block_group_identifiers': block_attributes['block_group_identifier'].astype(str).to_numpy(dtype=str),
+        'populations': block_attributes['population'].to_numpy(dtype=np.int64),
+        'population_density_proxies': block_attributes['population_density_proxy'].to_numpy(dtype=np.float64),
+        'metric_types': np.asarray(metric_types, dtype=str),
+        'months': month_axis.astype(np.int32),
+        'reliable_hours': np.bool_(source_adapter is None or source_adapter.reliable_hours),
+        'cell_blocks': cell_blocks.astype(np.int32),
+        'cell_metrics': cell_metrics.astype(np.uint8),
+        'cell_hours': cell_hours.astype(np.uint8),
+        'cell_months': cell_months.astype(np.uint16),
+        'incidents': np.rint(np.bincount(cell_codes.ravel(), weights=weights, minlength=len(cells))).astype(np.int64),
+        'latitude_sums': np.bincount(cell_codes.ravel(), weights=weights * latitudes[rows], minlength=len(cells)),
+        'longitude_sums': np.bincount(cell_codes.ravel(), weights=weights * longitudes[rows], minlength=len(cells))
+    }
+    dense_cells = len(block_pks) * len(metric_types) * 24 * len(month_axis)
+    logger.info(f"Built temporal cube for {city_name}: {len(cells):,} non-empty cells of {dense_cells:,} "
+                f"({len(block_pks):,} blocks x {len(metric_types)} metrics x 24 hours x {len(month_axis)} months).")
+    return cube
+
+def save_temporal_cube(city_id: int, census_version: str, cube: dict):
+    """
+    Atomically writes a city's temporal cube as a compressed .npz file and removes the
+    city's cubes for other census versions.
+    """
+    cube_path = get_temporal_cube_path(city_id, census_version)
+    cube_dir = os.path.dirname(cube_path)
+    os.makedirs(cube_dir, exist_ok=True)
+    try:
+        with open(f"{cube_path}.tmp", 'wb') as f:
+            np.savez_compressed(f, **cube)
+        os.replace(f"{cube_path}.tmp", cube_path)
+        logger.info(f"Saved temporal cube to {cube_path} ({os.path.getsize(cube_path) / (1024 * 1024):.2f} MB).")
+    except Exception as e:
+        logger.warning(f"Failed to write temporal cube {cube_path}: {e}")
+        return
+    for file_name in os.listdir(cube_dir):
+        # Includes cubes saved before they were versioned (city_{id}.npz)
+        if (file_name.startswith(f"city_{city_id}_") or file_name == f"city_{city_id}.npz") and file_name != os.path.basename(cube_path):
+            os.remove(os.path.join(cube_dir, file_name))
+            logger.info(f"Removed temporal cube for an outdated census version: {file_name}")
+
+def load_temporal_cube(city_id: int, census_version: str) -> dict | None:
+    """Loads a city's temporal cube for the census data version, or None if missing/unreadable."""
+    cube_path = get_temporal_cube_path(city_id, census_version)
+    if not os.path.exists(cube_path):
+        return None
+    try:
+        with np.load(cube_path, allow_pickle=False) as cached:
+            return {key: cached[key] for key in cached.files}
+    except Exception as e:
+        logger.warning(f"Could not read temporal cube {cube_path}: {e}")
+        return None
+
+def cube_months_between(cube: dict, first_month: str | None = None, last_month: str | None = None) -> list:
+    """Returns the cube's 'YYYY-MM' month labels within [first_month, last_month] (open ends when None)."""
+    month_labels = [format_cube_month(month) for month in cube['months'].tolist()]
+    return [label for label in month_labels
+            if (first_month is None or label >= first_month) and (last_month is None or label <= last_month)]
+
+def metric_partials_from_cube(cube: dict, time_filters: dict | None = None, months: list | None = None) -> pd.DataFrame:
+    """
+    Slices the temporal cube into per-block, per-metric partials (as reduce_metric_partials).
+    time_filters maps metric types to admitted hours and overrides the configured time_filter
+    (ignored when the source's hours are unreliable); months restricts to 'YYYY-MM' labels.
+    """
+    metric_types = cube['metric_types'].tolist()
+    keep = np.ones(len(cube['incidents']), dtype=bool)
+    for metric_code, metric_type in enumerate(metric_types):
+        if time_filters is not None and metric_type in time_filters:
+            time_filter_hours = time_filters[metric_type]
+        else:
+            time_filter_hours = METRIC_DEFINITIONS.get(metric_type, {}).get('time_filter')
+        if time_filter_hours and isinstance(time_filter_hours, list) and cube['reliable_hours']:
+            keep &= (cube['cell_metrics'] != metric_code) | np.isin(cube['cell_hours'], time_filter_hours)
+    if months is not None:
+        month_labels = np.array([format_cube_month(month) for month in cube['months'].tolist()], dtype=str)
+        keep &= np.isin(month_labels, list(months))[cube['cell_months']]
+
+    block_metric_keys = cube['cell_blocks'][keep].astype(np.int64) * len(metric_types) + cube['cell_metrics'][keep]
+    keys, key_codes = np.unique(block_metric_keys, return_inverse=True)
+    key_codes = key_codes.ravel()
+    blocks, metric_codes = keys // len(metric_types), keys % len(metric_types)
+    metric_partials = pd.DataFrame({
+        'metric_type': np.asarray(metric_types, dtype=object)[metric_codes],
+        'census_block_pk': cube['block_pks'].astype(object)[blocks],
+        'block_group_identifier': cube['block_group_identifiers'].astype(object)[blocks],
+        'direct_incidents': np.bincount(key_codes, weights=cube['incidents'][keep], minlength=len(keys)).round().astype(np.int64),
+        'latitude_sum': np.bincount(key_codes, weights=cube['latitude_sums'][keep], minlength=len(keys)),
+        'longitude_sum': np.bincount(key_codes, weights=cube['longitude_sums'][keep], minlength=len(keys)),
+        'population': cube['populations'][blocks],
+        'population_density_proxy': cube['population_density_proxies'][blocks]
+    })
+    return merge_metric_partials([metric_partials[metric_partials['direct_incidents'] > 0]])
+
+# --- Incremental Metric Counters ---
+# Per-block, per-metric partials kept in daily buckets (day = days since 1970-01-01). A run
+# fetches only days from INCREMENTAL_OVERLAP_DAYS before the high-water mark, replaces those
+# buckets, drops buckets older than days_back, and only rescores blocks whose own or
+# neighbors' totals changed compared to the previous run.
+
+def get_metric_counter_paths(city_id, dataset_id: str) -> tuple:
+    """Returns (parquet_path, state_path) of the metric counter store for a city and dataset."""
+    counter_dir = os.path.join(LOCAL_DATA_DIR, 'metric_counters')
+    base_name = f"{city_id}_{dataset_id}"
+    return os.path.join(counter_dir, f"{base_name}.parquet"), os.path.join(counter_dir, f"{base_name}.state.json")
+
+def load_metric_counters(city_id, dataset_id: str) -> tuple:
+    """Loads the daily metric buckets and their state, or (None, None) if there is no usable store."""
+    counter_path, state_path = get_metric_counter_paths(city_id, dataset_id)
+    if not os.path.exists(counter_path) or not os.path.exists(state_path):
+        return None, None
+    try:
+        with open(state_path, 'r') as f:
+            state = json.load(f)
+        buckets_df = pd.read_parquet(counter_path)
+        logger.info(f"Loaded {len(buckets_df):,} daily metric buckets (high-water mark: {state['high_water_mark']}).")
+        return buckets_df, state
+    except Exception as e:
+        logger.warning(f"Could not load metric counters {counter_path}, recomputing from scratch: {e}")
+        return None, None
+
+def save_metric_counters(city_id, dataset_id: str, buckets_df: pd.DataFrame, state: dict):
+    """Writes the daily metric buckets and their state file."""
+    counter_path, state_path = get_metric_counter_paths(city_id, dataset_id)
+    os.makedirs(os.path.dirname(counter_path), exist_ok=True)
+    # Write to temp files first so an interrupted run never leaves a half-written store
+    buckets_df.to_parquet(f"{counter_path}.tmp", index=False)
+    os.replace(f"{counter_path}.tmp", counter_path)
+    with open(f"{state_path}.tmp", 'w') as f:
+        json.dump(dict(state, bucket_count=len(buckets_df), updated_at=datetime.now(timezone.utc).isoformat()), f, indent=2)
+    os.replace(f"{state_path}.tmp", state_path)
+    logger.info(f"Saved {len(buckets_df):,} daily metric buckets (high-water mark: {state['high_water_mark']}).")
+
+def get_metric_config_signature(target_city_id: int, city_config: dict) -> str:
+    """Hash of everything besides incidents that shapes the counters and scores (metrics, code mappings, neighbor radius)."""
+    signature_source = json.dumps({
+        'metrics': METRIC_DEFINITIONS,
+        'crime_codes': CITY_SPECIFIC_MAPPINGS.get(str(target_city_id)),
+        'neighbor_radius_meters': city_config.get('geospatial', {}).get('neighbor_radius_meters', DEFAULT_NEIGHBOR_RADIUS_METERS),
+        'neighbor_incident_weight': NEIGHBOR_INCIDENT_WEIGHT,
+        'score_decay_constant_k': SCORE_DECAY_CONSTANT_K
+    }, sort_keys=True, default=str)
+    return hashlib.sha256(signature_source.encode('utf-8')).hexdigest()[:16]
+
+def fetch_expiring_metric_ids(target_city_id: int, within_days: float) -> set | None:
+    """
+    Returns the ids of the city's 'safety_metrics' rows whose expires_at has passed or falls
+    within within_days from now, or None if they could not be fetched.
+    """
+    cutoff = (datetime.now(timezone.utc) + timedelta(days=within_days)).isoformat()
+    expiring_ids = set()
+    offset = 0
+    while True:
+        try:
+            expiry_response = supabase.table('safety_metrics') \
+                                      .select('id') \
+                                      .eq('city_id', target_city_id) \
+                                      .lt('expires_at', cutoff) \
+                                      .order('id') \
+                                      .limit(METRIC_HASH_FETCH_BATCH_SIZE) \
+                                      .offset(offset) \
+                                      .execute()
+        except Exception as e:
+            logger.warning(f"Could not fetch expiring metrics for city ID {target_city_id}: {e}")
+            return None
+        if hasattr(expiry_response, 'error') and expiry_response.error:
+            logger.warning(f"Could not fetch expiring metrics for city ID {target_city_id}: {expiry_response.error}")
+            return None
+        rows = expiry_response.data or []
+        expiring_ids.update(row['id'] for row in rows)
+        if len(rows) < METRIC_HASH_FETCH_BATCH_SIZE:
+            return expiring_ids
+        offset += METRIC_HASH_FETCH_BATCH_SIZE
+
+def prepare_metric_counter_update(city_config: dict, target_city_id: int, days_back: int, max_records: int,
+                                  fetch_mode: str = 'single', pushdown: bool = False, mapping_engine: str = 'rpc',
+                                  block_memo: bool = True, cache_writes: bool = True) -> dict | None:
+    """
+    Fetches and reduces only the incidents since the counters' high-water mark (minus
+    INCREMENTAL_OVERLAP_DAYS, whole days), rolls the daily buckets forward and diffs the
+    per-block totals against the previous run. Unchanged blocks whose stored metrics expire
+    within METRIC_EXPIRY_REFRESH_DAYS are rescored too, so their rows are rewritten with a
+    new expires_at. Returns a dict with the new totals
+    ('metric_partials'), the changed blocks ('changed_partials', for
+    calculate_metrics_from_partials), the ids of metrics that disappeared
+    ('removed_metric_ids'), 'full_refresh' (no usable previous state) and the 'buckets'
+    and 'state' to persist with save_metric_counters once the upload succeeded.
+    Returns None if the incidents could not be processed.
+    """
+    city_name = city_config.get('city_name', 'Unknown City')
+    adapter = get_source_adapter(city_config)
+    if adapter is None:
+        return None
+    dataset_id = adapter.source_key
+    census_version = get_census_version(target_city_id)
+    signature = get_metric_config_signature(target_city_id, city_config)
+
+    # Buckets are whole days: the window starts and re-fetching resumes at midnight (naive UTC, like Socrata)
+    today = datetime.now(timezone.utc).replace(tzinfo=None, hour=0, minute=0, second=0, microsecond=0)
+    window_start = today - timedelta(days=days_back)
+    old_buckets, state = load_metric_counters(target_city_id, dataset_id)
+    full_refresh = old_buckets is None or state.get('census_version') != census_version or state.get('signature') != signature
+    if full_refresh:
+        if old_buckets is not None:
+            logger.info(f"Census data or metric configuration changed for {city_name}; rebuilding metric counters.")
+        old_buckets = merge_metric_partials([], bucket_column='day')
+        fetch_since = window_start
+    else:
+        high_water_mark = datetime.fromisoformat(state['high_water_mark'])
+        fetch_since = max(window_start, (high_water_mark - timedelta(days=INCREMENTAL_OVERLAP_DAYS)).replace(hour=0, minute=0, second=0, microsecond=0))
+        logger.info(f"Incremental metric update for {city_name}: re-counting days from {fetch_since.date().isoformat()}.")
+
+    new_records = fetch_crime_data(city_config, days_back=days_back, max_records=max_records, fetch_mode=fetch_mode,
+                                   since=fetch_since.replace(tzinfo=timezone.utc), pushdown=pushdown)
+    if len(new_records) > 0:
+        processed_df = process_crime_data(new_records, city_config, mapping_engine=mapping_engine, block_memo=block_memo,
+                                          cache_writes=cache_writes)
+        if processed_df is None:
+            return None
+        del new_records
+        new_buckets = reduce_metric_partials(processed_df, target_city_id, city_config, bucket_column='day') if not processed_df.empty else None
+        if new_buckets is None and not processed_df.empty:
+            return None
+        high_water_mark = (datetime(1970, 1, 1) + timedelta(days=int(processed_df['day'].max()))) if not processed_df.empty else fetch_since
+        del processed_df
+    else:
+        new_buckets = None
+
+    epoch = datetime(1970, 1, 1)
+    window_start_day, fetch_since_day = (window_start - epoch).days, (fetch_since - epoch).days
+    bucket_days = old_buckets['day'].to_numpy(dtype=np.int64)
+    if new_buckets is None and not full_refresh:
+        # Nothing came back (possibly a failed request): keep the overlap rather than dropping it
+        logger.warning(f"Incremental fetch returned no records for {city_name}; keeping the stored buckets.")
+        kept_buckets = old_buckets[bucket_days >= window_start_day]
+        high_water_mark = datetime.fromisoformat(state['high_water_mark'])
+    else:
+        kept_buckets = old_buckets[(bucket_days >= window_start_day) & (bucket_days < fetch_since_day)]
+        if new_buckets is None:
+            high_water_mark = fetch_since
+    aged_out = int((bucket_days < window_start_day).sum())
+    if aged_out > 0:
+        logger.info(f"Aged out {aged_out:,} daily metric buckets older than {days_back} days.")
+    buckets = merge_metric_partials([kept_buckets, new_buckets], bucket_column='day')
+
+    # --- Diff the per-block totals against the previous run ---
+    key_columns = ['metric_type', 'census_block_pk']
+    value_columns = ['direct_incidents', 'latitude_sum', 'longitude_sum']
+    old_totals = merge_metric_partials([old_buckets.drop(columns='day')])
+    metric_partials = merge_metric_partials([buckets.drop(columns='day')])
+    totals_diff = old_totals[key_columns + value_columns].merge(
+        metric_partials[key_columns + value_columns], on=key_columns, how='outer', suffixes=('_old', '_new'), indicator=True
+    )
+    count_changed = totals_diff['direct_incidents_old'].fillna(0) != totals_diff['direct_incidents_new'].fillna(0)
+    own_changed = count_changed | (totals_diff['latitude_sum_old'] != totals_diff['latitude_sum_new']) | \
+        (totals_diff['longitude_sum_old'] != totals_diff['longitude_sum_new'])
+    changed_partials = totals_diff.loc[own_changed, key_columns].assign(count_changed=count_changed[own_changed].to_numpy())
+
+    # Unchanged blocks are never rewritten by an incremental run: refresh the ones about to expire
+    expiring_ids = fetch_expiring_metric_ids(target_city_id, METRIC_EXPIRY_REFRESH_DAYS) if not full_refresh else None
+    expiring_count = 0
+    if expiring_ids:
+        unchanged = metric_partials[key_columns].merge(changed_partials[key_columns], on=key_columns, how='left', indicator=True)
+        unchanged = unchanged.loc[unchanged['_merge'] == 'left_only', key_columns]
+        expiring_parts = [
+            blocks[np.isin(format_uuid_bytes(stable_metric_ids(target_city_id, blocks['census_block_pk'].astype(str), metric_type)), list(expiring_ids))]
+            for metric_type, blocks in unchanged.groupby('metric_type', observed=True)
+        ]
+        expiring_partials = pd.concat(expiring_parts, ignore_index=True) if expiring_parts else unchanged.iloc[:0]
+        expiring_count = len(expiring_partials)
+        changed_partials = pd.concat([changed_partials, expiring_partials.assign(count_changed=False)], ignore_index=True)
+
+    removed = totals_diff[totals_diff['_merge'] == 'left_only']
+    removed_metric_ids = [
+        metric_id
+        for metric_type, removed_blocks in removed.groupby('metric_type')
+        for metric_id in format_uuid_bytes(stable_metric_ids(target_city_id, removed_blocks['census_block_pk'].astype(str), metric_type))
+    ]
+    logger.info(f"Metric counters for {city_name}: {len(buckets):,} daily buckets, {len(metric_partials):,} block metrics, "
+                f"{len(changed_partials) - expiring_count:,} changed ({int(count_changed.sum()):,} with new counts), "
+                f"{expiring_count:,} unchanged but expiring, {len(removed_metric_ids):,} removed.")
+
+    return {
+        'metric_partials': metric_partials,
+        'changed_partials': changed_partials,
+        'removed_metric_ids': removed_metric_ids,
+        'full_refresh': full_refresh,
+        'dataset_id': dataset_id,
+        'buckets': buckets,
+        'state': {'high_water_mark': high_water_mark.isoformat(), 'census_version': census_version, 'signature': signature}
+    }
+
+def calculate_metrics(processed_df: pd.DataFrame, target_city_id: int, city_config: dict, neighbor_engine: str = 'rpc',
+                      cache_neighbors: bool = True, scoring_engine: str = 'loop', metric_output: str = 'records',
+                      cache_writes: bool = True) -> dict:
+    """
+    Calculates all safety metrics for each relevant census block.
+    Steps:
+    1. Reduces incidents to per-block, per-metric counts in one pass (reduce_metric_partials),
+       applying metric-specific crime code and time filters as bitmasks.
+    2. Scores the blocks (calculate_metrics_from_partials). Returns {metric_type: list of record
+       dicts} by default; scoring_engine='vectorized' with metric_output='columnar' returns MetricColumns.
+    """
+    if processed_df is None or processed_df.empty:
+        logger.warning("No processed data provided to calculate_metrics. Returning empty results.")
+        return {}
+
+    city_name = city_config.get('city_name', f'ID {target_city_id}')
+    logger.info(f"Calculating safety metrics for {city_name} using {len(processed_df):,} processed records.")
+    metric_partials = reduce_metric_partials(processed_df, target_city_id, city_config)
+    if metric_partials is None:
+        return {}
+    return calculate_metrics_from_partials(metric_partials, target_city_id, city_config, neighbor_engine=neighbor_engine,
+                                           cache_neighbors=cache_neighbors, scoring_engine=scoring_engine,
+                                           metric_output=metric_output, cache_writes=cache_writes)
+
+def build_metric_record(target_city_id: int, block_pk, metric_type: str, metric_info: dict, latitude: float,
+                        longitude: float, score: float, description: str, direct_incidents: int,
+                        weighted_incidents: float, pop_density_proxy: float, incidents_per_1000: float,
+                        now: datetime, expires_at: datetime) -> dict:
+    """Builds one 'safety_metrics' row with a stable UUID based on city, block PK, and metric type."""
+    id_string = f"{target_city_id}:{block_pk}:{metric_type}"
+    stable_metric_id = str(uuid.uuid5(uuid.NAMESPACE_DNS, id_string))
+
+    # Ensure types match Supabase table schema
+    return {
+        'id': stable_metric_id,
+        'city_id': int(target_city_id),
+        'block_group_id': str(block_pk), # FK column uses the PK
+        'latitude': float(latitude),
+        'longitude': float(longitude),
+        'geom': f"SRID=4326;POINT({longitude} {latitude})", # Optional: Construct geom string
+        'metric_type': str(metric_type),
+        'score': float(score), # NUMERIC in DB
+        'question': str(metric_info.get('question', '')),
+        'description': str(description),
+        'direct_incidents': int(direct_incidents),
+        'weighted_incidents': float(weighted_incidents), # NUMERIC in DB
+        'population_density': float(pop_density_proxy), # NUMERIC in DB
+        'incidents_per_1000': float(incidents_per_1000), # NUMERIC in DB
+        'created_at': now.isoformat(),
+        'expires_at': expires_at.isoformat()
+        # Optional: Add block_group_identifier if needed: block_row['block_group_identifier']
+    }
+
+def stable_metric_ids(target_city_id: int, block_pks, metric_type: str) -> np.ndarray:
+    """
+    Batch uuid5(NAMESPACE_DNS, "{city}:{block_pk}:{metric_type}") for many blocks, returned as
+    an (n, 16) uint8 array of UUID bytes (see format_uuid_bytes); identical to uuid.uuid5.
+    """
+    prefix = uuid.NAMESPACE_DNS.bytes + f"{target_city_id}:".encode('utf-8')
+    suffix = f":{metric_type}".encode('utf-8')
+    digests = b''.join(hashlib.sha1(prefix + str(pk).encode('utf-8') + suffix).digest()[:16] for pk in block_pks)
+    uuid_bytes = np.frombuffer(digests, dtype=np.uint8).reshape(-1, 16).copy()
+    uuid_bytes[:, 6] = (uuid_bytes[:, 6] & 0x0F) | 0x50 # Version 5
+    uuid_bytes[:, 8] = (uuid_bytes[:, 8] & 0x3F) | 0x80 # RFC 4122 variant
+    return uuid_bytes
+
+def format_uuid_bytes(uuid_bytes: np.ndarray) -> list:
+    """Formats an (n, 16) uint8 array of UUID bytes as canonical 8-4-4-4-12 strings."""
+    hex_digits = uuid_bytes.tobytes().hex()
+    return [f"{h[0:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:32]}"
+            for h in (hex_digits[i:i + 32] for i in range(0, len(hex_digits), 32))]
+
+class MetricColumns:
+    """
+    Columnar 'safety_metrics' records for one metric type: per-block values as NumPy arrays
+    (UUIDs as raw bytes, descriptions as a Categorical) and values shared by every row
+    (city, metric type, question, timestamps) stored once. Row dicts are only built on
+    demand (to_records), e.g. one upload batch at a time.
+    """
+    def __init__(self, constants: dict, columns: dict):
+        self.constants = constants
+        self.columns = columns
+
+    def __len__(self) -> int:
+        return len(self.columns['score'])
+
+    def to_records(self, start: int = 0, stop: int | None = None) -> list:
+        """Serializes rows [start, stop) into the dicts built by build_metric_record."""
+        rows = slice(start, stop)
+        constants = self.constants
+        records = []
+        for metric_id, block_pk, latitude, longitude, score, description, direct, weighted, pop_density, per_1000 in zip(
+                format_uuid_bytes(self.columns['id'][rows]), self.columns['block_group_id'][rows].tolist(),
+                self.columns['latitude'][rows].tolist(), self.columns['longitude'][rows].tolist(),
+                self.columns['score'][rows].tolist(), self.columns['description'][rows].tolist(),
+                self.columns['direct_incidents'][rows].tolist(), self.columns['weighted_incidents'][rows].tolist(),
+                self.columns['population_density'][rows].tolist(), self.columns['incidents_per_1000'][rows].tolist()):
+            records.append({
+                'id': metric_id,
+                'city_id': constants['city_id'],
+                'block_group_id': block_pk,
+                'latitude': latitude,
+                'longitude': longitude,
+                'geom': f"SRID=4326;POINT({longitude} {latitude})",
+                'metric_type': constants['metric_type'],
+                'score': score,
+                'question': constants['question'],
+                'description': description,
+                'direct_incidents': direct,
+                'weighted_incidents': weighted,
+                'population_density': pop_density,
+                'incidents_per_1000': per_1000,
+                'created_at': constants['created_at'],
+                'expires_at': constants['expires_at']
+            })
+        return records
+
+def iter_metric_records(metrics_by_type: dict, serialize_batch_size: int = METRIC_UPLOAD_BATCH_SIZE):
+    """Yields 'safety_metrics' records of all types, serializing columnar metrics one batch at a time."""
+    for metrics in metrics_by_type.values():
+        if isinstance(metrics, MetricColumns):
+            for start in range(0, len(metrics), serialize_batch_size):
+                yield from metrics.to_records(start, start + serialize_batch_size)
+        elif metrics:
+            yield from metrics
+
+def score_metric_blocks_loop(block_group_stats: pd.DataFrame, neighbor_cache: dict, target_city_id: int, metric_type: str,
+                             metric_info: dict, now: datetime, expires_at: datetime, rescore: np.ndarray | None = None) -> list:
+    """
+    Scores one metric's blocks one at a time, looking up each block's neighbors in neighbor_cache.
+    rescore optionally masks the blocks to score (all blocks still count as neighbors).
+    """
+    # Create a map of {block_pk: incident_count} for efficient neighbor lookup
+    metric_incident_map_pk = block_group_stats.set_index('census_block_pk')['direct_incidents'].to_dict()
+    if rescore is not None:
+        block_group_stats = block_group_stats[rescore]
+
+    metric_records = [] # List to store final records for this metric type
+    for _, block_row in tqdm(block_group_stats.iterrows(), total=len(block_group_stats), desc=f"Calculating {metric_type} scores", unit="block"):
+        current_block_pk = block_row['census_block_pk']
+        direct_incidents = block_row['direct_incidents']
+        population = block_row['population']
+
+        # Get neighbors from cache (defaults to empty list if block not in cache or failed)
+        neighbor_pks = neighbor_cache.get(current_block_pk, [])
+
+        # Calculate total incidents from neighbors that exist in *this metric's* incident map
+        neighbor_incident_map = {
+            nid_pk: metric_incident_map_pk.get(nid_pk, 0)
+            for nid_pk in neighbor_pks if nid_pk in metric_incident_map_pk
+        }
+        contributing_neighbor_count = len(neighbor_incident_map) # Count neighbors that *had* incidents for this metric
+
+        # Calculate weighted incidents and score
+        weighted_incidents = calculate_weighted_incidents(direct_incidents, neighbor_incident_map)
+        score = calculate_safety_score(weighted_incidents)
+        incidents_per_1000 = (direct_incidents / population) * 1000.0 if population > 0 else 0.0
+
+        # Generate description
+        description = get_risk_description(
+            metric_type,
+            score,
+            direct_incidents,
+            weighted_incidents,
+            incidents_per_1000,
+            contributing_neighbor_count
+        )
+
+        metric_records.append(build_metric_record(
+            target_city_id, current_block_pk, metric_type, metric_info, block_row['latitude'], block_row['longitude'],
+            score, description, direct_incidents, weighted_incidents, block_row['population_density_proxy'],
+            incidents_per_1000, now, expires_at
+        ))
+    return metric_records
+
+def build_block_metric_mask(block_metrics: pd.DataFrame, block_pks: pd.Index, metric_types: pd.Index) -> np.ndarray:
+    """Dense blocks x metrics boolean matrix, True for each (census_block_pk, metric_type) row of block_metrics."""
+    rows = block_pks.get_indexer(block_metrics['census_block_pk'])
+    columns = metric_types.get_indexer(block_metrics['metric_type'])
+    known = (rows >= 0) & (columns >= 0)
+    mask = np.zeros((len(block_pks), len(metric_types)), dtype=bool)
+    mask[rows[known], columns[known]] = True
+    return mask
+
+def build_block_metric_matrices(metric_partials: pd.DataFrame, block_pks: pd.Index, metric_types: pd.Index) -> tuple:
+    """
+    Pivots per-block, per-metric partials into dense blocks x metrics matrices:
+    (incident counts, 1 where the block has a row for the metric).
+    """
+    rows = block_pks.get_indexer(metric_partials['census_block_pk'])
+    columns = metric_types.get_indexer(metric_partials['metric_type'])
+    known = columns >= 0
+    incident_matrix = np.zeros((len(block_pks), len(metric_types)), dtype=np.int64)
+    incident_matrix[rows[known], columns[known]] = metric_partials['direct_incidents'].to_numpy(dtype=np.int64)[known]
+    presence_matrix = build_block_metric_mask(metric_partials, block_pks, metric_types).astype(np.int64)
+    return incident_matrix, presence_matrix
+
+def score_metric_blocks_vectorized(block_group_stats: pd.DataFrame, neighbor_incidents: np.ndarray,
+                                   contributing_neighbor_counts: np.ndarray, target_city_id: int, metric_type: str,
+                                   metric_info: dict, now: datetime, expires_at: datetime) -> 'MetricColumns':
+    """
+    Scores one metric's blocks at once from their neighbor incident totals and contributing
+    neighbor counts (rows of A @ incidents and A @ presence, aligned with block_group_stats):
+    weighted = direct + NEIGHBOR_INCIDENT_WEIGHT * neighbor incidents.
+    Returns columnar records; their to_records() equals score_metric_blocks_loop's output.
+    """
+    direct_incidents = block_group_stats['direct_incidents'].to_numpy(dtype=np.int64)
+    weighted_incidents = direct_incidents.astype(np.float64) + NEIGHBOR_INCIDENT_WEIGHT * neighbor_incidents.astype(np.float64)
+    scores = calculate_safety_scores(weighted_incidents)
+    population = block_group_stats['population'].to_numpy(dtype=np.int64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        incidents_per_1000 = np.where(population > 0, (direct_incidents / population) * 1000.0, 0.0)
+
+    # Descriptions depend only on the metric and score, so build each one once per distinct score
+    unique_scores, score_codes = np.unique(scores, return_inverse=True)
+    description_codes = {}
+    unique_description_codes = []
+    for score in unique_scores.tolist():
+        description = get_risk_description(metric_type, score, 0, 0.0, 0.0, 0)
+        unique_description_codes.append(description_codes.setdefault(description, len(description_codes)))
+    descriptions = pd.Categorical.from_codes(np.asarray(unique_description_codes, dtype=np.int32)[score_codes.ravel()],
+                                             categories=list(description_codes))
+
+    block_pks = block_group_stats['census_block_pk'].astype(str).to_numpy(dtype=object)
+    return MetricColumns(
+        constants={
+            'city_id': int(target_city_id),
+            'metric_type': str(metric_type),
+            'question': str(metric_info.get('question', '')),
+            'created_at': now.isoformat(),
+            'expires_at': expires_at.isoformat()
+        },
+        columns={
+            'id': stable_metric_ids(target_city_id, block_pks, metric_type),
+            'block_group_id': block_pks,
+            'latitude': block_group_stats['latitude'].to_numpy(dtype=np.float64),
+            'longitude': block_group_stats['longitude'].to_numpy(dtype=np.float64),
+            'score': scores,
+            'description': descriptions,
+            'direct_incidents': direct_incidents,
+            'weighted_incidents': weighted_incidents,
+            'population_density': block_group_stats['population_density_proxy'].to_numpy(dtype=np.float64),
+            'incidents_per_1000': incidents_per_1000
+        }
+    )
+
+def calculate_metrics_from_partials(metric_partials: pd.DataFrame, target_city_id: int, city_config: dict,
+                                    neighbor_engine: str = 'rpc', cache_neighbors: bool = True,
+                                    scoring_engine: str = 'loop', metric_output: str = 'records',
+                                    changed_partials: pd.DataFrame | None = None, cache_writes: bool = True) -> dict:
+    """
+    Scores per-block, per-metric incident counts (from reduce_metric_partials or
+    merged chunk partials). With changed_partials (metric_type, census_block_pk,
+    count_changed rows, see prepare_metric_counter_update), only blocks whose own
+    partials changed or that have a neighbor whose count changed are scored and emitted.
+    Steps:
+    1. Pre-fetches neighbor relationships for all blocks with incidents (batch RPC or local, see
+       neighbor_engine; served from the adjacency cache when cache_neighbors is set, which
+       is only read when cache_writes is off).
+    2. Calculates weighted incidents and scores for each block and metric, either as sparse
+       matrix-vector products over the neighbor adjacency ('vectorized') or block by block ('loop').
+    3. Formats results into a dictionary {metric_type: records}, where records are MetricColumns
+       (vectorized engine with metric_output='columnar') or a list of record dicts.
+    """
+    city_name = city_config.get('city_name', f'ID {target_city_id}')
+    results = {} # Dictionary to hold lists of metric records by type
+    now = datetime.now(timezone.utc)
+    expires_at = now + timedelta(days=METRIC_EXPIRY_DAYS)
+
+    # Ensure Supabase client is available
+    if not supabase:
+        logger.error("Supabase client not available for neighbor calculation.")
+        return {}
 
-        if metric_crimes_df.empty:
-            logger.info(f"No relevant incidents found for metric '{metric_type}' after code/time filtering.")
+    # --- 1. Pre-calculate Neighbors ---
+    neighbor_cache = fetch_block_neighbors(metric_partials['census_block_pk'].unique().tolist(), city_config,
+                                           neighbor_engine=neighbor_engine, cache_neighbors=cache_neighbors,
+                                           cache_writes=cache_writes)
+    if scoring_engine == 'vectorized' or changed_partials is not None:
+        block_pks = pd.Index(metric_partials['census_block_pk'].unique())
+        if changed_partials is not None:
+            # Blocks whose incidents aged out entirely still count as changed neighbors
+            block_pks = block_pks.append(pd.Index(changed_partials['census_block_pk'].unique())).unique()
+        adjacency = build_block_adjacency(block_pks, neighbor_cache)
+        logger.info(f"Built neighbor adjacency for {len(block_pks):,} blocks ({adjacency.nnz:,} neighbor links).")
+        metric_types = pd.Index(list(METRIC_DEFINITIONS))
+    if scoring_engine == 'vectorized':
+        # All metrics at once: blocks x metrics neighbor incident totals and contributing neighbor counts
+        incident_matrix, presence_matrix = build_block_metric_matrices(metric_partials, block_pks, metric_types)
+        neighbor_incident_matrix = adjacency @ incident_matrix
+        contributing_neighbor_matrix = adjacency @ presence_matrix
+    if changed_partials is not None:
+        count_changed_matrix = build_block_metric_mask(changed_partials[changed_partials['count_changed']], block_pks, metric_types)
+        rescore_matrix = build_block_metric_mask(changed_partials, block_pks, metric_types) | \
+            ((adjacency @ count_changed_matrix.astype(np.int64)) > 0)
+        logger.info(f"Rescoring {int(rescore_matrix.sum()):,} block metrics whose own or neighbors' counts changed.")
+
+    # --- 2. Calculate Metrics per Type ---
+    for metric_type, metric_info in METRIC_DEFINITIONS.items():
+        logger.info(f"--- Scoring Metric: '{metric_type}' for {city_name} ---")
+        block_group_stats = metric_partials[metric_partials['metric_type'] == metric_type].reset_index(drop=True)
+        if block_group_stats.empty:
             results[metric_type] = []
             continue
-
-        logger.info(f"Processing {len(metric_crimes_df):,} incidents for metric '{metric_type}'.")
-
-        # --- 2c. Aggregate Incidents per Block ---
-        # Group by the block primary key ('census_block_pk')
-        # Keep other needed fields for score calculation and output record
-        block_group_stats = metric_crimes_df.groupby('census_block_pk').agg(
-            block_group_identifier=('block_group_identifier', 'first'), # Keep original ID if needed
-            direct_incidents=('crime_code', 'size'),
-            latitude=('latitude', 'mean'), # Use mean lat/lon of incidents in block
-            longitude=('longitude', 'mean'),
-            population=('population', 'first'), # Population of the block
-            # housing_units=('housing_units', 'first'), # Not directly needed for score calc
-            population_density_proxy=('population_density_proxy', 'first')
-        ).reset_index() # census_block_pk becomes a column
-
-        logger.info(f"Aggregated incidents into {len(block_group_stats)} census blocks for '{metric_type}'.")
-
-        # Create a map of {block_pk: incident_count} for efficient neighbor lookup
-        metric_incident_map_pk = block_group_stats.set_index('census_block_pk')['direct_incidents'].to_dict()
-
-        # --- 2d. Calculate Score for Each Block ---
-        metric_records = [] # List to store final records for this metric type
-        for _, block_row in tqdm(block_group_stats.iterrows(), total=len(block_group_stats), desc=f"Calculating {metric_type} scores", unit="block"):
-            current_block_pk = block_row['census_block_pk']
-            direct_incidents = block_row['direct_incidents']
-            population = block_row['population']
-            pop_density_proxy = block_row['population_density_proxy']
-            latitude = block_row['latitude']
-            longitude = block_row['longitude']
-
-            # Get neighbors from cache (defaults to empty list if block not in cache or failed)
-            neighbor_pks = neighbor_cache.get(current_block_pk, [])
-            
-            # Calculate total incidents from neighbors that exist in *this metric's* incident map
-            neighbor_incident_map = {
-                nid_pk: metric_incident_map_pk.get(nid_pk, 0)
-                for nid_pk in neighbor_pks if nid_pk in metric_incident_map_pk
-            }
-            contributing_neighbor_count = len(neighbor_incident_map) # Count neighbors that *had* incidents for this metric
-
-            # Calculate weighted incidents and score
-            weighted_incidents = calculate_weighted_incidents(direct_incidents, neighbor_incident_map)
-            score = calculate_safety_score(weighted_incidents)
-            incidents_per_1000 = (direct_incidents / population) * 1000.0 if population > 0 else 0.0
-
-            # Generate description
-            description = get_risk_description(
-                metric_type,
-                score,
-                direct_incidents,
-                weighted_incidents,
-                incidents_per_1000,
-                contributing_neighbor_count
+        block_group_stats['latitude'] = block_group_stats['latitude_sum'] / block_group_stats['direct_incidents']
+        block_group_stats['longitude'] = block_group_stats['longitude_sum'] / block_group_stats['direct_incidents']
+        rescore = None
+        if changed_partials is not None:
+            rescore = rescore_matrix[block_pks.get_indexer(block_group_stats['census_block_pk']), metric_types.get_loc(metric_type)]
+
+        if scoring_engine == 'vectorized':
+            if rescore is not None:
+                block_group_stats = block_group_stats[rescore].reset_index(drop=True)
+            positions = block_pks.get_indexer(block_group_stats['census_block_pk'])
+            metric_column = metric_types.get_loc(metric_type)
+            metric_records = score_metric_blocks_vectorized(
+                block_group_stats, neighbor_incident_matrix[positions, metric_column],
+                contributing_neighbor_matrix[positions, metric_column], target_city_id, metric_type, metric_info, now, expires_at
             )
-
-            # Create stable UUID based on city, block PK, and metric type
-            id_string = f"{target_city_id}:{current_block_pk}:{metric_type}"
-            stable_metric_id = str(uuid.uuid5(uuid.NAMESPACE_DNS, id_string))
-
-            # Prepare record for insertion
-            # Ensure types match Supabase table schema
-            metric_record = {
-                'id': stable_metric_id,
-                'city_id': int(target_city_id),
-                'block_group_id': str(current_block_pk), # FK column uses the PK
-                'latitude': float(latitude),
-                'longitude': float(longitude),
-                'geom': f"SRID=4326;POINT({longitude} {latitude})", # Optional: Construct geom string
-                'metric_type': str(metric_type),
-                'score': float(score), # NUMERIC in DB
-                'question': str(metric_info.get('question', '')),
-                'description': str(description),
-                'direct_incidents': int(direct_incidents),
-                'weighted_incidents': float(weighted_incidents), # NUMERIC in DB
-                'population_density': float(pop_density_proxy), # NUMERIC in DB
-                'incidents_per_1000': float(incidents_per_1000), # NUMERIC in DB
-                'created_at': now.isoformat(),
-                'expires_at': expires_at.isoformat()
-                # Optional: Add block_group_identifier if needed: block_row['block_group_identifier']
-            }
-            metric_records.append(metric_record)
+            if metric_output == 'records':
+                metric_records = metric_records.to_records()
+        else:
+            metric_records = score_metric_blocks_loop(block_group_stats, neighbor_cache, target_city_id,
+                                                      metric_type, metric_info, now, expires_at, rescore=rescore)
 
         results[metric_type] = metric_records
         logger.info(f"Generated {len(metric_records)} metric records for type '{metric_type}'.")
@@ -911,41 +3149,264 @@ def calculate_metrics(processed_df: pd.DataFrame, target_city_id: int, city_conf
     logger.info("Finished calculating all metric types.")
     return results
 
-def upload_metrics(metrics_by_type: dict, target_city_id: int, test_mode: bool):
+def metric_content_hash(record: dict) -> str:
+    """Hashes a 'safety_metrics' record's content, ignoring bookkeeping fields (created_at, expires_at)."""
+    content = {key: value for key, value in record.items() if key not in METRIC_HASH_EXCLUDED_FIELDS}
+    return hashlib.sha256(json.dumps(content, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()[:32]
+
+def fetch_existing_metric_hashes(target_city_id: int) -> dict | None:
+    """
+    Fetches {id: content_hash} for the city's existing 'safety_metrics' rows. Rows written without a
+    hash, or whose expires_at falls within METRIC_EXPIRY_REFRESH_DAYS, map to None so they are
+    rewritten (refreshing expires_at) before they expire. Returns None on failure.
+    """
+    refresh_cutoff = pd.Timestamp.now(tz='UTC') + pd.Timedelta(days=METRIC_EXPIRY_REFRESH_DAYS)
+    existing_hashes = {}
+    offset = 0
+    while True:
+        try:
+            hash_response = supabase.table('safety_metrics') \
+                                    .select('id, content_hash, expires_at') \
+                                    .eq('city_id', target_city_id) \
+                                    .order('id') \
+                                    .limit(METRIC_HASH_FETCH_BATCH_SIZE) \
+                                    .offset(offset) \
+                                    .execute()
+        except Exception as e:
+            logger.error(f"Error fetching existing metric hashes for city ID {target_city_id}: {e}", exc_info=False)
+            return None
+        if hasattr(hash_response, 'error') and hash_response.error:
+            logger.error(f"Error fetching existing metric hashes for city ID {target_city_id}: {hash_response.error}")
+            return None
+
+        rows = hash_response.data or []
+        if rows:
+            page = pd.DataFrame(rows, columns=['id', 'content_hash', 'expires_at'])
+            expiring = pd.to_datetime(page['expires_at'], utc=True, format='ISO8601', errors='coerce') < refresh_cutoff
+            existing_hashes.update((metric_id, None if expires_soon else content_hash) for metric_id, content_hash, expires_soon
+                                   in zip(page['id'], page['content_hash'], expiring))
+        if len(rows) < METRIC_HASH_FETCH_BATCH_SIZE:
+            break
+        offset += METRIC_HASH_FETCH_BATCH_SIZE
+
+    logger.info(f"Fetched {len(existing_hashes):,} existing metric hashes for city ID {target_city_id}.")
+    return existing_hashes
+
+def iter_changed_metric_records(metric_records, existing_hashes: dict, seen_ids: set):
+    """
+    Sets 'content_hash' on each record and yields only records that are new or whose hash
+    differs from existing_hashes. Every record id is added to seen_ids.
+    """
+    for record in metric_records:
+        record['content_hash'] = metric_content_hash(record)
+        seen_ids.add(record['id'])
+        if existing_hashes.get(record['id']) != record['content_hash']:
+            yield record
+
+def iter_metric_batches(metric_records, max_rows: int, max_bytes: int | None = None):
+    """
+    Groups records into numbered (batch_number, records) batches of at most max_rows records and,
+    with max_bytes, at most max_bytes of JSON payload (a larger single record goes alone).
+    """
+    batch, batch_bytes, batch_number = [], 0, 0
+    for record in metric_records:
+        record_bytes = len(json.dumps(record, separators=(',', ':'))) + 1 if max_bytes else 0
+        if batch and (len(batch) >= max_rows or (max_bytes and batch_bytes + record_bytes > max_bytes)):
+            batch_number += 1
+            yield batch_number, batch
+            batch, batch_bytes = [], 0
+        batch.append(record)
+        batch_bytes += record_bytes
+    if batch:
+        yield batch_number + 1, batch
+
+def is_metric_data_error(write_error) -> bool:
+    """True for errors caused by the rows themselves (bad values, constraint violations), which retrying cannot fix."""
+    code = str(getattr(write_error, 'code', '') or '')
+    return code[:2] in METRIC_DATA_ERROR_CLASSES
+
+def apply_column_defaults(write_query, records: list, default_columns) -> object:
+    """
+    Makes a PostgREST insert/upsert write default_columns, which the records leave out, as their
+    column defaults: sends Prefer: missing=default and adds them to the ?columns= list (which
+    also makes an upsert set them on existing rows). Returns write_query.
+    """
+    if not default_columns:
+        return write_query
+    request = getattr(write_query, 'request', write_query) # Older postgrest clients keep params/headers on the builder
+    columns = dict.fromkeys(key for record in records for key in record)
+    columns.update(dict.fromkeys(default_columns))
+    request.params = request.params.set('columns', ','.join(f'"{column}"' for column in columns))
+    prefer = request.headers.get('Prefer')
+    request.headers['Prefer'] = f"{prefer},missing=default" if prefer else "missing=default"
+    return write_query
+
+def write_metric_batch(records: list, upload_mode: str, city_name: str, retry: bool = False, depth: int = 0,
+                       default_columns: tuple = ()) -> tuple:
+    """
+    Inserts (upload_mode 'replace') or upserts records in one request. Transient failures
+    (timeouts, rate limits, server errors) are retried up to METRIC_WRITE_MAX_RETRIES times
+    with exponential backoff. A batch rejected for bad data is retried as two halves, at most
+    METRIC_WRITE_MAX_BISECT_DEPTH levels deep, so a bad row loses as few others as possible.
+    Retries always upsert so rows committed by a request that errored afterwards are not duplicated.
+    default_columns are left out of the records and written as column defaults (slim payloads).
+    Returns (written, failed) record counts.
+    """
+    for attempt in range(1, METRIC_WRITE_MAX_RETRIES + 1):
+        try:
+            if upload_mode == 'replace' and not retry:
+                write_query = supabase.table('safety_metrics').insert(records, count='exact')
+            else:
+                write_query = supabase.table('safety_metrics').upsert(records, count='exact', on_conflict='id')
+            write_response = apply_column_defaults(write_query, records, default_columns).execute()
+
+            if hasattr(write_response, 'error') and write_response.error:
+                write_error = write_response.error
+            elif hasattr(write_response, 'count') and write_response.count is not None:
+                written = write_response.count
+                if written < len(records):
+                    logger.warning(f"Metrics write for {city_name} partially failed. Succeeded: {written}, Failed: {len(records) - written}. Check DB logs for constraint violations.")
+                return written, len(records) - written
+            else:
+                write_error = "no error and no count returned"
+        except APIError as api_err:
+            write_error = api_err
+        except Exception as e:
+            write_error = e
+
+        if is_metric_data_error(write_error):
+            break
+        retry = True
+        if attempt == METRIC_WRITE_MAX_RETRIES:
+            logger.error(f"Giving up on {len(records)} metrics for {city_name} after {METRIC_WRITE_MAX_RETRIES} attempts: {write_error}")
+            return 0, len(records)
+        logger.warning(f"Write of {len(records)} metrics for {city_name} failed (attempt {attempt}/{METRIC_WRITE_MAX_RETRIES}): {write_error}")
+        time.sleep(2 ** attempt)
+
+    if len(records) == 1 or depth >= METRIC_WRITE_MAX_BISECT_DEPTH:
+        logger.error(f"Could not write {len(records)} metric(s) for {city_name} starting at {records[0].get('id')}: {write_error}")
+        return 0, len(records)
+    logger.warning(f"Write of {len(records)} metrics for {city_name} was rejected ({write_error}); retrying as two halves.")
+    middle = len(records) // 2
+    written_left, failed_left = write_metric_batch(records[:middle], upload_mode, city_name, retry=True, depth=depth + 1,
+                                                   default_columns=default_columns)
+    written_right, failed_right = write_metric_batch(records[middle:], upload_mode, city_name, retry=True, depth=depth + 1,
+                                                     default_columns=default_columns)
+    return written_left + written_right, failed_left + failed_right
+
+def slim_metric_records(metric_records):
+    """
+    Yields records without SLIM_METRIC_OMITTED_FIELDS and SLIM_METRIC_DEFAULTED_FIELDS. Writers
+    list the defaulted fields as columns to fill from the column defaults (see apply_column_defaults),
+    so an upsert that rewrites an existing row refreshes them too.
+    """
+    omitted_fields = SLIM_METRIC_OMITTED_FIELDS + SLIM_METRIC_DEFAULTED_FIELDS
+    for record in metric_records:
+        yield {key: value for key, value in record.items() if key not in omitted_fields}
+
+def sync_metric_questions(metrics_by_type: dict) -> bool:
+    """
+    Upserts each metric type's question into 'safety_metric_questions', the dictionary the
+    safety_metrics trigger fills omitted questions from. Returns True on success.
+    """
+    questions = {}
+    for metric_type, metrics in metrics_by_type.items():
+        if isinstance(metrics, MetricColumns):
+            questions[metric_type] = metrics.constants['question']
+        elif metrics:
+            questions[metric_type] = metrics[0]['question']
+    if not questions:
+        return True
+    try:
+        response = supabase.table('safety_metric_questions').upsert(
+            [{'metric_type': metric_type, 'question': question} for metric_type, question in questions.items()],
+            on_conflict='metric_type').execute()
+        if hasattr(response, 'error') and response.error:
+            logger.error(f"Error syncing metric questions: {response.error}")
+            return False
+    except Exception as e:
+        logger.error(f"Error syncing metric questions: {e}", exc_info=False)
+        return False
+    logger.info(f"Synced questions for {len(questions)} metric types.")
+    return True
+
+def copy_metrics_to_postgres(metrics_by_type: dict, target_city_id: int, upload_mode: str, city_name: str,
+                             metric_payload: str = 'full') -> tuple:
+    """
+    Streams all metric records with COPY into a staging table over a direct Postgres connection
+    and merges them into 'safety_metrics' in one transaction (see postgres_bulk_load), so the
+    city never appears without metrics. upload_mode and metric_payload are as in upload_metrics;
+    in 'diff' mode the content hashes are compared in SQL. Returns (written, failed); a failed
+    load writes nothing.
+    """
+    total_metrics = sum(len(metrics) for metrics in metrics_by_type.values() if metrics is not None)
+    metric_records = iter_metric_records(metrics_by_type)
+    if upload_mode == 'diff':
+        metric_records = (dict(record, content_hash=metric_content_hash(record)) for record in metric_records)
+    if metric_payload == 'slim':
+        metric_records = slim_metric_records(metric_records)
+    first_record = next(metric_records)
+    city_filter = {'city_id': target_city_id}
+
+    logger.info(f"Loading {total_metrics:,} metrics for {city_name} with COPY ({upload_mode})...")
+    try:
+        with connect_database() as conn:
+            load_result = bulk_load(
+                conn, 'safety_metrics', itertools.chain([first_record], metric_records), list(first_record),
+                replace_where=city_filter if upload_mode == 'replace' else None,
+                delete_missing_where=city_filter if upload_mode == 'diff' else None,
+                default_columns=list(SLIM_METRIC_DEFAULTED_FIELDS) if metric_payload == 'slim' else None,
+                update_when=("safety_metrics.content_hash IS DISTINCT FROM EXCLUDED.content_hash "
+                             f"OR safety_metrics.expires_at < now() + interval '{METRIC_EXPIRY_REFRESH_DAYS} days'") if upload_mode == 'diff' else None
+            )
+    except Exception as e:
+        logger.error(f"COPY load of safety metrics for {city_name} failed and was rolled back: {e}", exc_info=True)
+        return 0, total_metrics
+
+    logger.info(f"Finished metrics COPY load for {city_name}. Total Written: {load_result['written']:,}, Deleted: {load_result['deleted']:,}")
+    return load_result['written'], 0
+
+def upload_metrics(metrics_by_type: dict, target_city_id: int, test_mode: bool, upload_mode: str = 'replace',
+                   upload_engine: str = 'serial', metric_payload: str = 'full') -> tuple:
     """
     Uploads the calculated safety metrics to the Supabase 'safety_metrics' table.
-    In production mode, it first deletes existing metrics for the city.
+    upload_mode selects how existing rows are handled in production mode:
+    - 'replace': deletes all existing metrics for the city, then inserts every record.
+    - 'upsert': upserts every record by id and leaves other rows alone (incremental updates).
+    - 'diff': content-hashes each record, upserts only new or changed records and deletes
+      ids that are no longer produced. Unchanged rows keep their created_at/expires_at.
+    upload_engine 'serial' (default) sends METRIC_UPLOAD_BATCH_SIZE-row batches one by one;
+    'concurrent' (opt-in) sends payload-sized batches METRIC_UPLOAD_MAX_WORKERS at a time.
+    Transient write errors are retried with backoff; batches rejected for bad data are bisected.
+    'copy' bypasses PostgREST and COPY-loads everything in one transaction (copy_metrics_to_postgres).
+    metric_payload 'slim' omits geom and sends question/created_at/expires_at as NULL in every
+    record (derived by the database trigger); content hashes still cover the full record.
     In test mode, it skips all database operations.
+    Returns (inserted, failed) record counts.
     """
     # Ensure Supabase client is available
     if not supabase:
         logger.error("Supabase client not available for uploading metrics.")
-        return
+        return 0, 0
         
-    # Aggregate all metric records from the input dictionary
-    all_metrics = []
-    for metric_type, metrics_list in metrics_by_type.items():
-        if metrics_list:
-            all_metrics.extend(metrics_list)
-
-    total_metrics = len(all_metrics)
+    # Count metric records across types; columnar metrics are serialized lazily, batch by batch
+    total_metrics = sum(len(metrics) for metrics in metrics_by_type.values() if metrics is not None)
     logger.info(f"Preparing to upload {total_metrics:,} total calculated metrics for city ID {target_city_id}.")
 
     if total_metrics == 0:
         logger.info("No metrics generated, nothing to upload.")
         # Optional: Decide if we should still delete old metrics even if no new ones were generated.
         # For now, we only delete if there are new metrics to insert.
-        return
+        return 0, 0
 
     # --- Test Mode Check ---
     if test_mode:
-        logger.info(f"[TEST MODE] Would upload {total_metrics:,} metrics. Skipping database operations.")
+        logger.info(f"[TEST MODE] Would upload {total_metrics:,} metrics ({upload_mode}). Skipping database operations.")
         # Optionally, log a sample of metrics that would be uploaded:
-        # if all_metrics:
-        #    logger.debug(f"[TEST MODE] Sample metric record to be uploaded:\n{json.dumps(all_metrics[0], indent=2)}")
-        return
+        # logger.debug(f"[TEST MODE] Sample metric record to be uploaded:\n{json.dumps(next(iter_metric_records(metrics_by_type, 1)), indent=2)}")
+        return 0, 0
 
-    # --- Production Mode: Delete and Upload ---
+    # --- Production Mode: Delete (or Upsert) and Upload ---
     city_name = "Unknown City" # Default
     try:
          # Fetch city name for logging clarity
@@ -956,73 +3417,120 @@ def upload_metrics(metrics_by_type: dict, target_city_id: int, test_mode: bool):
          logger.warning(f"Could not fetch city name for ID {target_city_id}: {city_fetch_err}")
          city_name = f'ID {target_city_id}'
 
-    # 1. Delete existing metrics for the target city
-    try:
-        logger.info(f"Deleting existing safety metrics for {city_name} (ID: {target_city_id})...")
-        delete_response = supabase.table('safety_metrics').delete().eq('city_id', target_city_id).execute()
-        
-        # Supabase delete response doesn't reliably give counts, check for errors
-        if hasattr(delete_response, 'error') and delete_response.error:
-             logger.error(f"Error deleting existing metrics for {city_name}: {delete_response.error}")
-             logger.warning("Aborting upload due to delete failure.")
-             return # Stop if delete fails
-        else:
-             # Log success, actual count deleted isn't easily available without another query
-             logger.info(f"Successfully sent delete request for existing metrics for {city_name}.")
+    if metric_payload == 'slim' and not sync_metric_questions(metrics_by_type):
+        logger.warning(f"Could not sync metric questions for {city_name}; sending full metric payloads.")
+        metric_payload = 'full'
 
-    except APIError as api_err:
-        logger.error(f"APIError during delete operation for {city_name}: {api_err}", exc_info=False)
-        logger.warning("Aborting upload due to delete failure.")
-        return
-    except Exception as del_err:
-        logger.error(f"Unexpected error during delete operation for {city_name}: {del_err}", exc_info=True)
-        logger.warning("Aborting upload due to delete failure.")
-        return
+    if upload_engine == 'copy':
+        return copy_metrics_to_postgres(metrics_by_type, target_city_id, upload_mode, city_name, metric_payload)
 
-    # 2. Insert new metrics in batches
-    total_inserted = 0
-    total_failed_records = 0
-    total_batches = math.ceil(total_metrics / METRIC_UPLOAD_BATCH_SIZE)
-    logger.info(f"Starting batch inserts for {total_metrics} new metrics in {total_batches} batches (size {METRIC_UPLOAD_BATCH_SIZE})...")
+    existing_hashes = None
+    if upload_mode == 'diff':
+        existing_hashes = fetch_existing_metric_hashes(target_city_id)
+        if existing_hashes is None:
+            # Upsert keeps existing rows if the write fails partway; stale ids are left for the next diff run
+            logger.warning(f"Could not fetch existing metric hashes for {city_name}; falling back to upserting every metric.")
+            upload_mode = 'upsert'
 
-    for i in range(0, total_metrics, METRIC_UPLOAD_BATCH_SIZE):
-        batch = all_metrics[i:i + METRIC_UPLOAD_BATCH_SIZE]
-        batch_number = (i // METRIC_UPLOAD_BATCH_SIZE) + 1
-        logger.info(f"Inserting metrics batch {batch_number}/{total_batches} ({len(batch)} records) for {city_name}.")
-        
+    # 1. Delete existing metrics for the target city (upsert and diff modes keep them)
+    if upload_mode == 'replace':
         try:
-            insert_response = supabase.table('safety_metrics').insert(batch, count='exact').execute() # Use count='exact'
-            
-            # Check for API level errors first
-            if hasattr(insert_response, 'error') and insert_response.error:
-                logger.error(f"APIError on insert batch {batch_number} for {city_name}: {insert_response.error}")
-                total_failed_records += len(batch) # Assume whole batch failed on API error
-            # Check the count returned by the API
-            elif hasattr(insert_response, 'count') and insert_response.count is not None:
-                 inserted_in_batch = insert_response.count
-                 total_inserted += inserted_in_batch
-                 failed_in_batch = len(batch) - inserted_in_batch
-                 if failed_in_batch > 0:
-                      total_failed_records += failed_in_batch
-                      logger.warning(f"Batch {batch_number} partially failed for {city_name}. Succeeded: {inserted_in_batch}, Failed: {failed_in_batch}. Check DB logs for constraint violations.")
-                 # else: logger.debug(f"Batch {batch_number} inserted successfully ({inserted_in_batch} records).") # Optional debug
+            logger.info(f"Deleting existing safety metrics for {city_name} (ID: {target_city_id})...")
+            delete_response = supabase.table('safety_metrics').delete().eq('city_id', target_city_id).execute()
+        
+            # Supabase delete response doesn't reliably give counts, check for errors
+            if hasattr(delete_response, 'error') and delete_response.error:
+                 logger.error(f"Error deleting existing metrics for {city_name}: {delete_response.error}")
+                 logger.warning("Aborting upload due to delete failure.")
+                 return 0, total_metrics # Stop if delete fails
             else:
-                 # If no error and no count, it's an unexpected response
-                 logger.warning(f"Batch {batch_number} for {city_name} returned no error and no count. Assuming failure for {len(batch)} records.")
-                 total_failed_records += len(batch)
+                 # Log success, actual count deleted isn't easily available without another query
+                 logger.info(f"Successfully sent delete request for existing metrics for {city_name}.")
 
         except APIError as api_err:
-             logger.error(f"APIError during insert batch {batch_number} for {city_name}: {api_err}", exc_info=False)
-             total_failed_records += len(batch) # Assume whole batch failed
-        except Exception as e:
-            logger.error(f"Unexpected error during insert batch {batch_number} for {city_name}: {e}", exc_info=True)
-            total_failed_records += len(batch)
-        
-        time.sleep(0.1) # Small delay between batches
+            logger.error(f"APIError during delete operation for {city_name}: {api_err}", exc_info=False)
+            logger.warning("Aborting upload due to delete failure.")
+            return 0, total_metrics
+        except Exception as del_err:
+            logger.error(f"Unexpected error during delete operation for {city_name}: {del_err}", exc_info=True)
+            logger.warning("Aborting upload due to delete failure.")
+            return 0, total_metrics
+
+    # 2. Write new metrics in batches (diff mode only sends new or changed records)
+    metric_records = iter_metric_records(metrics_by_type)
+    if upload_mode == 'diff':
+        seen_ids = set()
+        metric_records = iter_changed_metric_records(metric_records, existing_hashes, seen_ids)
+    if metric_payload == 'slim':
+        metric_records = slim_metric_records(metric_records)
+    if upload_engine == 'concurrent':
+        metric_batches = iter_metric_batches(metric_records, METRIC_UPLOAD_MAX_BATCH_ROWS, METRIC_UPLOAD_TARGET_BYTES)
+        max_workers = METRIC_UPLOAD_MAX_WORKERS
+        logger.info(f"Starting concurrent batch {'inserts' if upload_mode == 'replace' else 'upserts'} for {total_metrics:,} new metrics "
+                    f"(~{METRIC_UPLOAD_TARGET_BYTES // 1024} KB / at most {METRIC_UPLOAD_MAX_BATCH_ROWS} rows per request, {max_workers} concurrent)...")
+    else:
+        metric_batches = iter_metric_batches(metric_records, METRIC_UPLOAD_BATCH_SIZE)
+        max_workers = 1
+        logger.info(f"Starting batch {'inserts' if upload_mode == 'replace' else 'upserts'} for {total_metrics:,} new metrics in up to {math.ceil(total_metrics / METRIC_UPLOAD_BATCH_SIZE)} batches (size {METRIC_UPLOAD_BATCH_SIZE})...")
+
+    def write_batch(batch: tuple) -> tuple:
+        batch_number, records = batch
+        written, failed = write_metric_batch(records, upload_mode, city_name,
+                                             default_columns=SLIM_METRIC_DEFAULTED_FIELDS if metric_payload == 'slim' else ())
+        if upload_engine == 'serial':
+            time.sleep(0.1) # Small delay between batches
+        return batch_number, len(records), written, failed
+
+    total_inserted = 0
+    total_failed_records = 0
+    total_written = 0
+    start = time.perf_counter()
+    for batch_number, batch_size, written, failed in ordered_parallel_map(write_batch, metric_batches, max_workers):
+        total_written += batch_size
+        total_inserted += written
+        total_failed_records += failed
+        logger.info(f"Wrote metrics batch {batch_number} ({batch_size} records, {failed} failed) for {city_name}. Sent {total_written:,}/{total_metrics:,}.")
+    elapsed = time.perf_counter() - start
+    logger.info(f"Sent {total_written:,} metrics in {elapsed:.1f}s ({total_written / elapsed if elapsed > 0 else 0:,.0f} rows/s).")
+
+    # 3. Diff mode: report unchanged records and delete ids that are no longer produced
+    if upload_mode == 'diff':
+        logger.info(f"Skipped {total_metrics - total_written:,} unchanged metrics for {city_name}.")
+        vanished_ids = [metric_id for metric_id in existing_hashes if metric_id not in seen_ids]
+        total_failed_records += delete_metrics(vanished_ids, target_city_id, test_mode)
 
     logger.info(f"Finished metrics upload for {city_name}. Total Inserted: {total_inserted:,}, Total Failed: {total_failed_records:,}")
     if total_failed_records > 0:
          logger.warning("Some metric records failed to insert. Review logs and potential DB constraint issues.")
+    return total_inserted, total_failed_records
+
+def delete_metrics(metric_ids: list, target_city_id: int, test_mode: bool) -> int:
+    """
+    Deletes 'safety_metrics' rows by id (metrics whose blocks no longer have incidents
+    after an incremental update). Returns the number of ids that could not be deleted.
+    """
+    if not metric_ids:
+        return 0
+    if test_mode:
+        logger.info(f"[TEST MODE] Would delete {len(metric_ids):,} metrics that no longer have incidents. Skipping database operations.")
+        return 0
+    if not supabase:
+        logger.error("Supabase client not available for deleting metrics.")
+        return len(metric_ids)
+
+    failed = 0
+    for i in range(0, len(metric_ids), METRIC_UPLOAD_BATCH_SIZE):
+        batch_ids = metric_ids[i:i + METRIC_UPLOAD_BATCH_SIZE]
+        try:
+            delete_response = supabase.table('safety_metrics').delete().eq('city_id', target_city_id).in_('id', batch_ids).execute()
+            if hasattr(delete_response, 'error') and delete_response.error:
+                logger.error(f"Error deleting metrics batch for city ID {target_city_id}: {delete_response.error}")
+                failed += len(batch_ids)
+        except Exception as e:
+            logger.error(f"Error deleting metrics batch for city ID {target_city_id}: {e}", exc_info=False)
+            failed += len(batch_ids)
+    logger.info(f"Deleted {len(metric_ids) - failed:,} metrics that no longer have incidents (failed: {failed:,}).")
+    return failed
 
 def update_accommodation_safety_scores(supabase_client: Client, target_city_id: int):
     """
@@ -1452,11 +3960,31 @@ def update_accommodation_safety_scores(supabase_client: Client, target_city_id:
 
 
 # --- Main Execution Logic ---
-def main(target_city_id: int, test_mode: bool):
+def main(target_city_id: int, test_mode: bool, fetch_mode: str = 'single', stream: bool = False, incremental: bool = False,
+         cache_ttl_hours: float | None = None, max_cache_mb: float = CRIME_CACHE_DEFAULT_MAX_MB, pushdown: bool = False,
+         aggregate: bool = False, mapping_engine: str = 'rpc', block_memo: bool = True, chunked: bool = False,
+         neighbor_engine: str = 'rpc', cache_neighbors: bool = True, scoring_engine: str = 'loop',
+         metric_output: str = 'records', temporal_cube: bool = False, incremental_metrics: bool = False,
+         upload_mode: str = 'replace', upload_engine: str = 'serial', metric_payload: str = 'full',
+         from_cube: bool = False, cube_months: tuple | None = None, pushdown_report: bool = False):
     start_time = datetime.now(timezone.utc)
     logger.info(f"====== Starting Safety Metrics Processing run at {start_time.isoformat()} ======")
     logger.info(f"Mode: {'TEST' if test_mode else 'PRODUCTION'}")
     logger.info(f"Target City ID: {target_city_id}")
+    logger.info(f"Fetch Mode: {'saved temporal cube (no fetch)' if from_cube else 'windowed (chunked)' if chunked else 'windowed (streaming)' if stream else fetch_mode}{' (incremental)' if incremental else ' (incremental metric counters)' if incremental_metrics else ''}")
+    if cache_ttl_hours:
+        logger.info(f"Socrata Pull Cache: TTL {cache_ttl_hours}h, max {max_cache_mb:,.0f} MB")
+    logger.info(f"Query Pushdown: {'enabled' if pushdown else 'disabled'}{' (with savings report)' if pushdown and pushdown_report else ''}")
+    logger.info(f"Server-side Aggregation: {'enabled' if aggregate else 'disabled'}")
+    logger.info(f"Census Block Mapping Engine: {mapping_engine} (coordinate memo {'enabled' if block_memo else 'disabled'})")
+    logger.info(f"Neighbor Engine: {neighbor_engine} (adjacency cache {'enabled' if cache_neighbors else 'disabled'})")
+    cache_writes = not test_mode # Test runs read the coordinate memo and neighbor cache but never write them
+    if test_mode and (block_memo or cache_neighbors):
+        logger.info("[TEST MODE] Coordinate memo and neighbor cache are read-only.")
+    logger.info(f"Scoring Engine: {scoring_engine} ({metric_output} metric output)")
+    logger.info(f"Upload Mode: {upload_mode} ({upload_engine} upload engine, {metric_payload} metric payloads)")
+    if temporal_cube:
+        logger.info(f"Temporal Cube: {'not built in chunked or incremental metrics mode' if chunked or incremental_metrics else 'enabled'}")
 
     if not supabase:
         logger.critical("Supabase client not initialized. Exiting.")
@@ -1473,31 +4001,122 @@ def main(target_city_id: int, test_mode: bool):
         days_back = 300 if test_mode else 800 # Example: 30 days for test, 800 for prod
         max_records = 5000 if test_mode else 500000 # Example: 5k for test, 500k for prod
         logger.info(f"Run Parameters: days_back={days_back}, max_records={max_records:,}")
+        if pushdown and pushdown_report:
+            report_city_pushdown_savings(city_config, days_back)
 
         # 2. Fetch Crime Data
-        logger.info(f"\n--- STEP 2: Fetching Crime Data for {city_name} ---")
-        raw_crime_data = fetch_crime_data(city_config, days_back=days_back, max_records=max_records)
-        if not raw_crime_data:
-            logger.warning(f"No crime data fetched for {city_name}. Pipeline stopped.")
-            return # Exit gracefully if no data
-
-        logger.info(f"Fetched {len(raw_crime_data):,} raw crime records.")
-
-        # 3. Process Crime Data
-        logger.info(f"\n--- STEP 3: Processing and Mapping Crime Data ---")
-        processed_df = process_crime_data(raw_crime_data, city_config)
-        del raw_crime_data # Free memory
-
-        if processed_df is None or processed_df.empty:
-            logger.error(f"Crime data processing failed or yielded no results for {city_name}. Pipeline stopped.")
-            return
-
-        logger.info(f"Processed data yielded {len(processed_df):,} records for metric calculation.")
-
-        # 4. Calculate Safety Metrics
-        logger.info(f"\n--- STEP 4: Calculating Safety Metrics ---")
-        metrics_by_type = calculate_metrics(processed_df, target_city_id, city_config)
-        del processed_df # Free memory
+        counter_update = None
+        if from_cube:
+            # 2+3+4a. Slice per-block metric counts for the month window out of the saved cube
+            logger.info(f"\n--- STEP 2/3: Slicing Saved Temporal Cube for {city_name} ---")
+            census_version = get_census_version(target_city_id)
+            if census_version is None:
+                logger.error(f"Cannot check the temporal cube of {city_name} against its census data: version unavailable. Pipeline stopped.")
+                return
+            cube = load_temporal_cube(target_city_id, census_version)
+            if cube is None:
+                logger.error(f"No temporal cube saved for {city_name} and its current census data; run once with --temporal-cube first. Pipeline stopped.")
+                return
+            first_month, last_month = cube_months or (None, None)
+            months = cube_months_between(cube, first_month, last_month)
+            if not months:
+                logger.error(f"The temporal cube for {city_name} has no months between {first_month or 'start'} and {last_month or 'end'}. Pipeline stopped.")
+                return
+            logger.info(f"Scoring {len(months)} cube months ({months[0]} to {months[-1]}).")
+            metric_partials = metric_partials_from_cube(cube, months=months)
+            del cube
+
+            # 4. Calculate Safety Metrics
+            logger.info(f"\n--- STEP 4: Calculating Safety Metrics ---")
+            metrics_by_type = calculate_metrics_from_partials(metric_partials, target_city_id, city_config,
+                                                              neighbor_engine=neighbor_engine, cache_neighbors=cache_neighbors,
+                                                              scoring_engine=scoring_engine, metric_output=metric_output,
+                                                              cache_writes=cache_writes)
+            del metric_partials # Free memory
+        elif incremental_metrics:
+            # 2+3+4a. Count only new days into the daily metric buckets and diff against the previous run
+            logger.info(f"\n--- STEP 2/3: Incremental Fetching and Counting of Crime Data for {city_name} ---")
+            counter_update = prepare_metric_counter_update(city_config, target_city_id, days_back=days_back, max_records=max_records,
+                                                           fetch_mode=fetch_mode, pushdown=pushdown, mapping_engine=mapping_engine,
+                                                           block_memo=block_memo, cache_writes=cache_writes)
+            if counter_update is None:
+                logger.error(f"Incremental metric counting failed for {city_name}. Pipeline stopped.")
+                return
+
+            # 4. Calculate Safety Metrics (changed blocks only, unless the counters were rebuilt)
+            logger.info(f"\n--- STEP 4: Calculating Safety Metrics ---")
+            metrics_by_type = calculate_metrics_from_partials(counter_update['metric_partials'], target_city_id, city_config,
+                                                              neighbor_engine=neighbor_engine, cache_neighbors=cache_neighbors,
+                                                              scoring_engine=scoring_engine, metric_output=metric_output,
+                                                              changed_partials=None if counter_update['full_refresh'] else counter_update['changed_partials'],
+                                                              cache_writes=cache_writes)
+        elif chunked:
+            # 2+3+4a. Map each date window and reduce it to per-block metric counts right away
+            logger.info(f"\n--- STEP 2/3: Chunked Fetching, Mapping and Reducing Crime Data for {city_name} ---")
+            raw_pages = iter_crime_data_pages(city_config, days_back=days_back, max_records=max_records, pushdown=pushdown, aggregate=aggregate)
+            metric_partials = process_crime_chunks(raw_pages, city_config, target_city_id, mapping_engine=mapping_engine,
+                                                   block_memo=block_memo, cache_writes=cache_writes)
+            if metric_partials is None or metric_partials.empty:
+                logger.error(f"Chunked crime data processing failed or yielded no results for {city_name}. Pipeline stopped.")
+                return
+
+            # 4. Calculate Safety Metrics
+            logger.info(f"\n--- STEP 4: Calculating Safety Metrics ---")
+            metrics_by_type = calculate_metrics_from_partials(metric_partials, target_city_id, city_config,
+                                                              neighbor_engine=neighbor_engine, cache_neighbors=cache_neighbors,
+                                                              scoring_engine=scoring_engine, metric_output=metric_output,
+                                                              cache_writes=cache_writes)
+            del metric_partials # Free memory
+        else:
+            if stream:
+                # 2+3. Stream pages straight through standardization into column buffers
+                logger.info(f"\n--- STEP 2/3: Streaming, Processing and Mapping Crime Data for {city_name} ---")
+                raw_pages = iter_crime_data_pages(city_config, days_back=days_back, max_records=max_records, pushdown=pushdown, aggregate=aggregate)
+                processed_df = process_crime_stream(raw_pages, city_config, mapping_engine=mapping_engine, block_memo=block_memo,
+                                                    cache_writes=cache_writes)
+            else:
+                logger.info(f"\n--- STEP 2: Fetching Crime Data for {city_name} ---")
+                if incremental:
+                    raw_crime_data = fetch_crime_data_incremental(city_config, days_back=days_back, max_records=max_records, fetch_mode=fetch_mode,
+                                                                  cache_ttl_hours=cache_ttl_hours, max_cache_mb=max_cache_mb, pushdown=pushdown)
+                else:
+                    raw_crime_data = fetch_crime_data(city_config, days_back=days_back, max_records=max_records, fetch_mode=fetch_mode,
+                                                      cache_ttl_hours=cache_ttl_hours, max_cache_mb=max_cache_mb, pushdown=pushdown,
+                                                      aggregate=aggregate)
+                if len(raw_crime_data) == 0:
+                    logger.warning(f"No crime data fetched for {city_name}. Pipeline stopped.")
+                    return # Exit gracefully if no data
+
+                logger.info(f"Fetched {len(raw_crime_data):,} raw crime records.")
+
+                # 3. Process Crime Data
+                logger.info(f"\n--- STEP 3: Processing and Mapping Crime Data ---")
+                processed_df = process_crime_data(raw_crime_data, city_config, mapping_engine=mapping_engine, block_memo=block_memo,
+                                                  cache_writes=cache_writes)
+                del raw_crime_data # Free memory
+
+            if processed_df is None or processed_df.empty:
+                logger.error(f"Crime data processing failed or yielded no results for {city_name}. Pipeline stopped.")
+                return
+
+            logger.info(f"Processed data yielded {len(processed_df):,} records for metric calculation.")
+
+            if temporal_cube:
+                census_version = get_census_version(target_city_id)
+                cube = build_temporal_cube(processed_df, target_city_id, city_config) if census_version else None
+                if cube is not None:
+                    save_temporal_cube(target_city_id, census_version, cube)
+                elif census_version is None:
+                    logger.warning(f"Temporal cube not saved for {city_name}: census data version unavailable.")
+                del cube
+
+            # 4. Calculate Safety Metrics
+            logger.info(f"\n--- STEP 4: Calculating Safety Metrics ---")
+            metrics_by_type = calculate_metrics(processed_df, target_city_id, city_config,
+                                                neighbor_engine=neighbor_engine, cache_neighbors=cache_neighbors,
+                                                scoring_engine=scoring_engine, metric_output=metric_output,
+                                                cache_writes=cache_writes)
+            del processed_df # Free memory
         total_metrics = sum(len(m) for m in metrics_by_type.values())
 
         if total_metrics == 0:
@@ -1508,7 +4127,19 @@ def main(target_city_id: int, test_mode: bool):
 
         # 5. Upload Metrics
         logger.info(f"\n--- STEP 5: Uploading Safety Metrics ---")
-        upload_metrics(metrics_by_type, target_city_id=target_city_id, test_mode=test_mode)
+        if counter_update is not None and not counter_update['full_refresh']:
+            upload_mode = 'upsert' # Only rescored blocks are sent; removed ids are deleted below
+        _, failed_uploads = upload_metrics(metrics_by_type, target_city_id=target_city_id, test_mode=test_mode,
+                                           upload_mode=upload_mode, upload_engine=upload_engine, metric_payload=metric_payload)
+        if counter_update is not None:
+            failed_uploads += delete_metrics(counter_update['removed_metric_ids'], target_city_id, test_mode)
+            if test_mode:
+                logger.info("[TEST MODE] Not saving metric counters.")
+            elif failed_uploads > 0:
+                # The next run diffs against the previous counters again and re-sends these changes
+                logger.warning(f"{failed_uploads:,} metric writes failed; metric counters were not advanced.")
+            else:
+                save_metric_counters(target_city_id, counter_update['dataset_id'], counter_update['buckets'], counter_update['state'])
 
         # 6. Update Accommodation Scores
         logger.info(f"\n--- STEP 6: Updating Accommodation Scores ---")
@@ -1537,6 +4168,48 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Process safety metrics for a specific city (Refactored Version).")
     parser.add_argument("--city-id", type=int, required=True, help="The ID of the city to process (from the 'cities' table).")
     parser.add_argument("--test-mode", action="store_true", help="Run in test mode (uses smaller dataset parameters, skips database writes).")
+    parser.add_argument("--fetch-mode", choices=['single', 'windowed', 'csv'], default='single', help="How to download crime data: one request ('single'), parallel paged date windows ('windowed') or the streamed bulk CSV export ('csv').")
+    ingestion_group = parser.add_mutually_exclusive_group()
+    ingestion_group.add_argument("--stream", action="store_true", help="Stream date windows page by page through processing into typed column buffers (implies windowed fetching).")
+    ingestion_group.add_argument("--chunked", action="store_true", help="Out-of-core mode: map each date window and reduce it to per-block, per-metric counts before fetching the next (bounded memory for long histories).")
+    ingestion_group.add_argument("--incremental", action="store_true", help="Only fetch records newer than the local incident store's high-water mark and merge them in.")
+    ingestion_group.add_argument("--from-cube", action="store_true", help="Score from the temporal cube saved by an earlier --temporal-cube run instead of fetching crime data (see --cube-months).")
+    ingestion_group.add_argument("--incremental-metrics", action="store_true", help="Keep per-block metric counts in local daily buckets, fetch only new days, and rescore/upsert only blocks whose own or neighbors' counts changed.")
+    parser.add_argument("--cache-ttl-hours", type=float, default=None, help="Serve raw Socrata pulls from the local Parquet cache when younger than this many hours (disabled by default).")
+    parser.add_argument("--cache-max-mb", type=float, default=CRIME_CACHE_DEFAULT_MAX_MB, help=f"Size cap for the local pull cache before least recently used entries are evicted (default: {CRIME_CACHE_DEFAULT_MAX_MB} MB).")
+    parser.add_argument("--pushdown", action="store_true", help="Only request crime codes mapped in safety_metrics_config.json within the city bbox.")
+    parser.add_argument("--pushdown-report", action="store_true", help="With --pushdown, count the rows matching the window with and without the pushdown filters and log the rows avoided (two extra full-window count(*) queries).")
+    parser.add_argument("--aggregate", action="store_true", help="Ask Socrata for per-(code, hour, location) counts via $group and carry them as a 'weight' column.")
+    parser.add_argument("--mapping-engine", choices=['rpc', 'local'], default='rpc', help="Map incidents to census blocks with the 'match_points_to_block_groups_indexed' RPC ('rpc') or a local STRtree point-in-polygon over census_blocks geometries ('local').")
+    parser.add_argument("--no-block-memo", action="store_true", help="Do not read or write the on-disk coordinate -> census block memo (unique coordinates are still mapped once).")
+    parser.add_argument("--neighbor-engine", choices=['rpc', 'local'], default='rpc', help="Find block neighbors with the 'find_block_neighbors_batch' RPC ('rpc') or locally from census_blocks geometries within neighbor_radius_meters ('local').")
+    parser.add_argument("--scoring-engine", choices=['vectorized', 'loop'], default='loop', help="Score one block at a time ('loop', default) or all blocks of a metric with sparse matrix-vector products ('vectorized'); both give identical scores.")
+    parser.add_argument("--metric-output", choices=['columnar', 'records'], default='records', help="Build all metric record dicts up front ('records', default) or, with --scoring-engine vectorized, keep the results as columns serialized batch by batch at upload ('columnar').")
+    parser.add_argument("--temporal-cube", action="store_true", help="Save a block x metric x hour x month incident count cube (data/temporal_cube) after processing, so other time windows can be scored without reprocessing (not built with --chunked).")
+    parser.add_argument("--cube-months", nargs=2, metavar=('FIRST', 'LAST'), default=None, help="With --from-cube, only count incidents in months FIRST..LAST (inclusive, 'YYYY-MM').")
+    parser.add_argument("--no-neighbor-cache", action="store_true", help="Do not read or write the on-disk neighbor adjacency cache.")
+    parser.add_argument("--upload-mode", choices=['replace', 'diff'], default='replace', help="Delete all of the city's safety_metrics and reinsert them ('replace'), or compare content hashes and only upsert new or changed rows and delete vanished ids ('diff'; needs the content_hash column).")
+    parser.add_argument("--metric-payload", choices=['full', 'slim'], default='full', help="Send complete safety_metrics rows ('full'), or leave out geom, question, created_at and expires_at for the column defaults and database trigger to fill ('slim'; needs the safety_metric_questions migration).")
+    parser.add_argument("--upload-engine", choices=['serial', 'concurrent', 'copy'], default='serial', help=f"Write safety_metrics in {METRIC_UPLOAD_BATCH_SIZE}-row batches one at a time ('serial', default), or opt in to ~{METRIC_UPLOAD_TARGET_BYTES // 1024} KB batches sent {METRIC_UPLOAD_MAX_WORKERS} requests at a time ('concurrent'); transient errors are retried with backoff and batches rejected for bad data are retried in halves. 'copy' streams rows with COPY into a staging table and merges them in one transaction over a direct Postgres connection (needs psycopg and SUPABASE_DB_URL).")
     args = parser.parse_args()
-
-    main(target_city_id=args.city_id, test_mode=args.test_mode) 
\ No newline at end of file
+    if args.aggregate and (args.incremental or args.incremental_metrics):
+        # Aggregated rows are bucketed by month, which cannot be merged with the incident store's overlap window
+        parser.error("--aggregate cannot be combined with --incremental or --incremental-metrics.")
+    if args.cube_months and not args.from_cube:
+        parser.error("--cube-months requires --from-cube.")
+    if args.pushdown_report and not args.pushdown:
+        parser.error("--pushdown-report requires --pushdown.")
+    if args.from_cube and (args.temporal_cube or args.aggregate or args.pushdown):
+        parser.error("--from-cube does not fetch crime data and cannot be combined with --temporal-cube, --aggregate or --pushdown.")
+    if args.upload_engine == 'copy' and bulk_load_unavailable_reason():
+        parser.error(f"--upload-engine copy is unavailable: {bulk_load_unavailable_reason()}.")
+
+    main(target_city_id=args.city_id, test_mode=args.test_mode, fetch_mode=args.fetch_mode, stream=args.stream, incremental=args.incremental,
+         cache_ttl_hours=args.cache_ttl_hours, max_cache_mb=args.cache_max_mb, pushdown=args.pushdown,
+         aggregate=args.aggregate, mapping_engine=args.mapping_engine, block_memo=not args.no_block_memo, chunked=args.chunked,
+         neighbor_engine=args.neighbor_engine, cache_neighbors=not args.no_neighbor_cache,
+         scoring_engine=args.scoring_engine, metric_output=args.metric_output, temporal_cube=args.temporal_cube,
+         incremental_metrics=args.incremental_metrics, upload_mode=args.upload_mode,
+         upload_engine=args.upload_engine, metric_payload=args.metric_payload,
+         from_cube=args.from_cube, cube_months=tuple(args.cube_months) if args.cube_months else None,
+         pushdown_report=args.pushdown_report) 
\ No newline at end of file
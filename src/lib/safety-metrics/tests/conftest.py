@@ -0,0 +1,27 @@
+import os
+import sys
+
+# The processor creates its Supabase client at import time; tests replace it with fakes.FakeSupabase
+os.environ.setdefault("NEXT_PUBLIC_SUPABASE_URL", "https://example.supabase.co")
+os.environ.setdefault("SUPABASE_SERVICE_ROLE_KEY", "eyJhbGciOiJIUzI1NiJ9.eyJyb2xlIjoic2VydmljZV9yb2xlIn0.test")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+
+import city_safety_processor_refactored as processor
+from fakes import FakeSupabase, grid_blocks
+
+
+@pytest.fixture
+def fake_supabase(monkeypatch, tmp_path):
+    """Installs a fake Supabase client (with a census block grid) and a temporary data dir."""
+    client = FakeSupabase(grid_blocks())
+    monkeypatch.setattr(processor, 'supabase', client)
+    monkeypatch.setattr(processor, 'LOCAL_DATA_DIR', str(tmp_path))
+    processor.load_global_config()
+    return client
+
+
+@pytest.fixture
+def lapd_config(fake_supabase):
+    return processor.load_city_config(1)
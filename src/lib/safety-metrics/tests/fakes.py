@@ -0,0 +1,206 @@
+"""
+Fake crime records and a fake Supabase client for the safety metrics processor tests.
+
+Census blocks are 0.01-degree grid cells named "B{lat*100}_{-lon*100}"; every block's
+neighbors are its 8 adjacent cells. Populations are derived from the block id with crc32,
+so runs are deterministic.
+"""
+
+import random
+import zlib
+
+import httpx
+import shapely
+
+
+def lapd_records(n: int = 2000, seed: int = 1) -> list:
+    """LAPD-style raw records (date_occ, HHMM time_occ, crm_cd, lat/lon), including bad values."""
+    rng = random.Random(seed)
+    codes = ['110', '210', '330', '510', '624', '999', '310']
+    records = []
+    for _ in range(n):
+        time_occ = rng.choice(['0', '5', '45', '930', '1200', '2359', '2400', 'abc', None, '1305'])
+        record = {
+            'date_occ': f"2024-0{rng.randint(1, 9)}-1{rng.randint(0, 9)}T00:00:00.000",
+            'crm_cd': rng.choice(codes),
+            'lat': rng.choice([str(34 + rng.random() / 10), '0', None, '34.05']),
+            'lon': str(-118.2 - rng.random() / 10),
+        }
+        if time_occ is not None:
+            record['time_occ'] = time_occ
+        records.append(record)
+    return records
+
+
+def block_of(lat: float, lon: float) -> str:
+    return f"B{int(lat * 100)}_{int(-lon * 100)}"
+
+
+def block_population(block_id: str) -> int:
+    return zlib.crc32(block_id.encode('utf-8')) % 3000
+
+
+def block_housing_units(block_id: str) -> int:
+    return zlib.crc32(block_id.encode('utf-8')) % 900
+
+
+class FakeResponse:
+    def __init__(self, data, count=None):
+        self.data = data
+        self.count = count
+        self.error = None
+
+
+class FakeCall:
+    def __init__(self, fn):
+        self.fn = fn
+
+    def execute(self):
+        return FakeResponse(self.fn())
+
+
+class FakeQuery:
+    """Minimal PostgREST query builder over a list of row dicts."""
+
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.filters = []
+        self.op = 'select'
+        self.order_column = None
+        self.order_desc = False
+        self.offset_rows = 0
+        self.limit_rows = None
+        self.payload = []
+        self.params = httpx.QueryParams()
+        self.headers = httpx.Headers()
+
+    def select(self, *args, **kwargs):
+        return self
+
+    def eq(self, column, value):
+        self.filters.append(lambda row: row.get(column) == value)
+        return self
+
+    def lt(self, column, value):
+        self.filters.append(lambda row: row.get(column) is not None and row[column] < value)
+        return self
+
+    def in_(self, column, values):
+        values = set(values)
+        self.filters.append(lambda row: row.get(column) in values)
+        return self
+
+    def order(self, column, desc=False):
+        self.order_column, self.order_desc = column, desc
+        return self
+
+    def limit(self, n):
+        self.limit_rows = n
+        return self
+
+    def offset(self, n):
+        self.offset_rows = n
+        return self
+
+    def range(self, lo, hi):
+        self.offset_rows, self.limit_rows = lo, hi - lo + 1
+        return self
+
+    def maybe_single(self):
+        return self
+
+    def delete(self):
+        self.op = 'delete'
+        return self
+
+    def insert(self, rows, count=None):
+        self.op, self.payload = 'insert', rows
+        return self
+
+    def upsert(self, rows, count=None, on_conflict='id'):
+        self.op, self.payload = 'upsert', rows
+        return self
+
+    def execute(self):
+        table = self.client.tables.setdefault(self.name, {})
+        matches = [key for key, row in table.items() if all(f(row) for f in self.filters)]
+        if self.op == 'select':
+            rows = [dict(table[key]) for key in matches]
+            if self.order_column:
+                rows.sort(key=lambda row: str(row.get(self.order_column)), reverse=self.order_desc)
+            stop = self.offset_rows + self.limit_rows if self.limit_rows is not None else None
+            return FakeResponse(rows[self.offset_rows:stop], count=len(rows))
+        if self.op == 'delete':
+            for key in matches:
+                del table[key]
+            return FakeResponse([])
+        self.client.write_attempts.append((self.name, self.op, len(self.payload)))
+        failure = self.client.write_failure and self.client.write_failure(self.name, self.op, self.payload)
+        if failure:
+            raise failure
+        key_column = self.client.key_columns.get(self.name, 'id')
+        if 'missing=default' in self.headers.get('Prefer', ''):
+            defaults = self.client.column_defaults.get(self.name, {})
+            columns = [column.strip('"') for column in self.params['columns'].split(',')]
+            self.payload = [{column: row[column] if column in row else defaults.get(column) for column in columns} for row in self.payload]
+        for row in self.payload:
+            if self.op == 'insert' and row[key_column] in table:
+                raise ValueError(f"duplicate key {row[key_column]}")
+            table[row[key_column]] = {**table.get(row[key_column], {}), **row} if self.op == 'upsert' else dict(row)
+        self.client.writes.append((self.name, self.op, len(self.payload)))
+        return FakeResponse([], count=len(self.payload))
+
+
+class FakeSupabase:
+    """Answers the processor's block mapping/neighbor RPCs and stores tables in memory."""
+
+    def __init__(self, blocks=None):
+        self.rpc_calls = []
+        self.writes = []
+        self.tables = {'census_blocks': {row['id']: row for row in blocks or []}, 'cities': {1: {'id': 1, 'name': 'Testville'}}}
+        self.key_columns = {'safety_metric_questions': 'metric_type'}
+        self.write_failure = None # Optional fn(table, op, rows) returning an exception to raise instead of writing
+        self.write_attempts = []
+        self.column_defaults = {} # {table: {column: value}} for writes that ask for missing=default
+
+    def table(self, name):
+        return FakeQuery(self, name)
+
+    def rpc(self, name, params):
+        self.rpc_calls.append(name)
+        if name.startswith('match_points_to_block_groups'):
+            def match():
+                rows = []
+                for point in params['points_json']:
+                    block_id = block_of(point['lat'], point['lon'])
+                    row = {'id': block_id, 'block_group_id': block_id[1:],
+                           'total_population': block_population(block_id), 'housing_units': block_housing_units(block_id)}
+                    if 'idx' in point:
+                        row['idx'] = point['idx']
+                    rows.append(row)
+                return rows
+            return FakeCall(match)
+        if name == 'find_block_neighbors_batch':
+            def neighbors():
+                result = {}
+                for block_id in params['target_block_ids']:
+                    lat, lon = (int(part) for part in block_id[1:].split('_'))
+                    result[block_id] = [f"B{lat + i}_{lon + j}" for i in (-1, 0, 1) for j in (-1, 0, 1) if (i, j) != (0, 0)]
+                return result
+            return FakeCall(neighbors)
+        raise KeyError(name)
+
+
+def grid_blocks(lat_range=(3390, 3420), lon_range=(11810, 11840), city_id: int = 1) -> list:
+    """census_blocks rows for the grid, alternating GeoJSON and hex WKB geometries."""
+    rows = []
+    for lat in range(*lat_range):
+        for lon in range(*lon_range):
+            block_id = f"B{lat}_{lon}"
+            polygon = shapely.box(-(lon + 1) / 100, lat / 100, -lon / 100, (lat + 1) / 100)
+            geom = shapely.geometry.mapping(polygon) if (lat + lon) % 2 else shapely.to_wkb(polygon, hex=True, include_srid=False)
+            rows.append({'id': block_id, 'block_group_id': block_id[1:], 'total_population': block_population(block_id),
+                         'housing_units': block_housing_units(block_id), 'geom': geom, 'city_id': city_id,
+                         'updated_at': '2025-01-01'})
+    return rows
@@ -0,0 +1,126 @@
+import numpy as np
+import pandas as pd
+import pytest
+from postgrest.exceptions import APIError
+
+import city_safety_processor_refactored as processor
+from fakes import FakeCall, block_of, lapd_records
+
+
+@pytest.fixture
+def points(fake_supabase, monkeypatch):
+    """12 points inside the census block grid, mapped in batches of 4."""
+    monkeypatch.setattr(processor, 'GEO_MAPPING_BATCH_SIZE', 4)
+    monkeypatch.setattr(processor, 'MISSING_RPCS', set())
+    return pd.DataFrame({'latitude': [34.005 + 0.01 * i for i in range(12)], 'longitude': [-118.205 - 0.01 * i for i in range(12)]})
+
+
+def tamper_with_mapping_rpc(monkeypatch, tamper):
+    """Passes the fake mapping RPC rows of every batch through tamper(rows, points)."""
+    rpc = processor.supabase.rpc
+    def tampered(name, params):
+        call = rpc(name, params)
+        if not name.startswith('match_points_to_block_groups'):
+            return call
+        return FakeCall(lambda: tamper(call.execute().data, params['points_json']))
+    monkeypatch.setattr(processor.supabase, 'rpc', tampered)
+
+
+def mapped_ids(points):
+    return [None if pd.isna(block_id) else block_id for block_id in processor.match_blocks_rpc(points)['id']]
+
+
+def expected_ids(points):
+    return [block_of(lat, lon) for lat, lon in zip(points['latitude'], points['longitude'])]
+
+
+def test_rows_are_joined_by_index_not_position(points, monkeypatch):
+    tamper_with_mapping_rpc(monkeypatch, lambda rows, batch: rows[::-1])
+    assert mapped_ids(points) == expected_ids(points)
+
+
+def test_points_without_rows_stay_unmapped(points, monkeypatch):
+    tamper_with_mapping_rpc(monkeypatch, lambda rows, batch: [row for row in rows if row['idx'] % 3])
+    mapped = mapped_ids(points)
+    assert mapped == [None if idx % 3 == 0 else block_id for idx, block_id in enumerate(expected_ids(points))]
+
+
+@pytest.mark.parametrize('tamper', [
+    lambda rows, batch: rows + [{**rows[0], 'idx': 99}] if batch[0]['idx'] == 4 else rows, # Index from another request
+    lambda rows, batch: rows + [{**rows[0], 'idx': 0}] if batch[0]['idx'] == 4 else rows, # Index of another batch
+    lambda rows, batch: rows + [{**rows[1], 'id': 'B0_0'}] if batch[0]['idx'] == 4 else rows, # Duplicated index
+    lambda rows, batch: [{**row, 'idx': str(row['idx'])} for row in rows] if batch[0]['idx'] == 4 else rows, # Not an integer
+], ids=['foreign', 'other-batch', 'duplicated', 'non-integer'])
+def test_batches_with_invalid_indices_are_discarded(points, monkeypatch, tamper):
+    tamper_with_mapping_rpc(monkeypatch, tamper)
+    mapped = mapped_ids(points)
+    assert mapped == [None if 4 <= idx < 8 else block_id for idx, block_id in enumerate(expected_ids(points))]
+
+
+def test_falls_back_to_the_positional_rpc_without_the_indexed_function(points, monkeypatch):
+    rpc = processor.supabase.rpc
+    def without_indexed(name, params):
+        if name == 'match_points_to_block_groups_indexed':
+            return FakeCall(lambda: (_ for _ in ()).throw(APIError({'code': 'PGRST202', 'message': 'Could not find the function'})))
+        return rpc(name, params)
+    monkeypatch.setattr(processor.supabase, 'rpc', without_indexed)
+
+    assert mapped_ids(points) == expected_ids(points)
+    assert processor.MISSING_RPCS == {'match_points_to_block_groups_indexed'}
+    assert processor.supabase.rpc_calls.count('match_points_to_block_groups') == 3
+
+
+def test_positional_rpc_batches_of_the_wrong_length_are_discarded(points, monkeypatch):
+    processor.MISSING_RPCS.add('match_points_to_block_groups_indexed')
+    tamper_with_mapping_rpc(monkeypatch, lambda rows, batch: rows[1:] if batch[0]['lat'] == points['latitude'][8] else rows)
+    mapped = mapped_ids(points)
+    assert mapped == [None if idx >= 8 else block_id for idx, block_id in enumerate(expected_ids(points))]
+
+
+@pytest.fixture
+def census_index(fake_supabase, monkeypatch):
+    """Fresh census block index cache, loading the 900 grid blocks in pages of 250."""
+    monkeypatch.setattr(processor, 'CENSUS_BLOCK_INDEXES', {})
+    monkeypatch.setattr(processor, 'CENSUS_BLOCK_PAGE_SIZE', 250)
+    return processor.CENSUS_BLOCK_INDEXES
+
+
+def grid_points(n=2000, seed=7):
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({'latitude': rng.uniform(33.90, 34.20, n), 'longitude': rng.uniform(-118.40, -118.10, n)})
+
+
+def test_local_engine_matches_the_rpc(census_index):
+    points = grid_points()
+    local = processor.match_blocks_local(points, 1, 'Los Angeles')
+    rpc = processor.match_blocks_rpc(points)
+    assert local['id'].tolist() == expected_ids(points)
+    pd.testing.assert_frame_equal(local.astype(object), rpc.astype(object))
+
+
+def test_local_engine_leaves_points_outside_every_block_unmatched(census_index):
+    points = pd.DataFrame({'latitude': [34.005, 35.5, 34.005], 'longitude': [-118.205, -118.205, -119.5]})
+    local = processor.match_blocks_local(points, 1, 'Los Angeles')
+    assert [None if pd.isna(block_id) else block_id for block_id in local['id']] == ['B3400_11820', None, None]
+
+
+def test_local_engine_loads_every_page_once(census_index, monkeypatch):
+    processor.supabase.tables['census_blocks']['B3400_11820']['geom'] = None
+    table = processor.supabase.table
+    requests = []
+    monkeypatch.setattr(processor.supabase, 'table', lambda name: requests.append(name) or table(name))
+
+    processor.match_blocks_local(grid_points(100), 1, 'Los Angeles')
+    processor.match_blocks_local(grid_points(100, seed=8), 1, 'Los Angeles')
+    assert requests == ['census_blocks'] * 4 # 899 usable blocks in pages of 250, loaded for the first call only
+    assert len(census_index[1]['blocks']) == 899
+
+
+def test_local_and_rpc_engines_process_incidents_identically(lapd_config, census_index):
+    # ST_Contains leaves points on a block edge unmatched; the fake RPC does not
+    records = [record for record in lapd_records(3000) if record['lat'] != '34.05']
+    rpc = processor.process_crime_data(records, lapd_config, mapping_engine='rpc', block_memo=False)
+    processor.supabase.rpc_calls.clear()
+    local = processor.process_crime_data(records, lapd_config, mapping_engine='local', block_memo=False)
+    assert processor.supabase.rpc_calls == []
+    pd.testing.assert_frame_equal(local, rpc)
@@ -0,0 +1,75 @@
+import os
+
+import pytest
+
+import city_safety_processor_refactored as processor
+from fakes import lapd_records
+
+
+@pytest.fixture
+def memo_calls(fake_supabase, monkeypatch):
+    """Counts census version lookups, memo reads and memo writes."""
+    monkeypatch.setattr(processor, 'CENSUS_VERSIONS', {})
+    calls = {'version': 0, 'load': 0, 'save': 0}
+    for name, key in (('get_census_version', 'version'), ('load_block_memo', 'load'), ('save_block_memo', 'save')):
+        original = getattr(processor, name)
+        def counted(*args, _original=original, _key=key):
+            calls[_key] += 1
+            return _original(*args)
+        monkeypatch.setattr(processor, name, counted)
+    return calls
+
+
+def test_chunked_run_loads_and_saves_memo_once(lapd_config, memo_calls):
+    records = lapd_records(6000)
+    pages = [records[i:i + 2000] for i in range(0, len(records), 2000)]
+    partials = processor.process_crime_chunks(iter(pages), lapd_config, 1)
+    assert partials is not None and not partials.empty
+    assert memo_calls == {'version': 1, 'load': 1, 'save': 1}
+
+    # A second run is served from the memo: no block matching and nothing new to write
+    processor.supabase.rpc_calls.clear()
+    partials_again = processor.process_crime_chunks(iter(pages), lapd_config, 1)
+    assert memo_calls == {'version': 2, 'load': 2, 'save': 1}
+    assert not any(name.startswith('match_points') for name in processor.supabase.rpc_calls)
+    assert partials_again['direct_incidents'].sum() == partials['direct_incidents'].sum()
+
+
+def test_memo_is_invalidated_when_census_blocks_change(lapd_config, memo_calls, tmp_path):
+    records = lapd_records(2000)
+    first = processor.process_crime_data(records, lapd_config)
+    old_version = processor.CENSUS_VERSIONS[1]
+    assert processor.load_block_memo(1, old_version).shape[0] > 0
+
+    # Re-fetched census blocks get a new updated_at, so the next run sees a new census version
+    next(iter(processor.supabase.tables['census_blocks'].values()))['updated_at'] = '2026-10-16'
+    processor.CENSUS_VERSIONS.clear()
+    processor.supabase.rpc_calls.clear()
+    second = processor.process_crime_data(records, lapd_config)
+
+    new_version = processor.CENSUS_VERSIONS[1]
+    assert new_version != old_version
+    assert any(name.startswith('match_points') for name in processor.supabase.rpc_calls) # Old memo not reused
+    assert sorted(os.listdir(tmp_path / 'block_memo')) == [f"city_1_{new_version}.parquet"]
+    assert (first['census_block_pk'].astype(str).tolist() == second['census_block_pk'].astype(str).tolist())
+
+
+def test_memo_only_stores_matched_coordinates(lapd_config, memo_calls, monkeypatch):
+    # Points the engine could not match (e.g. a failed RPC batch) must be retried next run
+    def match_half(points_df):
+        blocks = processor.pd.DataFrame({'id': [f"B{i}" if i % 2 else None for i in range(len(points_df))],
+                                         'block_group_id': 'G', 'total_population': 10.0, 'housing_units': 5.0})
+        return blocks
+    monkeypatch.setattr(processor, 'match_blocks_rpc', match_half)
+    processor.process_crime_data(lapd_records(2000), lapd_config)
+    memo = processor.load_block_memo(1, processor.CENSUS_VERSIONS[1])
+    assert len(memo) > 0 and memo['id'].notna().all()
+
+
+def test_test_mode_runs_write_no_caches(fake_supabase, monkeypatch, tmp_path):
+    monkeypatch.setattr(processor, 'CENSUS_VERSIONS', {})
+    monkeypatch.setattr(processor.time, 'sleep', lambda seconds: None)
+    monkeypatch.setattr(processor, 'fetch_crime_data', lambda *args, **kwargs: lapd_records(2000))
+
+    processor.main(target_city_id=1, test_mode=True)
+    assert not (tmp_path / 'block_memo').exists() and not (tmp_path / 'neighbor_cache').exists()
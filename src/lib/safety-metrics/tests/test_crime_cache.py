@@ -0,0 +1,33 @@
+import pandas as pd
+
+import city_safety_processor_refactored as processor
+from fakes import lapd_records
+
+
+def test_cache_key_covers_fetch_options():
+    base = ('2nrs-mtv8', 'date_occ, crm_cd', "date_occ >= '2026-01-01'", 1000)
+    keys = {
+        processor.crime_cache_key(*base),
+        processor.crime_cache_key(*base, fetch_mode='csv'),
+        processor.crime_cache_key(*base, fetch_mode='windowed'),
+        processor.crime_cache_key(*base, pushdown=True),
+        processor.crime_cache_key(*base, aggregate=True),
+        processor.crime_cache_key(*base, group_clause='crm_cd'),
+    }
+    assert len(keys) == 6
+    assert processor.crime_cache_key(*base, fetch_mode='csv') == processor.crime_cache_key(*base, fetch_mode='csv')
+
+
+def test_cache_hit_keeps_fresh_result_type(fake_supabase, lapd_config):
+    csv_frame = pd.DataFrame(lapd_records(200))
+    dtypes = {column: dtype for column, dtype in processor.get_source_adapter(lapd_config).csv_dtypes().items() if column in csv_frame}
+    csv_frame = csv_frame[list(dtypes)].astype(dtypes)
+    processor.store_crime_pull('csv', csv_frame, '2nrs-mtv8', '', 100)
+    cached_frame = processor.load_cached_crime_pull('csv', 1, as_frame=True)
+    assert isinstance(cached_frame, pd.DataFrame)
+    pd.testing.assert_frame_equal(cached_frame, csv_frame)
+
+    records = lapd_records(200)
+    processor.store_crime_pull('json', records, '2nrs-mtv8', '', 100)
+    cached_records = processor.load_cached_crime_pull('json', 1)
+    assert isinstance(cached_records, list) and cached_records[0] == records[0]
@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+
+import city_safety_processor_refactored as processor
+
+
+def test_fetch_crime_data_dispatches_socrata_through_adapter(lapd_config, monkeypatch):
+    calls = []
+    def fetch(city_config, days_back, max_records, since=None, **fetch_options):
+        calls.append(fetch_options)
+        return [{'crm_cd': '624'}]
+    monkeypatch.setattr(processor, 'fetch_socrata_records', fetch)
+
+    records = processor.fetch_crime_data(lapd_config, 30, 100, fetch_mode='csv', pushdown=True, aggregate=True)
+    assert records == [{'crm_cd': '624'}]
+    assert calls[0]['fetch_mode'] == 'csv'
+    assert calls[0]['pushdown'] and calls[0]['aggregate']
+
+
+def test_fetch_crime_data_dispatches_generic_api_through_adapter(monkeypatch):
+    city_config = {'city_name': 'Miami', 'crime_data': {'source_type': 'api', 'api_url': 'https://example.com/crimes.json'}}
+    calls = []
+    monkeypatch.setattr(processor.GenericApiAdapter, 'fetch_records',
+                        lambda self, city_config, days_back, max_records, since=None, **options: calls.append(options) or [])
+    assert processor.fetch_crime_data(city_config, 30, 100, fetch_mode='windowed') == []
+    assert calls[0]['fetch_mode'] == 'windowed'
+
+
+def test_lapd_aggregate_groups_by_server_side_hour(lapd_config):
+    query = processor.prepare_socrata_query(lapd_config, 30, aggregate=True)
+    processor.close_socrata_client(query['client'])
+    hour_expression = "(time_occ::number - time_occ::number % 100) / 100"
+    assert hour_expression in query['group_clause']
+    assert f"{hour_expression} AS {processor.AGGREGATE_HOUR_FIELD}" in query['select_clause']
+    assert 'time_occ' not in query['group_clause'].replace(hour_expression, '')
+
+
+def test_aggregated_records_take_the_server_hour(lapd_config):
+    records = [
+        {'date_occ': '2024-03-01T00:00:00.000', 'crm_cd': '624', 'lat': '34.05', 'lon': '-118.25', 'incident_hour': '21', 'incident_count': '4'},
+        {'date_occ': '2024-03-01T00:00:00.000', 'crm_cd': '624', 'lat': '34.05', 'lon': '-118.25', 'incident_hour': '24', 'incident_count': '1'},
+    ]
+    df = processor.standardize_crime_chunk(records, processor.get_source_adapter(lapd_config), 'Los Angeles')
+    assert df['hour'].tolist() == [21, 23]
+    assert df['weight'].tolist() == [4, 1]
+
+
+def test_pushdown_bbox_uses_numeric_bounds(lapd_config):
+    adapter = processor.get_source_adapter(lapd_config)
+    clause = processor.build_pushdown_clause(lapd_config, adapter.fields)
+    assert "lat::number BETWEEN 33.7 AND 34.82" in clause
+    assert "lon::number BETWEEN -118.95 AND -117.65" in clause
+    assert "crm_cd IN (" in clause
+
+
+def test_fetch_skips_pushdown_counts_unless_reported(lapd_config, monkeypatch):
+    monkeypatch.setattr(processor, 'report_pushdown_savings', lambda *args: (_ for _ in ()).throw(AssertionError("counted")))
+    monkeypatch.setattr(processor.Socrata, 'get', lambda self, dataset_id, **params: [])
+    assert processor.fetch_crime_data(lapd_config, 30, 100, pushdown=True) == []
+
+
+def test_lapd_hhmm_parser():
+    cases = [
+        ('0', '2024-02-29T00:00'), ('5', '2024-02-29T00:05'), ('45', '2024-02-29T00:45'),
+        ('930', '2024-02-29T09:30'), (930, '2024-02-29T09:30'), ('0000', '2024-02-29T00:00'),
+        ('2359', '2024-02-29T23:59'), ('2400', '2024-02-29T23:59'), ('2475', '2024-02-29T23:59'), # hours >= 24
+        ('abc', '2024-02-29T12:00'), (None, '2024-02-29T12:00'), ('12345', '2024-02-29T12:00'), # not HHMM
+        ('1260', None), # minutes above 59
+    ]
+    dates = ['2024-02-29T00:00:00.000'] * len(cases) + ['2024-03-01', '2023-02-29T00:00:00.000', 'garbage', None]
+    times = [time_occ for time_occ, _ in cases] + ['0930'] * 4
+    expected = [value for _, value in cases] + ['2024-03-01T09:30', None, None, None]
+
+    parsed = processor.LapdSocrataAdapter({}).parse_timestamps(np.array(dates, dtype=object), np.array(times, dtype=object))
+    expected = np.array([np.datetime64(value) if value else np.datetime64('NaT') for value in expected], dtype='datetime64[ns]')
+    np.testing.assert_array_equal(parsed, expected)
+
+
+def test_adapters_must_implement_fetch_records():
+    class IncompleteAdapter(processor.CrimeSourceAdapter):
+        source_type = 'incomplete'
+
+    with pytest.raises(TypeError, match='fetch_records'):
+        IncompleteAdapter({})
+    assert isinstance(processor.LapdSocrataAdapter({}), processor.CrimeSourceAdapter)
@@ -0,0 +1,103 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import city_safety_processor_refactored as processor
+from fakes import lapd_records
+
+
+def pages_of(records, size):
+    return [records[i:i + size] for i in range(0, len(records), size)]
+
+
+def standardized(lapd_config, records):
+    return processor.standardize_crime_chunk(records, processor.get_source_adapter(lapd_config), 'Los Angeles')
+
+
+def test_stream_matches_one_shot_processing(lapd_config):
+    records = lapd_records(6000)
+    one_shot = processor.process_crime_data(records, lapd_config, block_memo=False)
+    streamed = processor.process_crime_stream(iter(pages_of(records, 1700) + [[]]), lapd_config, block_memo=False)
+    pd.testing.assert_frame_equal(streamed, one_shot)
+
+
+def test_stream_without_valid_records_is_empty(lapd_config):
+    pages = [[], [{'date_occ': '2024-03-01T00:00:00.000', 'time_occ': '1200', 'crm_cd': '624', 'lat': '0', 'lon': '0'}]]
+    assert processor.process_crime_stream(iter(pages), lapd_config).empty
+
+
+def test_column_buffer_concatenates_typed_chunks(lapd_config):
+    chunks = [standardized(lapd_config, page) for page in pages_of(lapd_records(3000), 1000)]
+    buffer = processor.IncidentColumnBuffer()
+    for chunk in chunks:
+        buffer.append(chunk)
+    assert buffer.row_count == sum(len(chunk) for chunk in chunks)
+
+    frame = buffer.to_frame()
+    expected = pd.concat(chunks, ignore_index=True).astype(processor.IncidentColumnBuffer.COLUMN_DTYPES)
+    pd.testing.assert_frame_equal(frame.astype({'crime_code': object}), expected.astype({'crime_code': object}))
+    assert frame['hour'].dtype == np.int8
+    assert all(isinstance(code, str) for code in frame['crime_code'])
+
+
+def test_column_buffer_keeps_aggregate_weights(lapd_config):
+    chunk = standardized(lapd_config, lapd_records(500)).assign(weight=np.int64(3))
+    buffer = processor.IncidentColumnBuffer()
+    buffer.append(chunk)
+    buffer.append(chunk)
+    frame = buffer.to_frame()
+    assert frame['weight'].dtype == np.int64 and frame['weight'].sum() == 6 * len(chunk)
+
+
+def test_column_buffer_rejects_weights_appearing_mid_stream(lapd_config):
+    chunk = standardized(lapd_config, lapd_records(500))
+    buffer = processor.IncidentColumnBuffer()
+    buffer.append(chunk)
+    with pytest.raises(ValueError, match='weight'):
+        buffer.append(chunk.assign(weight=np.int64(1)))
+
+
+def test_empty_column_buffer_has_the_schema_columns():
+    frame = processor.IncidentColumnBuffer().to_frame()
+    assert frame.empty and list(frame.columns) == list(processor.IncidentColumnBuffer.COLUMN_DTYPES)
+
+
+def test_processed_incidents_use_the_compact_schema(lapd_config):
+    processed = processor.process_crime_data(lapd_records(3000), lapd_config, block_memo=False)
+    for column, dtype in processor.COMPACT_INCIDENT_DTYPES.items():
+        if column in processed.columns:
+            assert processed[column].dtype == dtype, column
+    assert processed['census_block_pk'].cat.codes.min() >= 0
+
+
+def test_compaction_keeps_values_in_range():
+    frame = pd.DataFrame({
+        'hour': np.array([0, 23], dtype=np.int64), 'month': np.array([0, 65535], dtype=np.int64),
+        'day': np.array([0, 20742], dtype=np.int64), 'weight': np.array([1, 2 ** 31 - 1], dtype=np.int64),
+        'latitude': [34.0521, 33.9], 'crime_code': ['624', '0624'],
+    })
+    compact = processor.compact_incident_frame(frame)
+    assert compact['month'].dtype == np.uint16 and compact['weight'].dtype == np.int32
+    for column in ('hour', 'month', 'day', 'weight', 'crime_code'):
+        assert compact[column].tolist() == frame[column].tolist(), column
+    np.testing.assert_allclose(compact['latitude'], frame['latitude'], atol=1e-5)
+
+
+def test_compaction_never_wraps_out_of_range_integers():
+    frame = pd.DataFrame({
+        'hour': np.array([1, 2], dtype=np.int64), 'month': np.array([-1, 5], dtype=np.int64),
+        'day': np.array([-20, 70000], dtype=np.int64), 'weight': np.array([1, 2 ** 31], dtype=np.int64),
+    })
+    compact = processor.compact_incident_frame(frame)
+    assert compact['hour'].dtype == np.uint8
+    for column in ('month', 'day', 'weight'):
+        assert compact[column].dtype == np.int64
+        assert compact[column].tolist() == frame[column].tolist()
+
+
+def test_pre_1970_incidents_keep_their_month_and_day(lapd_config):
+    records = [{'date_occ': '1969-12-15T00:00:00.000', 'time_occ': '1200', 'crm_cd': '624', 'lat': '34.0512', 'lon': '-118.2512'},
+               {'date_occ': '2024-03-01T00:00:00.000', 'time_occ': '1200', 'crm_cd': '624', 'lat': '34.0512', 'lon': '-118.2512'}]
+    processed = processor.process_crime_data(records, lapd_config, block_memo=False)
+    assert sorted(processed['month'].tolist()) == [-1, (2024 - 1970) * 12 + 2]
+    assert sorted(processed['day'].tolist()) == [-17, 19783]
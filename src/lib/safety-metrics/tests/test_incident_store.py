@@ -0,0 +1,89 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import city_safety_processor_refactored as processor
+
+DAYS_BACK = 60
+
+
+def days_ago(days: int) -> str:
+    return (datetime.now(timezone.utc) - timedelta(days=days)).strftime('%Y-%m-%dT00:00:00.000')
+
+
+def incident(dr_no: str, age_days: int, crm_cd: str = '624') -> dict:
+    return {'dr_no': dr_no, 'date_occ': days_ago(age_days), 'time_occ': '1200', 'crm_cd': crm_cd, 'lat': '34.05', 'lon': '-118.25'}
+
+
+@pytest.fixture
+def source(lapd_config, monkeypatch):
+    """Fake fetch_crime_data serving source['records'] since the requested start, reporting source['complete']."""
+    state = {'records': [], 'complete': True, 'since': []}
+    def fetch(city_config, days_back, max_records, since=None, fetch_status=None, **options):
+        state['since'].append(since)
+        fetch_status['complete'] = state['complete']
+        start = since.replace(tzinfo=None).strftime('%Y-%m-%dT%H:%M:%S.000')
+        return [record for record in state['records'] if record['date_occ'] >= start]
+    monkeypatch.setattr(processor, 'fetch_crime_data', fetch)
+    return state
+
+
+def fetch(lapd_config):
+    records = processor.fetch_crime_data_incremental(lapd_config, days_back=DAYS_BACK, max_records=1000)
+    return {record['dr_no']: record for record in records}
+
+
+def stored_high_water_mark(lapd_config):
+    return processor.load_incident_store(lapd_config['city_id'], '2nrs-mtv8')[1]
+
+
+def test_backfill_then_overlap_refetch(lapd_config, source):
+    source['records'] = [incident('old', 40), incident('mid', 20), incident('new', 2)]
+    assert set(fetch(lapd_config)) == {'old', 'mid', 'new'}
+    assert stored_high_water_mark(lapd_config).date() == (datetime.now(timezone.utc) - timedelta(days=2)).date()
+
+    # The next run only asks for the overlap before the high-water mark
+    source['records'] = [incident('new', 2), incident('late', 3), incident('newest', 0)]
+    assert set(fetch(lapd_config)) == {'old', 'mid', 'new', 'late', 'newest'}
+    overlap_start = source['since'][-1].replace(tzinfo=None)
+    assert timedelta(days=processor.INCREMENTAL_OVERLAP_DAYS) <= datetime.now() - overlap_start <= timedelta(days=processor.INCREMENTAL_OVERLAP_DAYS + 3)
+    assert stored_high_water_mark(lapd_config).date() == datetime.now(timezone.utc).date()
+
+
+def test_complete_fetch_replaces_the_overlap(lapd_config, source):
+    source['records'] = [incident('old', 40), incident('withdrawn', 5), incident('new', 2)]
+    fetch(lapd_config)
+
+    source['records'] = [incident('old', 40), incident('new', 2, crm_cd='210')]
+    records = fetch(lapd_config)
+    assert set(records) == {'old', 'new'}
+    assert records['new']['crm_cd'] == '210'
+
+
+def test_partial_fetch_merges_without_losing_or_duplicating(lapd_config, source):
+    source['records'] = [incident('old', 40), incident('a', 5), incident('b', 2)]
+    fetch(lapd_config)
+    high_water_mark = stored_high_water_mark(lapd_config)
+
+    # A failed window lost 'a'; 'b' came back corrected, 'c' is new
+    source['records'] = [incident('b', 2, crm_cd='210'), incident('c', 1)]
+    source['complete'] = False
+    records = processor.fetch_crime_data_incremental(lapd_config, days_back=DAYS_BACK, max_records=1000)
+    assert sorted(record['dr_no'] for record in records) == ['a', 'b', 'c', 'old']
+    assert {record['dr_no']: record['crm_cd'] for record in records}['b'] == '210'
+    assert stored_high_water_mark(lapd_config) == high_water_mark
+
+    # A failed request returning nothing keeps the store as it is
+    source['records'] = []
+    assert set(fetch(lapd_config)) == {'a', 'b', 'c', 'old'}
+    assert stored_high_water_mark(lapd_config) == high_water_mark
+
+
+def test_records_older_than_days_back_age_out(lapd_config, source):
+    source['records'] = [incident('old', DAYS_BACK - 1), incident('new', 1)]
+    fetch(lapd_config)
+
+    store_df, _ = processor.load_incident_store(lapd_config['city_id'], '2nrs-mtv8')
+    store_df.loc[store_df['dr_no'] == 'old', 'date_occ'] = days_ago(DAYS_BACK + 5)
+    processor.save_incident_store(lapd_config['city_id'], '2nrs-mtv8', store_df, stored_high_water_mark(lapd_config))
+    assert set(fetch(lapd_config)) == {'new'}
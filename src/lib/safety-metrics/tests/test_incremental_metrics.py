@@ -0,0 +1,57 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import city_safety_processor_refactored as processor
+from fakes import lapd_records
+
+
+@pytest.fixture
+def recent_records():
+    """LAPD records spread over the last 60 days."""
+    today = datetime.now(timezone.utc).replace(tzinfo=None, hour=0, minute=0, second=0, microsecond=0)
+    records = lapd_records(20000)
+    for i, record in enumerate(records):
+        record['date_occ'] = (today - timedelta(days=i % 60)).strftime('%Y-%m-%dT00:00:00.000')
+    return records
+
+
+@pytest.fixture
+def incremental_run(fake_supabase, lapd_config, recent_records, monkeypatch):
+    def fetch(city_config, days_back, max_records, fetch_mode='single', since=None, **kwargs):
+        return [r for r in recent_records if datetime.fromisoformat(r['date_occ']) >= since.replace(tzinfo=None)]
+    monkeypatch.setattr(processor, 'fetch_crime_data', fetch)
+
+    def run():
+        update = processor.prepare_metric_counter_update(lapd_config, 1, days_back=40, max_records=10**9)
+        metrics_by_type = processor.calculate_metrics_from_partials(
+            update['metric_partials'], 1, lapd_config,
+            changed_partials=None if update['full_refresh'] else update['changed_partials'])
+        upload_mode = 'replace' if update['full_refresh'] else 'upsert'
+        processor.upload_metrics(metrics_by_type, 1, test_mode=False, upload_mode=upload_mode, upload_engine='serial')
+        processor.save_metric_counters(1, update['dataset_id'], update['buckets'], update['state'])
+        return update, [record['id'] for record in processor.iter_metric_records(metrics_by_type)]
+    return run
+
+
+def test_unchanged_run_rewrites_only_expiring_metrics(fake_supabase, incremental_run, monkeypatch):
+    monkeypatch.setattr(processor.time, 'sleep', lambda seconds: None)
+    update, written_ids = incremental_run()
+    assert update['full_refresh']
+    stored = fake_supabase.tables['safety_metrics']
+    assert set(written_ids) == set(stored)
+
+    update, written_ids = incremental_run()
+    assert not update['full_refresh']
+    assert written_ids == []
+
+    # Age three stored rows to within METRIC_EXPIRY_REFRESH_DAYS of expiry
+    expiring = sorted(stored)[:3]
+    almost_expired = (datetime.now(timezone.utc) + timedelta(days=processor.METRIC_EXPIRY_REFRESH_DAYS - 1)).isoformat()
+    for metric_id in expiring:
+        stored[metric_id]['expires_at'] = almost_expired
+
+    update, written_ids = incremental_run()
+    assert sorted(written_ids) == expiring
+    assert all(stored[metric_id]['expires_at'] > almost_expired for metric_id in expiring)
+    assert not update['changed_partials']['count_changed'].any()
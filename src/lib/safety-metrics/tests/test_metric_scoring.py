@@ -0,0 +1,82 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import city_safety_processor_refactored as processor
+from fakes import lapd_records
+
+
+@pytest.fixture
+def metric_partials(lapd_config):
+    processed_df = processor.process_crime_data(lapd_records(20000), lapd_config, block_memo=False)
+    return processor.reduce_metric_partials(processed_df, 1, lapd_config)
+
+
+def scored_records(metric_partials, lapd_config, **engine_options):
+    metrics_by_type = processor.calculate_metrics_from_partials(metric_partials, 1, lapd_config, cache_neighbors=False, **engine_options)
+    # Timestamps come from each run's clock
+    return {metric_type: sorted(({**record, 'created_at': None, 'expires_at': None}
+                                 for record in processor.iter_metric_records({metric_type: metrics})), key=lambda r: r['id'])
+            for metric_type, metrics in metrics_by_type.items()}
+
+
+def assert_records_match(actual: dict, expected: dict):
+    assert actual.keys() == expected.keys()
+    for metric_type in expected:
+        assert len(actual[metric_type]) == len(expected[metric_type]) > 0
+        for actual_record, expected_record in zip(actual[metric_type], expected[metric_type]):
+            assert actual_record.keys() == expected_record.keys()
+            for field, value in expected_record.items():
+                if isinstance(value, float):
+                    assert actual_record[field] == pytest.approx(value, rel=1e-12), (metric_type, field)
+                else:
+                    assert actual_record[field] == value, (metric_type, field)
+
+
+def test_vectorized_scores_equal_loop_scores(metric_partials, lapd_config):
+    vectorized = scored_records(metric_partials, lapd_config, scoring_engine='vectorized', metric_output='records')
+    loop = scored_records(metric_partials, lapd_config, scoring_engine='loop')
+    assert_records_match(vectorized, loop)
+
+
+def test_columnar_output_equals_per_record_builder(metric_partials, lapd_config):
+    # The loop engine builds each dict with build_metric_record, independently of MetricColumns
+    columnar = scored_records(metric_partials, lapd_config, scoring_engine='vectorized', metric_output='columnar')
+    records = scored_records(metric_partials, lapd_config, scoring_engine='loop')
+    assert_records_match(columnar, records)
+
+
+def test_columnar_serialization_batches_cover_every_row(metric_partials, lapd_config):
+    metrics_by_type = processor.calculate_metrics_from_partials(metric_partials, 1, lapd_config, cache_neighbors=False,
+                                                                scoring_engine='vectorized', metric_output='columnar')
+    assert all(isinstance(metrics, processor.MetricColumns) for metrics in metrics_by_type.values() if len(metrics))
+    whole = [record['id'] for metrics in metrics_by_type.values() if len(metrics) for record in metrics.to_records()]
+    batched = [record['id'] for record in processor.iter_metric_records(metrics_by_type, serialize_batch_size=7)]
+    assert batched == whole and len(set(whole)) == len(whole)
+
+
+def test_calculate_metrics_returns_record_dicts_by_default(lapd_config):
+    processed_df = processor.process_crime_data(lapd_records(2000), lapd_config, block_memo=False)
+    metrics_by_type = processor.calculate_metrics(processed_df, 1, lapd_config, cache_neighbors=False)
+    assert metrics_by_type and all(isinstance(metrics, list) for metrics in metrics_by_type.values())
+    assert all(isinstance(record, dict) for metrics in metrics_by_type.values() for record in metrics)
+
+
+def sorted_partials(partials):
+    partials = partials.astype({'census_block_pk': str, 'block_group_identifier': str, 'direct_incidents': 'int64'})
+    return partials.sort_values(['metric_type', 'census_block_pk'], ignore_index=True)
+
+
+@pytest.mark.parametrize('page_size', [20000, 1999])
+def test_chunked_partials_equal_one_shot_partials(metric_partials, lapd_config, page_size):
+    records = lapd_records(20000)
+    pages = [records[i:i + page_size] for i in range(0, len(records), page_size)]
+    chunked = processor.process_crime_chunks(iter(pages[:1] + [[]] + pages[1:]), lapd_config, 1, block_memo=False)
+
+    expected = sorted_partials(metric_partials)
+    actual = sorted_partials(chunked)
+    exact_columns = ['metric_type', 'census_block_pk', 'block_group_identifier', 'direct_incidents', 'population']
+    pd.testing.assert_frame_equal(actual[exact_columns], expected[exact_columns])
+    for column in ('latitude_sum', 'longitude_sum', 'population_density_proxy'):
+        np.testing.assert_allclose(actual[column], expected[column], rtol=1e-12)
+    assert_records_match(scored_records(chunked, lapd_config), scored_records(metric_partials, lapd_config))
@@ -0,0 +1,144 @@
+import httpx
+import pytest
+from postgrest.exceptions import APIError
+
+import city_safety_processor_refactored as processor
+
+
+def metric_record(metric_id='m1', score=0.5):
+    return {
+        'id': metric_id, 'city_id': 1, 'block_group_id': 'B3400_11820', 'metric_type': 'night',
+        'latitude': 34.0, 'longitude': -118.2, 'geom': 'SRID=4326;POINT(-118.2 34.0)',
+        'question': 'Is it safe at night?', 'score': score, 'direct_incidents': 3,
+        'created_at': '2026-10-16T00:00:00+00:00', 'expires_at': '2027-01-14T00:00:00+00:00'
+    }
+
+
+def test_slim_records_leave_out_derived_fields():
+    slim = next(processor.slim_metric_records([metric_record()]))
+    assert not set(slim) & {'geom', *processor.SLIM_METRIC_DEFAULTED_FIELDS}
+    assert slim['score'] == 0.5 and slim['metric_type'] == 'night'
+
+
+def test_column_defaults_are_requested_from_postgrest():
+    from postgrest import SyncPostgrestClient
+    records = [{'id': 'm1', 'score': 0.5}, {'id': 'm2', 'score': 0.6, 'content_hash': 'h'}]
+    query = SyncPostgrestClient("http://localhost:54321/rest/v1").from_('safety_metrics').upsert(records, count='exact', on_conflict='id')
+
+    processor.apply_column_defaults(query, records, processor.SLIM_METRIC_DEFAULTED_FIELDS)
+    assert query.request.params['columns'] == '"id","score","content_hash","question","created_at","expires_at"'
+    assert query.request.params['on_conflict'] == 'id'
+    prefer = query.request.headers['Prefer'].split(',')
+    assert 'missing=default' in prefer and 'resolution=merge-duplicates' in prefer and 'count=exact' in prefer
+
+
+def test_slim_upsert_refreshes_defaulted_fields_of_existing_rows(fake_supabase, monkeypatch):
+    monkeypatch.setattr(processor.time, 'sleep', lambda seconds: None)
+    processor.upload_metrics({'night': [metric_record('m1')]}, 1, test_mode=False, upload_mode='upsert')
+    fake_supabase.column_defaults['safety_metrics'] = {'created_at': 'NOW()', 'expires_at': 'NOW() + 90 days'}
+
+    processor.upload_metrics({'night': [metric_record('m1', score=0.9)]}, 1, test_mode=False, upload_mode='upsert', metric_payload='slim')
+    row = fake_supabase.tables['safety_metrics']['m1']
+    assert row['score'] == 0.9
+    assert (row['created_at'], row['expires_at']) == ('NOW()', 'NOW() + 90 days')
+    assert row['question'] is None # Filled by the trigger from safety_metric_questions
+    assert fake_supabase.tables['safety_metric_questions']['night']['question'] == metric_record()['question']
+
+
+def test_content_hash_ignores_bookkeeping_fields():
+    record = metric_record()
+    rewritten = {**metric_record(), 'created_at': '2026-11-01T00:00:00+00:00', 'expires_at': '2027-02-01T00:00:00+00:00'}
+    reordered = dict(reversed(list(record.items())))
+    assert processor.metric_content_hash(record) == processor.metric_content_hash(rewritten) == processor.metric_content_hash(reordered)
+    assert processor.metric_content_hash(record) != processor.metric_content_hash(metric_record(score=0.6))
+
+
+def test_diff_upload_writes_only_new_changed_or_expired_metrics(fake_supabase, monkeypatch):
+    monkeypatch.setattr(processor.time, 'sleep', lambda seconds: None)
+    def upload(*records):
+        processor.upload_metrics({'night': [dict(record) for record in records]}, 1, test_mode=False, upload_mode='diff')
+        upserts = [count for table, op, count in fake_supabase.writes if table == 'safety_metrics' and op == 'upsert']
+        fake_supabase.writes.clear()
+        return sum(upserts)
+
+    assert upload(metric_record('m1'), metric_record('m2'), metric_record('m3')) == 3
+    assert upload(metric_record('m1'), metric_record('m2'), metric_record('m3')) == 0
+
+    # m1 expired in the database, m2 changed, m3 no longer produced
+    fake_supabase.tables['safety_metrics']['m1']['expires_at'] = '2020-01-01T00:00:00+00:00'
+    assert upload(metric_record('m1'), metric_record('m2', score=0.9)) == 2
+    rows = fake_supabase.tables['safety_metrics']
+    assert set(rows) == {'m1', 'm2'}
+    assert rows['m2']['score'] == 0.9
+    assert rows['m1']['expires_at'] == metric_record()['expires_at']
+    assert rows['m2']['content_hash'] == processor.metric_content_hash(metric_record('m2', score=0.9))
+
+
+@pytest.fixture
+def backoff_sleeps(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(processor.time, 'sleep', sleeps.append)
+    return sleeps
+
+
+def test_transient_write_error_is_retried_with_backoff_not_bisected(fake_supabase, backoff_sleeps):
+    failures = iter([httpx.ReadTimeout("timed out")])
+    fake_supabase.write_failure = lambda table, op, rows: next(failures, None)
+    records = [metric_record(f"m{i}") for i in range(100)]
+
+    assert processor.write_metric_batch(records, 'replace', 'Testville') == (100, 0)
+    # One failed insert, then one upsert of the whole batch (the insert may have committed)
+    assert fake_supabase.write_attempts == [('safety_metrics', 'insert', 100), ('safety_metrics', 'upsert', 100)]
+    assert backoff_sleeps == [2]
+
+
+def test_outage_gives_up_after_bounded_retries(fake_supabase, backoff_sleeps):
+    fake_supabase.write_failure = lambda table, op, rows: APIError({'code': 'PGRST003', 'message': 'Timed out acquiring connection'})
+    records = [metric_record(f"m{i}") for i in range(1000)]
+
+    assert processor.write_metric_batch(records, 'upsert', 'Testville') == (0, 1000)
+    assert len(fake_supabase.write_attempts) == processor.METRIC_WRITE_MAX_RETRIES
+    assert backoff_sleeps == [2, 4]
+
+
+def test_poison_row_is_isolated_by_bounded_bisection(fake_supabase, backoff_sleeps):
+    def reject_poison(table, op, rows):
+        if any(row['id'] == 'm37' for row in rows):
+            return APIError({'code': '23502', 'message': 'null value in column "score" violates not-null constraint'})
+    fake_supabase.write_failure = reject_poison
+    records = [metric_record(f"m{i}") for i in range(100)]
+
+    assert processor.write_metric_batch(records, 'replace', 'Testville') == (99, 1)
+    assert set(fake_supabase.tables['safety_metrics']) == {f"m{i}" for i in range(100)} - {'m37'}
+    assert len(fake_supabase.write_attempts) <= 2 * 7 + 1 # Two requests per halving level
+    assert backoff_sleeps == [] # Data errors are not retried as-is
+
+    # Past the depth cap the remaining group fails as a whole instead of splitting further
+    fake_supabase.write_attempts.clear()
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        monkeypatch.setattr(processor, 'METRIC_WRITE_MAX_BISECT_DEPTH', 2)
+        assert processor.write_metric_batch(records, 'upsert', 'Testville') == (75, 25)
+    assert len(fake_supabase.write_attempts) == 1 + 2 + 2
+
+
+def test_diff_upload_refreshes_metrics_expiring_soon(fake_supabase, monkeypatch):
+    monkeypatch.setattr(processor.time, 'sleep', lambda seconds: None)
+    processor.upload_metrics({'night': [metric_record('m1'), metric_record('m2')]}, 1, test_mode=False, upload_mode='diff')
+    soon = (processor.pd.Timestamp.now(tz='UTC') + processor.pd.Timedelta(days=processor.METRIC_EXPIRY_REFRESH_DAYS - 1)).isoformat()
+    later = (processor.pd.Timestamp.now(tz='UTC') + processor.pd.Timedelta(days=processor.METRIC_EXPIRY_REFRESH_DAYS + 1)).isoformat()
+    fake_supabase.tables['safety_metrics']['m1']['expires_at'] = soon
+    fake_supabase.tables['safety_metrics']['m2']['expires_at'] = later
+
+    assert processor.fetch_existing_metric_hashes(1) == {'m1': None, 'm2': processor.metric_content_hash(metric_record('m2'))}
+
+
+def test_diff_upload_without_hashes_upserts_instead_of_deleting(fake_supabase, monkeypatch):
+    monkeypatch.setattr(processor.time, 'sleep', lambda seconds: None)
+    processor.upload_metrics({'night': [metric_record('m1'), metric_record('m2')]}, 1, test_mode=False, upload_mode='diff')
+    fake_supabase.writes.clear()
+    monkeypatch.setattr(processor, 'fetch_existing_metric_hashes', lambda target_city_id: None)
+
+    processor.upload_metrics({'night': [metric_record('m1', score=0.9)]}, 1, test_mode=False, upload_mode='diff')
+    assert [op for table, op, count in fake_supabase.writes if table == 'safety_metrics'] == ['upsert']
+    assert set(fake_supabase.tables['safety_metrics']) == {'m1', 'm2'}
+    assert fake_supabase.tables['safety_metrics']['m1']['score'] == 0.9
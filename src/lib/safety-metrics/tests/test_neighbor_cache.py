@@ -0,0 +1,137 @@
+import os
+
+import pytest
+
+import city_safety_processor_refactored as processor
+from fakes import FakeCall, lapd_records
+
+
+@pytest.fixture
+def neighbor_rpc_blocks(fake_supabase, monkeypatch):
+    """Records the block ids sent to the neighbor RPC."""
+    monkeypatch.setattr(processor, 'CENSUS_VERSIONS', {})
+    monkeypatch.setattr(processor.time, 'sleep', lambda seconds: None)
+    requested = []
+    rpc = fake_supabase.rpc
+    def recording_rpc(name, params):
+        if name == 'find_block_neighbors_batch':
+            requested.extend(params['target_block_ids'])
+        return rpc(name, params)
+    monkeypatch.setattr(fake_supabase, 'rpc', recording_rpc)
+    return requested
+
+
+def cache_files(tmp_path):
+    return sorted(os.listdir(tmp_path / 'neighbor_cache'))
+
+
+def test_warm_run_skips_neighbor_rpc(lapd_config, neighbor_rpc_blocks):
+    block_pks = ['B3400_11820', 'B3401_11820', 'B3405_11825']
+    cold = processor.fetch_block_neighbors(block_pks, lapd_config)
+    assert sorted(neighbor_rpc_blocks) == sorted(block_pks)
+
+    neighbor_rpc_blocks.clear()
+    warm = processor.fetch_block_neighbors(block_pks, lapd_config)
+    assert neighbor_rpc_blocks == []
+    assert {pk: sorted(neighbors) for pk, neighbors in warm.items()} == {pk: sorted(neighbors) for pk, neighbors in cold.items()}
+
+
+def test_only_missing_blocks_are_computed_and_merged(lapd_config, neighbor_rpc_blocks):
+    processor.fetch_block_neighbors(['B3400_11820'], lapd_config)
+    neighbor_rpc_blocks.clear()
+    neighbors = processor.fetch_block_neighbors(['B3400_11820', 'B3410_11830'], lapd_config)
+    assert neighbor_rpc_blocks == ['B3410_11830']
+    assert 'B3399_11819' in neighbors['B3400_11820'] and 'B3411_11831' in neighbors['B3410_11830']
+
+    neighbor_rpc_blocks.clear()
+    processor.fetch_block_neighbors(['B3400_11820', 'B3410_11830'], lapd_config)
+    assert neighbor_rpc_blocks == []
+
+
+def test_cache_is_invalidated_when_census_blocks_change(lapd_config, neighbor_rpc_blocks, tmp_path):
+    processor.fetch_block_neighbors(['B3400_11820'], lapd_config)
+    old_files = cache_files(tmp_path)
+
+    next(iter(processor.supabase.tables['census_blocks'].values()))['updated_at'] = '2026-10-16'
+    processor.CENSUS_VERSIONS.clear()
+    neighbor_rpc_blocks.clear()
+    processor.fetch_block_neighbors(['B3400_11820'], lapd_config)
+    assert neighbor_rpc_blocks == ['B3400_11820']
+    assert len(cache_files(tmp_path)) == 1 and cache_files(tmp_path) != old_files
+
+
+def test_cache_is_keyed_by_neighbor_radius(lapd_config, neighbor_rpc_blocks, tmp_path):
+    processor.fetch_block_neighbors(['B3400_11820'], lapd_config)
+    wider_config = {**lapd_config, 'geospatial': {**lapd_config.get('geospatial', {}), 'neighbor_radius_meters': 12345}}
+    neighbor_rpc_blocks.clear()
+    processor.fetch_block_neighbors(['B3400_11820'], wider_config)
+    assert neighbor_rpc_blocks == ['B3400_11820']
+    assert len(cache_files(tmp_path)) == 2
+
+
+def test_blocks_without_neighbors_are_cached(lapd_config, neighbor_rpc_blocks, monkeypatch):
+    # The RPC leaves blocks without neighbors out of its response
+    rpc = processor.supabase.rpc
+    def without_isolated(name, params):
+        neighbor_map = rpc(name, params).execute().data
+        return FakeCall(lambda: {pk: neighbors for pk, neighbors in neighbor_map.items() if pk != 'B3405_11825'})
+    monkeypatch.setattr(processor.supabase, 'rpc', without_isolated)
+
+    block_pks = ['B3400_11820', 'B3405_11825']
+    assert processor.fetch_block_neighbors(block_pks, lapd_config)['B3405_11825'] == []
+    neighbor_rpc_blocks.clear()
+    assert processor.fetch_block_neighbors(block_pks, lapd_config)['B3405_11825'] == []
+    assert neighbor_rpc_blocks == []
+
+
+def test_read_only_cache_is_used_but_not_written(lapd_config, neighbor_rpc_blocks, tmp_path):
+    processor.fetch_block_neighbors(['B3400_11820'], lapd_config)
+    old_files = {name: os.path.getmtime(tmp_path / 'neighbor_cache' / name) for name in cache_files(tmp_path)}
+
+    neighbor_rpc_blocks.clear()
+    neighbors = processor.fetch_block_neighbors(['B3400_11820', 'B3410_11830'], lapd_config, cache_writes=False)
+    assert neighbor_rpc_blocks == ['B3410_11830']
+    assert 'B3411_11831' in neighbors['B3410_11830']
+    assert {name: os.path.getmtime(tmp_path / 'neighbor_cache' / name) for name in cache_files(tmp_path)} == old_files
+
+
+
+@pytest.fixture
+def census_index(fake_supabase, monkeypatch):
+    monkeypatch.setattr(processor, 'CENSUS_BLOCK_INDEXES', {})
+    return processor.CENSUS_BLOCK_INDEXES
+
+
+def sorted_neighbors(neighbor_map):
+    return {str(pk): sorted(neighbors) for pk, neighbors in neighbor_map.items()}
+
+
+def test_local_neighbors_match_the_rpc_inside_the_grid(lapd_config, neighbor_rpc_blocks, census_index):
+    block_pks = [f"B{lat}_{lon}" for lat in range(3395, 3415, 3) for lon in range(11815, 11835, 4)]
+    local = processor.compute_block_neighbors(block_pks, lapd_config, neighbor_engine='local')
+    assert neighbor_rpc_blocks == []
+    rpc = processor.compute_block_neighbors(block_pks, lapd_config, neighbor_engine='rpc')
+    assert sorted_neighbors(local) == sorted_neighbors(rpc)
+
+
+def test_local_neighbors_cover_every_block_and_stop_at_the_grid_edge(lapd_config, census_index):
+    neighbors = processor.find_block_neighbors_local(None, lapd_config)
+    assert len(neighbors) == 900
+    assert sorted(neighbors['B3390_11810']) == ['B3390_11811', 'B3391_11810', 'B3391_11811']
+    assert len(neighbors['B3390_11820']) == 5 and len(neighbors['B3405_11825']) == 8
+
+
+def test_local_neighbors_follow_the_radius(lapd_config, census_index):
+    # Cells are ~1.1 km tall and ~0.92 km wide, so 1 km reaches the second column but not the second row
+    wider_config = {**lapd_config, 'geospatial': {'neighbor_radius_meters': 1000}}
+    neighbors = processor.find_block_neighbors_local(['B3405_11825'], wider_config)
+    assert sorted(neighbors['B3405_11825']) == sorted(f"B{3405 + i}_{11825 + j}" for i in (-1, 0, 1) for j in (-2, -1, 0, 1, 2) if (i, j) != (0, 0))
+
+
+def test_local_and_rpc_neighbor_engines_score_identically(lapd_config, census_index):
+    processed_df = processor.process_crime_data(lapd_records(3000), lapd_config, block_memo=False)
+    def scored(neighbor_engine):
+        metrics_by_type = processor.calculate_metrics(processed_df, 1, lapd_config, neighbor_engine=neighbor_engine, cache_neighbors=False)
+        return {metric_type: sorted(((record['id'], record['weighted_incidents'], record['score']) for record in metrics))
+                for metric_type, metrics in metrics_by_type.items()}
+    assert scored('local') == scored('rpc')
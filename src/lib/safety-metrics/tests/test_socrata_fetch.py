@@ -0,0 +1,175 @@
+import io
+import re
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import city_safety_processor_refactored as processor
+from fakes import lapd_records
+
+DAYS_BACK = 90
+
+
+@pytest.fixture
+def socrata(monkeypatch):
+    """
+    Fake Socrata dataset with one LAPD record every 12 hours (newest first in 'records').
+    Serves date-bounded $where/$limit/$offset pages in date order; every request is logged
+    in 'requests' and raises when 'fail'(where, offset) is true.
+    """
+    now = datetime.now(timezone.utc)
+    state = {'requests': [], 'fail': lambda where, offset: False, 'sleeps': []}
+    state['records'] = [
+        {'dr_no': str(i), 'date_occ': (now - timedelta(hours=12 * i + 6)).strftime('%Y-%m-%dT%H:%M:%S.000'),
+         'time_occ': '1200', 'crm_cd': '624', 'lat': '34.05', 'lon': '-118.25'}
+        for i in range(2 * DAYS_BACK + 20)
+    ]
+
+    def get(self, dataset_id, select=None, where=None, group=None, order=None, limit=1000, offset=0):
+        state['requests'].append((where, offset))
+        if state['fail'](where, offset):
+            raise processor.requests.exceptions.ConnectionError('connection reset')
+        bounds = re.findall(r"date_occ (>=|<) '([^']+)'", where)
+        rows = [record for record in state['records']
+                if all(record['date_occ'] >= value if op == '>=' else record['date_occ'] < value for op, value in bounds)]
+        rows.sort(key=lambda record: record['date_occ'])
+        return rows[offset:offset + limit]
+
+    monkeypatch.setattr(processor.Socrata, 'get', get)
+    monkeypatch.setattr(processor.time, 'sleep', state['sleeps'].append)
+    return state
+
+
+def in_days_back(socrata):
+    return [record for record in socrata['records'] if int(record['dr_no']) < 2 * DAYS_BACK]
+
+
+def dr_numbers(records):
+    return [record['dr_no'] for record in records]
+
+
+def windowed_fetch(lapd_config, max_records=10000):
+    status = {}
+    records = processor.fetch_crime_data(lapd_config, DAYS_BACK, max_records, fetch_mode='windowed', fetch_status=status)
+    return records, status
+
+
+def test_window_is_paged_with_offset_until_a_short_page(socrata):
+    window = (datetime.now(timezone.utc) - timedelta(days=20), datetime.now(timezone.utc))
+    records = processor.fetch_socrata_window(processor.Socrata('example.com', None), '2nrs-mtv8', 'dr_no', '',
+                                             'date_occ', window, page_size=7)
+    expected = sorted(socrata['records'][:40], key=lambda record: record['date_occ'])
+    assert records == expected
+    assert [offset for _, offset in socrata['requests']] == [0, 7, 14, 21, 28, 35]
+
+
+def test_windowed_fetch_returns_every_record_once(lapd_config, socrata):
+    records, status = windowed_fetch(lapd_config)
+    assert sorted(dr_numbers(records), key=int) == dr_numbers(in_days_back(socrata))
+    assert dr_numbers(records) == sorted(dr_numbers(records), key=int, reverse=True) # Oldest window first
+    assert len(socrata['requests']) == len({where for where, _ in socrata['requests']}) # One page per window
+    assert status['complete']
+
+
+def test_transient_page_failures_are_retried(lapd_config, socrata):
+    failed = set()
+    def fail_once(where, offset):
+        first_attempt = where not in failed
+        failed.add(where)
+        return first_attempt
+    socrata['fail'] = fail_once
+
+    records, status = windowed_fetch(lapd_config)
+    assert len(records) == len(in_days_back(socrata))
+    assert socrata['sleeps'] == [2] * len(failed)
+    assert status['complete']
+
+
+def test_failed_window_is_skipped_and_marks_the_fetch_incomplete(lapd_config, socrata):
+    middle_window_start = (datetime.now(timezone.utc) - timedelta(days=60)).strftime('%Y-%m-%d')
+    socrata['fail'] = lambda where, offset: f"date_occ >= '{middle_window_start}" in where
+
+    records, status = windowed_fetch(lapd_config)
+    failed_attempts = [where for where, _ in socrata['requests'] if f"date_occ >= '{middle_window_start}" in where]
+    assert len(failed_attempts) == processor.SOCRATA_MAX_RETRIES
+    assert socrata['sleeps'] == [2, 4]
+    # Only the other two windows came back
+    assert set(dr_numbers(records)) == {record['dr_no'] for record in in_days_back(socrata)
+                                        if not 30 <= (int(record['dr_no']) * 12 + 6) / 24 < 60}
+    assert len(records) == len(in_days_back(socrata)) * 2 // 3
+    assert not status['complete']
+
+
+def test_windowed_fetch_keeps_the_newest_max_records(lapd_config, socrata):
+    records, status = windowed_fetch(lapd_config, max_records=50)
+    assert sorted(dr_numbers(records), key=int) == [str(i) for i in range(50)]
+    assert not status['complete']
+
+
+def test_streamed_pages_arrive_newest_first_and_stop_at_max_records(lapd_config, socrata):
+    pages = list(processor.iter_crime_data_pages(lapd_config, DAYS_BACK, 70))
+    assert [len(page) for page in pages if page] == [60, 10]
+    assert sorted((dr_no for page in pages for dr_no in dr_numbers(page)), key=int) == [str(i) for i in range(70)]
+
+
+class FakeCsvResponse:
+    def __init__(self, body: bytes, status_code: int = 200):
+        self.raw = io.BytesIO(body)
+        self.status_code = status_code
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise processor.requests.exceptions.HTTPError(f"{self.status_code} Server Error")
+
+
+@pytest.fixture
+def csv_export(monkeypatch):
+    """Fake /resource/<id>.csv endpoint serving 'records' as CSV (or 'status_code'); requests are logged."""
+    state = {'records': lapd_records(3000), 'status_code': 200, 'requests': []}
+    def get(self, url, params=None, stream=False, timeout=None):
+        state['requests'].append((url, params))
+        return FakeCsvResponse(pd.DataFrame(state['records']).to_csv(index=False).encode('utf-8'), state['status_code'])
+    monkeypatch.setattr(processor.requests.Session, 'get', get)
+    return state
+
+
+def test_csv_export_is_read_into_typed_columns(lapd_config, csv_export):
+    status = {}
+    frame = processor.fetch_crime_data(lapd_config, DAYS_BACK, 5000, fetch_mode='csv', fetch_status=status)
+    assert isinstance(frame, pd.DataFrame) and len(frame) == 3000
+    assert frame['lat'].dtype == np.float64
+    assert frame['crm_cd'].tolist() == [record['crm_cd'] for record in csv_export['records']]
+    assert frame['time_occ'].tolist() == [record.get('time_occ', np.nan) for record in csv_export['records']]
+
+    url, params = csv_export['requests'][0]
+    assert url == 'https://data.lacity.org/resource/2nrs-mtv8.csv'
+    assert params['$limit'] == 5000 and params['$order'] == 'date_occ DESC, :id'
+    assert status['complete']
+
+
+def test_csv_export_processes_like_json_records(lapd_config, csv_export):
+    frame = processor.fetch_crime_data(lapd_config, DAYS_BACK, 5000, fetch_mode='csv')
+    from_csv = processor.process_crime_data(frame, lapd_config, block_memo=False)
+    from_json = processor.process_crime_data(csv_export['records'], lapd_config, block_memo=False)
+    pd.testing.assert_frame_equal(from_csv, from_json)
+
+
+def test_csv_export_at_max_records_is_incomplete(lapd_config, csv_export):
+    status = {}
+    assert len(processor.fetch_crime_data(lapd_config, DAYS_BACK, 3000, fetch_mode='csv', fetch_status=status)) == 3000
+    assert not status['complete']
+
+
+def test_failed_csv_export_returns_nothing(lapd_config, csv_export):
+    csv_export['status_code'] = 503
+    status = {}
+    assert len(processor.fetch_crime_data(lapd_config, DAYS_BACK, 5000, fetch_mode='csv', fetch_status=status)) == 0
+    assert not status['complete']
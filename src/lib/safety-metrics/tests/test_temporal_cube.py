@@ -0,0 +1,97 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import city_safety_processor_refactored as processor
+from fakes import lapd_records
+
+
+@pytest.fixture
+def census_version(fake_supabase, monkeypatch):
+    monkeypatch.setattr(processor, 'CENSUS_VERSIONS', {})
+    return processor.get_census_version(1)
+
+
+@pytest.fixture
+def processed_df(lapd_config):
+    return processor.process_crime_data(lapd_records(20000), lapd_config, block_memo=False)
+
+
+def assert_partials_equal(from_cube: pd.DataFrame, direct: pd.DataFrame):
+    key_columns = ['metric_type', 'census_block_pk', 'block_group_identifier', 'direct_incidents', 'population']
+    from_cube = from_cube.sort_values(['metric_type', 'census_block_pk']).reset_index(drop=True)
+    direct = direct.sort_values(['metric_type', 'census_block_pk']).reset_index(drop=True)
+    assert len(from_cube) == len(direct)
+    assert (from_cube[key_columns].astype(str).values == direct[key_columns].astype(str).values).all()
+    np.testing.assert_allclose(from_cube['latitude_sum'], direct['latitude_sum'], rtol=1e-12)
+    np.testing.assert_allclose(from_cube['longitude_sum'], direct['longitude_sum'], rtol=1e-12)
+
+
+def test_cube_partials_equal_direct_partials(processed_df, lapd_config, census_version):
+    cube = processor.build_temporal_cube(processed_df, 1, lapd_config)
+    processor.save_temporal_cube(1, census_version, cube)
+    cube = processor.load_temporal_cube(1, census_version)
+
+    assert_partials_equal(processor.metric_partials_from_cube(cube),
+                          processor.reduce_metric_partials(processed_df, 1, lapd_config))
+
+
+def test_cube_month_window_and_time_filter(processed_df, lapd_config, monkeypatch):
+    cube = processor.build_temporal_cube(processed_df, 1, lapd_config)
+    months = processor.cube_months_between(cube, '2024-02', '2024-04')
+    assert months == ['2024-02', '2024-03', '2024-04']
+    night_hours = [0, 1, 2, 3]
+    from_cube = processor.metric_partials_from_cube(cube, time_filters={'night': night_hours}, months=months)
+
+    in_window = processed_df[processed_df['month'].isin(cube['months'][np.isin(
+        [processor.format_cube_month(m) for m in cube['months'].tolist()], months)])]
+    monkeypatch.setitem(processor.METRIC_DEFINITIONS['night'], 'time_filter', night_hours)
+    assert_partials_equal(from_cube, processor.reduce_metric_partials(in_window, 1, lapd_config))
+
+
+def test_main_scores_from_saved_cube_without_fetching(processed_df, lapd_config, census_version, monkeypatch):
+    processor.save_temporal_cube(1, census_version, processor.build_temporal_cube(processed_df, 1, lapd_config))
+    monkeypatch.setattr(processor, 'fetch_crime_data', lambda *args, **kwargs: pytest.fail("--from-cube must not fetch"))
+    uploaded = {}
+    monkeypatch.setattr(processor, 'upload_metrics', lambda metrics_by_type, **kwargs: uploaded.update(metrics_by_type) or (0, 0))
+
+    processor.main(target_city_id=1, test_mode=True, from_cube=True, cube_months=('2024-02', '2024-04'),
+                   scoring_engine='vectorized', metric_output='columnar')
+
+    cube = processor.load_temporal_cube(1, census_version)
+    expected = processor.calculate_metrics_from_partials(
+        processor.metric_partials_from_cube(cube, months=['2024-02', '2024-03', '2024-04']), 1, lapd_config,
+        scoring_engine='vectorized', metric_output='columnar')
+    assert uploaded.keys() == expected.keys()
+    for metric_type, metrics in expected.items():
+        assert np.array_equal(uploaded[metric_type].columns['score'], metrics.columns['score'])
+
+
+def test_cube_of_outdated_census_data_is_not_used(processed_df, lapd_config, census_version, monkeypatch, tmp_path):
+    processor.save_temporal_cube(1, census_version, processor.build_temporal_cube(processed_df, 1, lapd_config))
+    next(iter(processor.supabase.tables['census_blocks'].values()))['updated_at'] = '2026-10-16'
+    processor.CENSUS_VERSIONS.clear()
+    uploaded = {}
+    monkeypatch.setattr(processor, 'upload_metrics', lambda metrics_by_type, **kwargs: uploaded.update(metrics_by_type) or (0, 0))
+
+    processor.main(target_city_id=1, test_mode=True, from_cube=True)
+    assert uploaded == {}
+
+    # Saving for the new census version replaces the outdated cube
+    processor.save_temporal_cube(1, processor.get_census_version(1), processor.build_temporal_cube(processed_df, 1, lapd_config))
+    assert os.listdir(tmp_path / 'temporal_cube') == [f"city_1_{processor.get_census_version(1)}.npz"]
+
+
+def test_census_reload_invalidates_cube(processed_df, lapd_config, census_version, monkeypatch, tmp_path):
+    processor.save_temporal_cube(1, census_version, processor.build_temporal_cube(processed_df, 1, lapd_config))
+    processor.save_block_memo(1, census_version, processor.load_block_memo(1, census_version))
+    monkeypatch.chdir(tmp_path) # fetch_census_blocks logs to census_fetch.log in the working directory
+    monkeypatch.syspath_prepend(os.path.join(os.path.dirname(processor.SCRIPT_DIR), '..', '..'))
+    fetch_census_blocks = pytest.importorskip('fetch_census_blocks')
+    monkeypatch.setattr(fetch_census_blocks, 'SAFETY_METRICS_DATA_DIR', str(tmp_path))
+
+    fetch_census_blocks.CensusFetcher.invalidate_safety_metric_caches(object.__new__(fetch_census_blocks.CensusFetcher), city_id=1)
+    assert processor.load_temporal_cube(1, census_version) is None
+    assert os.listdir(tmp_path / 'temporal_cube') == [] and os.listdir(tmp_path / 'block_memo') == []
@@ -455,10 +455,29 @@ export type Database = {
         }
         Relationships: []
       }
+      safety_metric_questions: {
+        Row: {
+          metric_type: string
+          question: string
+          updated_at: string | null
+        }
+        Insert: {
+          metric_type: string
+          question: string
+          updated_at?: string | null
+        }
+        Update: {
+          metric_type?: string
+          question?: string
+          updated_at?: string | null
+        }
+        Relationships: []
+      }
       safety_metrics: {
         Row: {
           block_group_id: string | null
           city_id: number | null
+          content_hash: string | null
           created_at: string | null
           description: string
           direct_incidents: number
@@ -477,6 +496,7 @@ export type Database = {
         Insert: {
           block_group_id?: string | null
           city_id?: number | null
+          content_hash?: string | null
           created_at?: string | null
           description: string
           direct_incidents: number
@@ -495,6 +515,7 @@ export type Database = {
         Update: {
           block_group_id?: string | null
           city_id?: number | null
+          content_hash?: string | null
           created_at?: string | null
           description?: string
           direct_incidents?: number
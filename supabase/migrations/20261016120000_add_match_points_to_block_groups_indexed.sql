@@ -0,0 +1,39 @@
+-- Index-tagged variant of match_points_to_block_groups.
+-- Each input point carries an 'idx'; every returned row echoes it, so callers can join
+-- results by index instead of relying on output order. Unmatched points return no row.
+CREATE OR REPLACE FUNCTION match_points_to_block_groups_indexed(points_json jsonb)
+RETURNS TABLE (
+  idx integer,
+  id text,
+  block_group_id text,
+  total_population integer,
+  housing_units integer
+)
+LANGUAGE sql
+STABLE
+SECURITY DEFINER
+SET search_path = public
+AS $$
+  SELECT
+    (p->>'idx')::integer AS idx,
+    cb.id::text,
+    cb.block_group_id,
+    cb.total_population,
+    cb.housing_units
+  FROM jsonb_array_elements(points_json) AS p
+  CROSS JOIN LATERAL (
+    SELECT c.id, c.block_group_id, c.total_population, c.housing_units
+    FROM census_blocks c
+    WHERE ST_Contains(
+      c.geom,
+      ST_SetSRID(ST_MakePoint((p->>'lon')::double precision, (p->>'lat')::double precision), 4326)
+    )
+    LIMIT 1
+  ) cb;
+$$;
+
+-- Spatial index used by the ST_Contains lookup above
+CREATE INDEX IF NOT EXISTS idx_census_blocks_geom ON census_blocks USING GIST (geom);
+
+-- Grant usage
+GRANT EXECUTE ON FUNCTION match_points_to_block_groups_indexed(jsonb) TO service_role;
@@ -0,0 +1,11 @@
+-- Content hash for diff-based safety_metrics uploads.
+-- The processor hashes each record (excluding created_at/expires_at), fetches the stored hashes
+-- per city and only upserts new or changed rows; ids it no longer produces are deleted.
+ALTER TABLE safety_metrics
+    ADD COLUMN IF NOT EXISTS content_hash TEXT;
+
+-- Per-city id/hash scans when diffing an upload
+CREATE INDEX IF NOT EXISTS idx_safety_metrics_city_id_id
+    ON safety_metrics (city_id, id);
+
+COMMENT ON COLUMN safety_metrics.content_hash IS 'Hash of the metric content (excluding created_at/expires_at) written by diff uploads; NULL for rows written by delete-and-insert uploads';
@@ -0,0 +1,52 @@
+-- Slim safety_metrics payloads (city_safety_processor --metric-payload slim).
+-- The processor leaves out fields the database can derive:
+--   geom                    always rebuilt from longitude/latitude by a BEFORE INSERT OR UPDATE trigger
+--   question                when NULL: looked up by metric_type in safety_metric_questions (synced by the processor)
+--   created_at, expires_at  column defaults: NOW() and NOW() + 90 days (METRIC_EXPIRY_DAYS); the only
+--                           place the database defines the expiry interval
+-- Slim writes ask for the defaults of the omitted columns (PostgREST Prefer: missing=default with the
+-- columns listed in ?columns=, or the COPY staging table's defaults), so an upsert that rewrites an
+-- existing row refreshes them too. Full payloads keep working unchanged.
+
+-- Dictionary of metric questions (one row per metric type)
+CREATE TABLE IF NOT EXISTS safety_metric_questions (
+    metric_type TEXT PRIMARY KEY,
+    question TEXT NOT NULL,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT TIMEZONE('utc', NOW())
+);
+
+ALTER TABLE safety_metric_questions ENABLE ROW LEVEL SECURITY;
+
+DROP TRIGGER IF EXISTS update_safety_metric_questions_updated_at ON safety_metric_questions;
+CREATE TRIGGER update_safety_metric_questions_updated_at
+    BEFORE UPDATE ON safety_metric_questions
+    FOR EACH ROW
+    EXECUTE FUNCTION update_updated_at_column();
+
+-- Defaults for rows written without timestamps
+ALTER TABLE safety_metrics
+    ALTER COLUMN created_at SET DEFAULT NOW(),
+    ALTER COLUMN expires_at SET DEFAULT NOW() + INTERVAL '90 days';
+
+CREATE OR REPLACE FUNCTION fill_safety_metric_derived_fields()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF NEW.latitude IS NOT NULL AND NEW.longitude IS NOT NULL THEN
+        NEW.geom := ST_SetSRID(ST_MakePoint(NEW.longitude, NEW.latitude), 4326);
+    END IF;
+
+    IF NEW.question IS NULL THEN
+        NEW.question := (SELECT q.question FROM safety_metric_questions q WHERE q.metric_type = NEW.metric_type);
+    END IF;
+
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS fill_safety_metric_derived_fields ON safety_metrics;
+CREATE TRIGGER fill_safety_metric_derived_fields
+    BEFORE INSERT OR UPDATE ON safety_metrics
+    FOR EACH ROW
+    EXECUTE FUNCTION fill_safety_metric_derived_fields();
+
+COMMENT ON TABLE safety_metric_questions IS 'Question text per metric type; fills safety_metrics.question for slim metric uploads';